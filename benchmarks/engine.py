@@ -0,0 +1,303 @@
+"""
+Benchmarks of the engine hot paths: opening and decoding sources, creating
+thumbnails and encoding them, for synthetic sources of several formats and
+sizes.
+
+    python -m benchmarks run --output baseline.json
+    python -m benchmarks run --output current.json
+    python -m benchmarks compare baseline.json current.json --threshold 0.1
+
+Every case runs in a forked process of its own. Its peak memory is how much
+the resident set size peaks above where it was before the timed runs, exact
+on linux where the peak can be reset, and only an upper bound elsewhere.
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+from io import BytesIO
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings.pil")
+
+import django  # noqa: E402
+
+django.setup()
+
+from PIL import Image  # noqa: E402
+import PIL  # noqa: E402
+import pillow_avif  # noqa: E402
+from sorl.thumbnail.base import ThumbnailBackend  # noqa: E402
+from sorl.thumbnail.parsers import parse_geometry  # noqa: E402
+
+from sorl_thumbnail_avif.thumbnail.engines import AvifEngine  # noqa: E402
+
+SOURCE_FORMATS = ("JPEG", "PNG", "WEBP", "AVIF")
+SOURCE_SIZES = ((640, 480), (1920, 1080), (4000, 3000))
+OUTPUT_FORMATS = ("AVIF", "WEBP", "JPEG")
+GEOMETRY = "400x300"
+CREATE_OPTIONS = {
+    "scale": {},
+    "crop": {"crop": "center"},
+    "blur": {"blur": 3},
+    "padding": {"padding": True},
+}
+
+
+def make_source(format_, size):
+    """
+    Returns the encoded bytes of a synthetic photo like image: a fractal for
+    detail over gradients for smooth areas.
+    """
+    width, height = size
+    detail = Image.effect_mandelbrot(size, (-2, -1.2, 1, 1.2), 100)
+    gradient = Image.linear_gradient("L").resize(size)
+    image = Image.merge("RGB", (detail, gradient, gradient.transpose(Image.ROTATE_180)))
+    buffer = BytesIO()
+    image.save(buffer, format_, quality=85)
+    return buffer.getvalue()
+
+
+def get_options(**options):
+    options = dict(ThumbnailBackend.default_options, **options)
+    options["image_info"] = {}
+    return options
+
+
+def get_cases():
+    """
+    Returns ``(name, setup, func)`` for every case. ``setup`` is called once
+    and its result passed to ``func`` on every run.
+    """
+    engine = AvifEngine()
+
+    def decoded(data):
+        image = engine.get_image(data)
+        engine.load(image)
+        return image
+
+    def thumbnail(data):
+        image = decoded(data)
+        geometry = parse_geometry(
+            GEOMETRY, engine.get_image_ratio(image, get_options())
+        )
+        return engine.create(image, geometry, get_options())
+
+    cases = []
+    for source_format in SOURCE_FORMATS:
+        for size in SOURCE_SIZES:
+            source = "%s-%dx%d" % (source_format.lower(), *size)
+
+            def source_data(source_format=source_format, size=size):
+                return make_source(source_format, size)
+
+            cases.append(
+                ("get_image/%s" % source, source_data, lambda data: decoded(data))
+            )
+
+            for name, options in CREATE_OPTIONS.items():
+
+                def create(image, options=options):
+                    geometry = parse_geometry(
+                        GEOMETRY, engine.get_image_ratio(image, get_options())
+                    )
+                    return engine.create(image.copy(), geometry, get_options(**options))
+
+                cases.append(
+                    (
+                        "create/%s/%s" % (name, source),
+                        lambda source_data=source_data: decoded(source_data()),
+                        create,
+                    )
+                )
+
+    # Encoding only depends on the thumbnail, one source is enough
+    for output_format in OUTPUT_FORMATS:
+
+        def encode(image, output_format=output_format):
+            return engine._get_raw_data(
+                image,
+                output_format,
+                ThumbnailBackend.default_options["quality"],
+                image_info={},
+                options={},
+            )
+
+        cases.append(
+            (
+                "encode/%s/%s" % (output_format.lower(), GEOMETRY),
+                lambda: thumbnail(make_source("JPEG", SOURCE_SIZES[1])),
+                encode,
+            )
+        )
+    return cases
+
+
+def run_case(index, repeat, warmup):
+    name, setup, func = get_cases()[index]
+    arg = setup()
+    for _ in range(warmup):
+        func(arg)
+
+    rss_before = get_memory("VmRSS")
+    reset_peak_memory()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(arg)
+        timings.append(time.perf_counter() - start)
+
+    return name, summarize(timings, max(get_memory("VmHWM") - rss_before, 0))
+
+
+def get_memory(field):
+    """
+    Returns the resident set size (``VmRSS``) or its peak (``VmHWM``) in
+    bytes. Without ``/proc`` both are the peak from ``getrusage``.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    unit = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+
+
+def reset_peak_memory():
+    """
+    Resets ``VmHWM`` to the current resident set size, linux only.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = (len(values) - 1) * percent / 100
+    low, high = math.floor(index), math.ceil(index)
+    return values[low] + (values[high] - values[low]) * (index - low)
+
+
+def summarize(timings, peak_memory):
+    mean = sum(timings) / len(timings)
+    return {
+        "runs": len(timings),
+        "mean_ms": mean * 1000,
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p90_ms": percentile(timings, 90) * 1000,
+        "p99_ms": percentile(timings, 99) * 1000,
+        "ops_per_second": 1 / mean if mean else None,
+        "peak_memory_bytes": peak_memory,
+    }
+
+
+def run(repeat=10, warmup=1, select=None):
+    """
+    Runs the cases whose name contains ``select`` and returns the results.
+    """
+    cases = [
+        index
+        for index, (name, _, _) in enumerate(get_cases())
+        if not select or select in name
+    ]
+    context = multiprocessing.get_context("fork")
+
+    results = {}
+    for index in cases:
+        with context.Pool(1) as pool:
+            name, result = pool.apply(run_case, (index, repeat, warmup))
+        results[name] = result
+        print(
+            "%-32s p50 %9.2fms  p99 %9.2fms  %8.1f/s  peak %6.1fMB"
+            % (
+                name,
+                result["p50_ms"],
+                result["p99_ms"],
+                result["ops_per_second"],
+                result["peak_memory_bytes"] / 2**20,
+            ),
+            file=sys.stderr,
+        )
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "pillow": PIL.__version__,
+            "pillow_avif": pillow_avif.__version__,
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def compare(baseline, current, threshold=0.1, metrics=("p50_ms", "peak_memory_bytes")):
+    """
+    Returns ``(name, metric, baseline, current, change)`` for every metric of
+    every case in both runs that got worse by more than ``threshold``.
+    """
+    regressions = []
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        for metric in metrics:
+            before, after = base[metric], result[metric]
+            if before and after > before * (1 + threshold):
+                regressions.append((name, metric, before, after, after / before - 1))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--repeat", type=int, default=10)
+    run_parser.add_argument("--warmup", type=int, default=1)
+    run_parser.add_argument("--select", help="only run cases containing this")
+    run_parser.add_argument("--output", help="write the results to this file")
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="flag regressions against a baseline"
+    )
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        results = run(args.repeat, args.warmup, args.select)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    regressions = compare(baseline, current, args.threshold)
+    for name, metric, before, after, change in regressions:
+        print(
+            "%s %s: %.2f -> %.2f (+%.0f%%)"
+            % (name, metric, before, after, change * 100)
+        )
+    if regressions:
+        sys.exit(1)
+    print("No regressions beyond %.0f%%" % (args.threshold * 100))
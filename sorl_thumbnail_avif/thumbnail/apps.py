@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+
+
+class AvifThumbnailConfig(AppConfig):
+    name = "sorl_thumbnail_avif.thumbnail"
+    # sorl.thumbnail already uses the "thumbnail" label
+    label = "avif_thumbnail"
+    verbose_name = "Thumbnail AVIF"
+
+    def ready(self):
+        from sorl_thumbnail_avif.thumbnail.metrics import connect_collectors
+
+        connect_collectors()
@@ -1,8 +1,52 @@
+import hashlib
+import logging
+import os
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import sync_to_async
+from django.core.files.base import File
+from sorl.thumbnail import default
 from sorl.thumbnail.base import ThumbnailBackend
-from sorl.thumbnail.conf import settings
 from sorl.thumbnail.conf import defaults as default_settings
-from sorl.thumbnail.helpers import serialize, tokey
+from sorl.thumbnail.helpers import serialize, toint, tokey
+from sorl.thumbnail.images import (
+    DummyImageFile,
+    ImageFile,
+    deserialize_image_file,
+)
+from sorl.thumbnail.parsers import parse_geometry
+
+from sorl_thumbnail_avif.thumbnail.conf import defaults as avif_default_settings
+from sorl_thumbnail_avif.thumbnail.conf import settings
+from sorl_thumbnail_avif.thumbnail.engines.pil_engine import CHUNK_SIZE
+from sorl_thumbnail_avif.thumbnail.executors import (
+    DatabaseThreadPoolExecutor,
+    get_async_executor,
+    get_encode_executor,
+    render_in_process_pool,
+)
+from sorl_thumbnail_avif.thumbnail.helpers import (
+    DECODE_ERRORS,
+    SourceImageError,
+    SourceReadError,
+)
+from sorl_thumbnail_avif.thumbnail.images import (
+    PlaceholderImageFile,
+    StatelessImageFile,
+    existing_thumbnails,
+)
+from sorl_thumbnail_avif.thumbnail.locks import generation_locks
+from sorl_thumbnail_avif.thumbnail.metrics import stage
+from sorl_thumbnail_avif.thumbnail.middleware import get_negotiated_format
+from sorl_thumbnail_avif.thumbnail.queues import get_deferred_queue
+
+logger = logging.getLogger(__name__)
 
+# Thumbnails by key fetched by ``prefetch_thumbnails`` inside ``prefetching``
+_prefetched = ContextVar("thumbnail_prefetched", default=None)
 
 EXTENSIONS = {
     "JPEG": "jpg",
@@ -14,6 +58,982 @@ EXTENSIONS = {
 
 
 class AvifThumbnail(ThumbnailBackend):
+    # Like ``extra_options`` these are only added to the options (and so to
+    # the thumbnail key) when the setting differs from its default.
+    avif_options = (
+        ("avif_speed", "THUMBNAIL_AVIF_SPEED"),
+        ("avif_threads", "THUMBNAIL_AVIF_THREADS"),
+        ("avif_codec", "THUMBNAIL_AVIF_CODEC"),
+        ("avif_tiling", "THUMBNAIL_AVIF_TILING"),
+    )
+
+    def get_thumbnail(self, file_, geometry_string, **options):
+        """
+        Returns thumbnail as an ImageFile instance for file with geometry and
+        options given. First it will try to get it from the key value store,
+        secondly it will create it.
+        """
+        logger.debug("Getting thumbnail for file [%s] at [%s]", file_, geometry_string)
+
+        return self.get_thumbnails(file_, [geometry_string], **options)[0]
+
+    def get_thumbnails(self, file_, geometry_strings, **options):
+        """
+        Returns a thumbnail for every geometry in ``geometry_strings``, in
+        order. They are looked up in the key value store at once and the
+        missing ones are created from a single decode of the source.
+        """
+        source, options, thumbnails = self._get_thumbnail_files(
+            file_, geometry_strings, options
+        )
+        if settings.THUMBNAIL_STATELESS:
+            results = self._get_stateless_thumbnails(
+                file_, source, geometry_strings, options, thumbnails
+            )
+        else:
+            results = self._get_cached_thumbnails(thumbnails)
+        if settings.THUMBNAIL_DEFERRED:
+            return self._defer_missing(source, geometry_strings, options, results)
+        return self._create_missing(
+            file_, source, geometry_strings, options, thumbnails, results
+        )
+
+    def prefetch_thumbnails(self, files, geometry_strings, **options):
+        """
+        Returns the thumbnails of every file of ``files`` at every geometry, a
+        list per file. They are looked up in the key value store in one round
+        trip and the missing ones are created concurrently in the pool
+        returned by ``get_async_executor``. Inside ``prefetching`` the
+        thumbnails are kept, and ``get_thumbnail`` returns them without a
+        lookup.
+        """
+        files = [file_ for file_ in files if file_]
+        lookups = [
+            self._get_thumbnail_files(file_, geometry_strings, dict(options))
+            for file_ in files
+        ]
+
+        if settings.THUMBNAIL_STATELESS:
+            results = [
+                self._get_stateless_thumbnails(
+                    file_, source, geometry_strings, file_options, thumbnails
+                )
+                for file_, (source, file_options, thumbnails) in zip(files, lookups)
+            ]
+        else:
+            cached = iter(
+                self._get_cached_thumbnails(
+                    [
+                        thumbnail
+                        for _, _, thumbnails in lookups
+                        for thumbnail in thumbnails
+                    ]
+                )
+            )
+            results = [
+                [next(cached) for _ in thumbnails] for _, _, thumbnails in lookups
+            ]
+
+        missing = [i for i, file_results in enumerate(results) if not all(file_results)]
+        if settings.THUMBNAIL_DEFERRED:
+            for i in missing:
+                source, file_options, _ = lookups[i]
+                self._defer_missing(source, geometry_strings, file_options, results[i])
+        elif missing:
+
+            def create_missing(i):
+                source, file_options, thumbnails = lookups[i]
+                return self._create_missing(
+                    files[i],
+                    source,
+                    geometry_strings,
+                    file_options,
+                    thumbnails,
+                    results[i],
+                )
+
+            for i, created in zip(
+                missing, get_async_executor().map(create_missing, missing)
+            ):
+                results[i] = created
+
+        prefetched = _prefetched.get()
+        if prefetched is not None:
+            for (_, _, thumbnails), file_results in zip(lookups, results):
+                for thumbnail, result in zip(thumbnails, file_results):
+                    prefetched[thumbnail.key] = result
+        return results
+
+    def get_thumbnails_bulk(self, files, geometry_string, **options):
+        """
+        Yields ``(file_, thumbnail)`` for every file of ``files`` in order,
+        ``None`` for falsy files, for batch jobs needing one geometry of many
+        sources. The files are taken ``THUMBNAIL_BULK_CHUNK_SIZE`` at a time:
+        their thumbnails are looked up in one round trip, the missing ones
+        are created in a pool of ``THUMBNAIL_BULK_WORKERS`` threads and stored
+        in the key value store together before the chunk is yielded.
+        """
+        with DatabaseThreadPoolExecutor(
+            max_workers=settings.THUMBNAIL_BULK_WORKERS,
+            thread_name_prefix="thumbnail-bulk",
+        ) as executor:
+            chunk = []
+            for file_ in files:
+                chunk.append(file_)
+                if len(chunk) == settings.THUMBNAIL_BULK_CHUNK_SIZE:
+                    yield from self._get_bulk_chunk(
+                        executor, chunk, geometry_string, options
+                    )
+                    chunk = []
+            if chunk:
+                yield from self._get_bulk_chunk(
+                    executor, chunk, geometry_string, options
+                )
+
+    def _get_bulk_chunk(self, executor, files, geometry_string, options):
+        present = [file_ for file_ in files if file_]
+        lookups = [
+            self._get_thumbnail_files(file_, [geometry_string], dict(options))
+            for file_ in present
+        ]
+        if settings.THUMBNAIL_STATELESS:
+            results = [
+                self._get_stateless_thumbnails(
+                    file_, source, [geometry_string], file_options, thumbnails
+                )[0]
+                for file_, (source, file_options, thumbnails) in zip(present, lookups)
+            ]
+        else:
+            results = self._get_cached_thumbnails(
+                [thumbnails[0] for _, _, thumbnails in lookups]
+            )
+
+        # the same source can be listed several times, it is created once
+        futures = {}
+        for file_, (source, file_options, (thumbnail,)), cached in zip(
+            present, lookups, results
+        ):
+            if not cached and thumbnail.key not in futures:
+                futures[thumbnail.key] = executor.submit(
+                    self._create_bulk_thumbnail,
+                    file_,
+                    source,
+                    geometry_string,
+                    file_options,
+                    thumbnail,
+                )
+
+        created = {}
+        for i, (file_, (source, _, (thumbnail,))) in enumerate(zip(present, lookups)):
+            if not results[i]:
+                # one failing file mustn't lose the thumbnails of the others
+                try:
+                    results[i], store = futures[thumbnail.key].result()
+                except Exception as e:
+                    logger.exception(e)
+                    results[i] = self._get_source_error_thumbnail(
+                        file_, geometry_string, thumbnail
+                    )
+                    store = False
+                if store:
+                    created[thumbnail.key] = (results[i], source)
+
+        if created:
+            with stage(self, "kvstore_set"):
+                if hasattr(default.kvstore, "set_many"):
+                    default.kvstore.set_many(*zip(*created.values()))
+                else:
+                    for thumbnail, source in created.values():
+                        default.kvstore.get_or_set(source)
+                        default.kvstore.set(thumbnail, source)
+
+        results = iter(results)
+        for file_ in files:
+            yield file_, next(results) if file_ else None
+
+    def _create_bulk_thumbnail(
+        self, file_, source, geometry_string, options, thumbnail
+    ):
+        """
+        Creates the thumbnail of a ``get_thumbnails_bulk`` chunk. Returns it
+        and whether it still has to be stored in the key value store, which is
+        done for the whole chunk at once.
+        """
+        if not generation_locks.acquire(thumbnail.key):
+            # created elsewhere, wait for it like get_thumbnail does
+            results = self._create_missing(
+                file_, source, [geometry_string], options, [thumbnail], [None]
+            )
+            return results[0], False
+
+        try:
+            if settings.THUMBNAIL_FORCE_OVERWRITE or not thumbnail.exists():
+                logger.debug(
+                    "Creating thumbnail file [%s] at [%s] with [%s]",
+                    thumbnail.name,
+                    geometry_string,
+                    options,
+                )
+                try:
+                    [(outputs,)] = self._render_source(
+                        source, [geometry_string], options
+                    )
+                except SourceImageError as e:
+                    logger.exception(e)
+                    return (
+                        self._get_source_error_thumbnail(
+                            file_, geometry_string, thumbnail
+                        ),
+                        False,
+                    )
+                self._write_thumbnails(thumbnail, outputs)
+        finally:
+            generation_locks.release(thumbnail.key)
+        return thumbnail, True
+
+    def create_thumbnails(self, file_, geometry_strings, **options):
+        """
+        Like ``get_thumbnails`` but always creates the missing thumbnails right
+        away, this is what the ``THUMBNAIL_DEFERRED`` queue runs.
+        """
+        source, options, thumbnails = self._get_thumbnail_files(
+            file_, geometry_strings, options
+        )
+        results = self._get_cached_thumbnails(thumbnails)
+        return self._create_missing(
+            file_, source, geometry_strings, options, thumbnails, results
+        )
+
+    def get_thumbnail_formats(self, file_, geometry_string, formats=None, **options):
+        """
+        Returns a thumbnail of ``file_`` at ``geometry_string`` in every format
+        of ``formats`` (``THUMBNAIL_PICTURE_FORMATS`` by default), in order.
+        They are created from a single decode and transform of the source,
+        only the encoding is repeated, and kept under one key value store
+        entry so getting them is a single lookup. Like ``get_thumbnails``,
+        formats another caller is creating are waited for and placeholders
+        are returned for the missing ones with ``THUMBNAIL_DEFERRED``.
+        """
+        formats = [
+            format_.upper() for format_ in formats or settings.THUMBNAIL_PICTURE_FORMATS
+        ]
+        unsupported = [format_ for format_ in formats if format_ not in EXTENSIONS]
+        if unsupported:
+            raise ValueError(
+                "Unsupported thumbnail formats %s in get_thumbnail_formats(), "
+                "expected some of %s" % (", ".join(unsupported), ", ".join(EXTENSIONS))
+            )
+
+        if file_:
+            source = ImageFile(file_)
+        else:
+            raise ValueError("falsey file_ argument in get_thumbnail_formats()")
+
+        format_options = [
+            self._get_options(source, dict(options, format=format_))
+            for format_ in formats
+        ]
+        thumbnails = [
+            ImageFile(
+                self._get_thumbnail_filename(source, geometry_string, options),
+                default.storage,
+            )
+            for options in format_options
+        ]
+
+        geometry_strings = [geometry_string] * len(formats)
+        if settings.THUMBNAIL_STATELESS:
+            # the formats only differ by their format, not by the size
+            results = self._get_stateless_thumbnails(
+                file_, source, geometry_strings, format_options[0], thumbnails
+            )
+            if all(results):
+                return results
+        else:
+            cached = default.kvstore._get(thumbnails[0].key, identity="formats")
+            if cached:
+                cached = [deserialize_image_file(value) for value in cached]
+                # the entry is shared by the calls whose first format is the
+                # same, it is only theirs when it lists the same thumbnails
+                if [image_file.name for image_file in cached] == [
+                    thumbnail.name for thumbnail in thumbnails
+                ]:
+                    return cached
+            # e.g. created one format at a time by the deferred queue
+            results = self._get_cached_thumbnails(thumbnails)
+
+        if settings.THUMBNAIL_DEFERRED and not all(results):
+            for i, result in enumerate(results):
+                if not result:
+                    (results[i],) = self._defer_missing(
+                        source, [geometry_string], format_options[i], [None]
+                    )
+            return results
+
+        results = self._create_missing(
+            file_,
+            source,
+            geometry_strings,
+            format_options[0],
+            thumbnails,
+            results,
+            formats,
+        )
+        # error thumbnails are dummies or have no size, they aren't kept
+        if not settings.THUMBNAIL_STATELESS and all(
+            result.size and not isinstance(result, DummyImageFile) for result in results
+        ):
+            default.kvstore._set(
+                thumbnails[0].key,
+                [result.serialize() for result in results],
+                identity="formats",
+            )
+        return results
+
+    async def aget_thumbnail(self, file_, geometry_string, **options):
+        """
+        Async version of ``get_thumbnail``.
+        """
+        logger.debug("Getting thumbnail for file [%s] at [%s]", file_, geometry_string)
+
+        return (await self.aget_thumbnails(file_, [geometry_string], **options))[0]
+
+    async def aget_thumbnails(self, file_, geometry_strings, **options):
+        """
+        Async version of ``get_thumbnails``. Cached thumbnails only cost a key
+        value store lookup, the missing ones are created in the thread pool
+        returned by ``get_async_executor`` so many calls can be gathered
+        without blocking the event loop or queueing on a single thread.
+        """
+        if settings.THUMBNAIL_CONTENT_KEYS:
+            get_thumbnail_files = sync_to_async(
+                self._get_thumbnail_files,
+                thread_sensitive=False,
+                executor=get_async_executor(),
+            )
+            source, options, thumbnails = await get_thumbnail_files(
+                file_, geometry_strings, options
+            )
+        else:
+            source, options, thumbnails = self._get_thumbnail_files(
+                file_, geometry_strings, options
+            )
+        if not settings.THUMBNAIL_STATELESS:
+            results = await self._aget_cached_thumbnails(thumbnails)
+        elif all(thumbnail.name in existing_thumbnails for thumbnail in thumbnails):
+            results = self._get_stateless_thumbnails(
+                file_, source, geometry_strings, options, thumbnails
+            )
+        else:
+            get_stateless_thumbnails = sync_to_async(
+                self._get_stateless_thumbnails,
+                thread_sensitive=False,
+                executor=get_async_executor(),
+            )
+            results = await get_stateless_thumbnails(
+                file_, source, geometry_strings, options, thumbnails
+            )
+        if all(results):
+            return results
+
+        if settings.THUMBNAIL_DEFERRED:
+            defer_missing = sync_to_async(
+                self._defer_missing,
+                thread_sensitive=False,
+                executor=get_async_executor(),
+            )
+            return await defer_missing(source, geometry_strings, options, results)
+
+        create_missing = sync_to_async(
+            self._create_missing,
+            thread_sensitive=False,
+            executor=get_async_executor(),
+        )
+        return await create_missing(
+            file_, source, geometry_strings, options, thumbnails, results
+        )
+
+    def _get_thumbnail_files(self, file_, geometry_strings, options):
+        """
+        Returns the source, the full options and a thumbnail ``ImageFile`` per
+        geometry, without any storage or key value store access unless
+        ``THUMBNAIL_CONTENT_KEYS`` needs the content key of the source.
+        """
+        if file_:
+            source = ImageFile(file_)
+        else:
+            raise ValueError("falsey file_ argument in get_thumbnail()")
+
+        options = self._get_options(source, options)
+
+        thumbnails = [
+            ImageFile(
+                self._get_thumbnail_filename(source, geometry_string, options),
+                default.storage,
+            )
+            for geometry_string in geometry_strings
+        ]
+        return source, options, thumbnails
+
+    def _defer_missing(self, source, geometry_strings, options, results):
+        """
+        Queues the creation of the thumbnails not found in the key value store
+        and returns placeholders for them.
+        """
+        missing = [i for i, cached in enumerate(results) if not cached]
+
+        if not missing:
+            return results
+
+        get_deferred_queue().enqueue(
+            source, [geometry_strings[i] for i in missing], options.copy()
+        )
+
+        cached_source = default.kvstore.get(source)
+        for i in missing:
+            results[i] = PlaceholderImageFile(
+                source,
+                self._get_placeholder_size(cached_source, geometry_strings[i], options),
+            )
+        return results
+
+    def _get_placeholder_size(self, cached_source, geometry_string, options):
+        """
+        Returns the size the thumbnail will have, it can only be worked out
+        when the source size is in the key value store. Otherwise the
+        geometry is resolved with ``THUMBNAIL_DUMMY_RATIO`` like dummy
+        thumbnails.
+        """
+        if cached_source is None:
+            return parse_geometry(geometry_string, settings.THUMBNAIL_DUMMY_RATIO)
+
+        x_image, y_image = cached_source.size
+        geometry = parse_geometry(geometry_string, cached_source.ratio)
+        if options.get("padding"):
+            return geometry
+
+        factor = default.engine._calculate_scaling_factor(
+            x_image, y_image, geometry, options
+        )
+        if factor < 1 or options["upscale"]:
+            x_image, y_image = toint(x_image * factor), toint(y_image * factor)
+        if options["crop"] and options["crop"] != "noop":
+            x_image, y_image = min(x_image, geometry[0]), min(y_image, geometry[1])
+        return x_image, y_image
+
+    def _create_missing(
+        self,
+        file_,
+        source,
+        geometry_strings,
+        options,
+        thumbnails,
+        results,
+        formats=None,
+    ):
+        """
+        Creates the thumbnails not found in the key value store, ``results``
+        holds the cached ones. Thumbnails another thread or process is
+        creating already are waited for and reused, see ``GenerationLocks``.
+        With ``formats`` the thumbnails are those of ``get_thumbnail_formats``,
+        one per format at the same geometry.
+        """
+        missing = [i for i, cached in enumerate(results) if not cached]
+
+        if not missing:
+            return results
+
+        # Create the thumbnails nobody else is creating first and only then
+        # wait for the others, so callers never wait on each other while
+        # holding a lock.
+        owned = []
+        try:
+            for i in missing:
+                if generation_locks.acquire(thumbnails[i].key):
+                    owned.append(i)
+            self._create_thumbnails(
+                file_,
+                source,
+                geometry_strings,
+                options,
+                thumbnails,
+                results,
+                owned,
+                formats,
+            )
+        finally:
+            for i in owned:
+                generation_locks.release(thumbnails[i].key)
+
+        waiting = [i for i in missing if i not in owned]
+        if waiting:
+            deadline = time.monotonic() + settings.THUMBNAIL_LOCK_TIMEOUT
+            for i in waiting:
+                generation_locks.wait(thumbnails[i].key, deadline - time.monotonic())
+
+            cached = self._get_cached_thumbnails([thumbnails[i] for i in waiting])
+            for i, thumbnail in zip(waiting, cached):
+                results[i] = thumbnail
+
+            # The other caller failed or is taking too long, so go ahead
+            self._create_thumbnails(
+                file_,
+                source,
+                geometry_strings,
+                options,
+                thumbnails,
+                results,
+                [i for i in waiting if not results[i]],
+                formats,
+            )
+
+        return results
+
+    def _create_thumbnails(
+        self,
+        file_,
+        source,
+        geometry_strings,
+        options,
+        thumbnails,
+        results,
+        indexes,
+        formats=None,
+    ):
+        """
+        Creates the thumbnails at ``indexes`` and stores them in ``results``.
+        With ``formats`` only the encoding differs between them.
+        """
+        if not indexes:
+            return
+
+        # We have to check exists() because the Storage backend does not
+        # overwrite in some implementations.
+        create = [
+            i
+            for i in indexes
+            if settings.THUMBNAIL_FORCE_OVERWRITE or not thumbnails[i].exists()
+        ]
+
+        if create:
+            for i in create:
+                logger.debug(
+                    "Creating thumbnail file [%s] at [%s] with [%s]",
+                    thumbnails[i].name,
+                    geometry_strings[i],
+                    options,
+                )
+
+            try:
+                if formats:
+                    (by_format,) = self._render_source(
+                        source,
+                        [geometry_strings[create[0]]],
+                        options,
+                        [formats[i] for i in create],
+                    )
+                    rendered = [(outputs,) for outputs in by_format]
+                else:
+                    rendered = self._render_source(
+                        source, [geometry_strings[i] for i in create], options
+                    )
+            except SourceImageError as e:
+                logger.exception(e)
+                for i in indexes:
+                    results[i] = self._get_source_error_thumbnail(
+                        file_, geometry_strings[i], thumbnails[i]
+                    )
+                return
+
+            for i, (outputs,) in zip(create, rendered):
+                self._write_thumbnails(thumbnails[i], outputs)
+
+        # If the thumbnail exists we don't create it, the other option is
+        # to delete and write but this could lead to race conditions so I
+        # will just leave that out for now.
+        with stage(self, "kvstore_set"):
+            default.kvstore.get_or_set(source)
+            for i in indexes:
+                default.kvstore.set(thumbnails[i], source)
+                results[i] = thumbnails[i]
+
+    def delete(self, file_, delete_file=True):
+        source = ImageFile(file_)
+        default.kvstore._delete(source.key, identity="invalid")
+        default.kvstore._delete(source.key, identity="content")
+        default.kvstore._delete(source.key, identity="quality")
+        names = []
+        for key in default.kvstore._get(source.key, identity="thumbnails") or []:
+            default.kvstore._delete(key, identity="formats")
+            thumbnail = default.kvstore._get(key)
+            if thumbnail:
+                names.append(thumbnail.name)
+        super().delete(file_, delete_file=delete_file)
+        existing_thumbnails.discard(*names)
+
+    def _get_stateless_thumbnails(
+        self, file_, source, geometry_strings, options, thumbnails
+    ):
+        """
+        Returns the thumbnails that exist without a key value store lookup,
+        ``None`` for the missing ones. The existence is checked once per
+        process, see ``existing_thumbnails``. The expected size is worked out
+        when the width and height fields of the source image field are set,
+        otherwise it is read from the thumbnail when first used.
+        """
+        source_size = self._get_source_size(file_)
+        if source_size:
+            source.set_size(source_size)
+
+        results = []
+        for geometry_string, thumbnail in zip(geometry_strings, thumbnails):
+            if thumbnail.name not in existing_thumbnails:
+                if not thumbnail.exists():
+                    results.append(None)
+                    continue
+                existing_thumbnails.add(thumbnail.name)
+
+            result = StatelessImageFile(thumbnail.name, thumbnail.storage)
+            if source_size:
+                result.set_size(
+                    self._get_placeholder_size(source, geometry_string, options)
+                )
+            results.append(result)
+        return results
+
+    def _get_source_size(self, file_):
+        """
+        Returns the source size stored on the model instance by the
+        ``width_field`` and ``height_field`` of its image field, if any.
+        """
+        field = getattr(file_, "field", None)
+        instance = getattr(file_, "instance", None)
+        width_field = getattr(field, "width_field", None)
+        height_field = getattr(field, "height_field", None)
+        if instance is None or not width_field or not height_field:
+            return None
+
+        width = getattr(instance, width_field, None)
+        height = getattr(instance, height_field, None)
+        if not width or not height:
+            return None
+        return width, height
+
+    def _get_cached_thumbnails(self, thumbnails):
+        """
+        Gets the thumbnails from the key value store in one round trip when it
+        supports ``get_many``.
+        """
+        prefetched = _prefetched.get()
+        if prefetched:
+            results = [prefetched.get(thumbnail.key) for thumbnail in thumbnails]
+            if all(results):
+                return results
+
+        with stage(self, "kvstore_get"):
+            if hasattr(default.kvstore, "get_many"):
+                return default.kvstore.get_many(thumbnails)
+            return [default.kvstore.get(thumbnail) for thumbnail in thumbnails]
+
+    async def _aget_cached_thumbnails(self, thumbnails):
+        if hasattr(default.kvstore, "aget_many"):
+            return await default.kvstore.aget_many(thumbnails)
+        get_cached_thumbnails = sync_to_async(
+            self._get_cached_thumbnails,
+            thread_sensitive=False,
+            executor=get_async_executor(),
+        )
+        return await get_cached_thumbnails(thumbnails)
+
+    def _get_source_error_thumbnail(self, file_, geometry_string, thumbnail):
+        if settings.THUMBNAIL_DUMMY:
+            return DummyImageFile(geometry_string)
+
+        # if storage backend says file doesn't exist remotely,
+        # don't try to create it and exit early.
+        # Will return working empty image type; 404'd image
+        logger.warning(
+            "Remote file [%s] at [%s] does not exist", file_, geometry_string
+        )
+        return thumbnail
+
+    def _render_source(self, source, geometry_strings, options, formats=None):
+        """
+        Renders the thumbnails for ``geometry_strings`` from ``source``, see
+        ``_render``, in the process pool when ``THUMBNAIL_PROCESS_POOL_WORKERS``
+        is set.
+        Sources that failed before are not opened again until
+        ``THUMBNAIL_INVALID_SOURCE_TIMEOUT`` has passed.
+        """
+        failed_at = default.kvstore._get(source.key, identity="invalid")
+        if (
+            failed_at
+            and time.time() - failed_at < settings.THUMBNAIL_INVALID_SOURCE_TIMEOUT
+        ):
+            raise SourceImageError("Source [%s] is not a valid image" % source.name)
+
+        if options.get("target_bytes") or options.get("target_ssim"):
+            # Start the search from the quality found for other sizes
+            options = dict(
+                options,
+                quality_hint=default.kvstore._get(source.key, identity="quality"),
+            )
+
+        try:
+            if settings.THUMBNAIL_PROCESS_POOL_WORKERS:
+                size, rendered, quality = render_in_process_pool(
+                    self._read_source(source), geometry_strings, options, formats
+                )
+            else:
+                source_image = self._get_source_image(source)
+                try:
+                    size, rendered, quality = self._render(
+                        source_image, geometry_strings, options, formats
+                    )
+                finally:
+                    default.engine.cleanup(source_image)
+        except SourceReadError:
+            raise
+        except SourceImageError:
+            self._set_invalid(source)
+            raise
+
+        # We might as well set the size since we have it
+        source.set_size(size)
+        if quality is not None:
+            default.kvstore._set(source.key, quality, identity="quality")
+        return rendered
+
+    def _read_source(self, source):
+        try:
+            with stage(self, "source") as source_stage:
+                raw_data = source.read()
+                source_stage.set(bytes=len(raw_data))
+            return raw_data
+        except OSError as e:
+            raise SourceReadError("Can't read source [%s]" % source.name) from e
+
+    def _get_source_image(self, source):
+        try:
+            with stage(self, "source"):
+                return default.engine.get_image(source)
+        except DECODE_ERRORS as e:
+            raise SourceImageError("Can't open source [%s]" % source.name) from e
+        except OSError as e:
+            raise SourceReadError("Can't read source [%s]" % source.name) from e
+
+    def _set_invalid(self, source):
+        default.kvstore._set(source.key, time.time(), identity="invalid")
+
+    def _render(self, source_image, geometry_strings, options, formats=None):
+        """
+        Decodes, transforms and encodes the opened source image for every
+        geometry, without any storage or key value store access so it can run
+        in a worker process. Every transformed image is encoded in each of
+        ``formats``, only ``options["format"]`` by default. Returns the source
+        size, for every geometry and format a list of
+        ``(resolution, raw_data, size)`` with the thumbnail itself first and
+        its alternative resolutions after it, and the AVIF quality searched
+        for the ``target_bytes`` or ``target_ssim`` option.
+        """
+        formats = formats or [options["format"]]
+
+        # The header check reuses the image opened to create the thumbnails
+        if not default.engine.is_valid_image(source_image):
+            raise SourceImageError("Source is not a valid image")
+
+        options["image_info"] = default.engine.get_image_info(source_image)
+        size = default.engine.get_image_size(source_image)
+
+        # Resolve the geometries against the full size source before the
+        # engine drafts it down, so the output size does not depend on the
+        # decoded resolution.
+        ratio = default.engine.get_image_ratio(source_image, options)
+        geometries = [
+            parse_geometry(geometry_string, ratio)
+            for geometry_string in geometry_strings
+        ]
+        # Drafting may decode already, so it is part of the stage
+        with stage(self, "decode") as decode_stage:
+            image = default.engine.draft(
+                source_image, self._get_draft_geometry(geometries), options
+            )
+            try:
+                default.engine.load(image)
+            except (OSError, *DECODE_ERRORS) as e:
+                default.engine.cleanup(image)
+                raise SourceImageError("Source can't be decoded") from e
+            x_image, y_image = default.engine.get_image_size(image)
+            decode_stage.set(pixels=x_image * y_image)
+
+        try:
+            image = default.engine.prepare(image, geometries[0], options)
+            rendered, qualities = zip(
+                *(
+                    self._render_resolutions(image, geometry, options, formats)
+                    for geometry in geometries
+                )
+            )
+        finally:
+            default.engine.cleanup(image)
+
+        quality = next((q for q in reversed(qualities) if q is not None), None)
+        return size, list(rendered), quality
+
+    def _render_resolutions(self, image, geometry, options, formats):
+        """
+        Renders the thumbnail and its alternative resolutions from the
+        prepared source image. The biggest resolution is resized from the
+        source and every smaller one from the one before it, then they are
+        encoded in every format in parallel. Returns the outputs per format and
+        the quality found for the ``target_bytes`` or ``target_ssim`` option.
+        """
+        variants = [(1, options)] + [
+            (resolution, self._get_resolution_options(options, resolution))
+            for resolution in settings.THUMBNAIL_ALTERNATIVE_RESOLUTIONS
+        ]
+
+        images = {}
+        for resolution, resolution_options in sorted(
+            variants, key=lambda variant: variant[0], reverse=True
+        ):
+            resolution_geometry = (
+                int(geometry[0] * resolution),
+                int(geometry[1] * resolution),
+            )
+            image = default.engine.resize(
+                image, resolution_geometry, resolution_options
+            )
+            images[resolution] = default.engine.finish(
+                image, resolution_geometry, resolution_options
+            )
+
+        encodes = [
+            (resolution, dict(variant_options, format=format_))
+            for format_ in formats
+            for resolution, variant_options in variants
+        ]
+        raw_data = [None] * len(encodes)
+
+        # The quality found for the thumbnail is used for its other AVIF
+        # resolutions as well.
+        quality = None
+        if "AVIF" in formats and (
+            options.get("target_bytes") or options.get("target_ssim")
+        ):
+            i = [encode_options["format"] for _, encode_options in encodes].index(
+                "AVIF"
+            )
+            quality, raw_data[i] = default.engine.encode_to_target(
+                images[1], encodes[i][1]
+            )
+            for _, encode_options in encodes:
+                if encode_options["format"] == "AVIF":
+                    encode_options["quality"] = quality
+
+        pending = [i for i, data in enumerate(raw_data) if data is None]
+        if len(pending) == 1:
+            resolution, encode_options = encodes[pending[0]]
+            raw_data[pending[0]] = default.engine.encode(
+                images[resolution], encode_options
+            )
+        elif pending:
+            executor = get_encode_executor()
+            futures = {
+                i: executor.submit(
+                    default.engine.encode, images[encodes[i][0]], encodes[i][1]
+                )
+                for i in pending
+            }
+            for i, future in futures.items():
+                raw_data[i] = future.result()
+
+        outputs = [
+            (resolution, data, default.engine.get_image_size(images[resolution]))
+            for (resolution, _), data in zip(encodes, raw_data)
+        ]
+        return [
+            outputs[i : i + len(variants)]
+            for i in range(0, len(outputs), len(variants))
+        ], quality
+
+    def _write_thumbnails(self, thumbnail, outputs):
+        """
+        Writes the outputs of ``_render_resolutions`` for ``thumbnail``.
+        Appends @<ratio>x to the file name of the alternative resolutions.
+        """
+        file_name, dot_file_ext = os.path.splitext(thumbnail.name)
+
+        # Written in order, some storages are not thread safe
+        for i, (resolution, raw_data, size) in enumerate(outputs):
+            if i == 0:
+                image_file = thumbnail
+            else:
+                thumbnail_name = "%(file_name)s%(suffix)s%(file_ext)s" % {
+                    "file_name": file_name,
+                    "suffix": "@%sx" % resolution,
+                    "file_ext": dot_file_ext,
+                }
+                image_file = ImageFile(thumbnail_name, default.storage)
+            # Storages read the encoded buffer in chunks, without a copy
+            with stage(self, "write", bytes=len(raw_data)):
+                image_file.write(File(raw_data))
+            raw_data.close()
+            # It's much cheaper to set the size here
+            image_file.set_size(size)
+
+    def _get_resolution_options(self, options, resolution):
+        resolution_options = options.copy()
+        if "crop" in options and isinstance(options["crop"], str):
+            crop = options["crop"].split(" ")
+            for i in range(len(crop)):
+                s = re.match(r"(\d+)px", crop[i])
+                if s:
+                    crop[i] = "%spx" % int(int(s.group(1)) * resolution)
+            resolution_options["crop"] = " ".join(crop)
+        return resolution_options
+
+    def _get_options(self, source, options):
+        # preserve image filetype
+        if settings.THUMBNAIL_PRESERVE_FORMAT:
+            options.setdefault("format", self._get_format(source))
+
+        # the format the client of the request accepts, see
+        # ``FormatNegotiationMiddleware``
+        if "format" not in options:
+            format_ = get_negotiated_format()
+            if format_:
+                options["format"] = format_
+
+        for key, value in self.default_options.items():
+            options.setdefault(key, value)
+
+        # For the future I think it is better to add options only if they
+        # differ from the default settings as below. This will ensure the same
+        # filenames being generated for new options at default.
+        for key, attr in self.extra_options:
+            value = getattr(settings, attr)
+            if value != getattr(default_settings, attr):
+                options.setdefault(key, value)
+
+        for key, attr in self.avif_options:
+            value = getattr(settings, attr)
+            if value != getattr(avif_default_settings, attr):
+                options.setdefault(key, value)
+
+        return options
+
+    def _get_draft_geometry(self, geometries):
+        """
+        A geometry covering all ``geometries`` generated from the source,
+        alternative resolutions included.
+        """
+        resolution = max([1, *settings.THUMBNAIL_ALTERNATIVE_RESOLUTIONS])
+        return (
+            int(max(geometry[0] for geometry in geometries) * resolution),
+            int(max(geometry[1] for geometry in geometries) * resolution),
+        )
+
     def _get_format(self, source):
         file_extension = self.file_extension(source)
 
@@ -34,7 +1054,82 @@ class AvifThumbnail(ThumbnailBackend):
                 settings, "THUMBNAIL_FORMAT", default_settings.THUMBNAIL_FORMAT
             )
 
+    def get_content_key(self, file_):
+        """
+        Returns the sha256 of the content of ``file_``, hashed in chunks the
+        first time and kept in the key value store afterwards. With
+        ``THUMBNAIL_CONTENT_KEYS`` it replaces the path based source key in
+        the thumbnail names, so copies of a file share their thumbnails. Call
+        it after an upload is saved to hash it while it is at hand.
+        """
+        source = file_ if isinstance(file_, ImageFile) else ImageFile(file_)
+        content_key = default.kvstore._get(source.key, identity="content")
+        if content_key:
+            return content_key
+
+        content_hash, size = hashlib.sha256(), 0
+        with stage(self, "source") as source_stage:
+            f = source.storage.open(source.name)
+            try:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    content_hash.update(chunk)
+                    size += len(chunk)
+            finally:
+                f.close()
+            source_stage.set(bytes=size)
+        content_key = content_hash.hexdigest()
+        default.kvstore._set(source.key, content_key, identity="content")
+        return content_key
+
+    def _get_source_key(self, source):
+        """
+        Returns the key of the source used in the thumbnail names, see
+        ``get_content_key``. Sources that can't be read keep their path
+        based key, creating their thumbnails reports the error.
+        """
+        if not settings.THUMBNAIL_CONTENT_KEYS:
+            return source.key
+        if not hasattr(source, "content_key"):
+            try:
+                source.content_key = self.get_content_key(source)
+            except Exception:
+                logger.warning("Can't hash source [%s]", source.name, exc_info=True)
+                return source.key
+        return source.content_key
+
     def _get_thumbnail_filename(self, source, geometry_string, options):
-        key = tokey(source.key, geometry_string, serialize(options))
-        path = f"{key[:2]}{key[2:4]}{key}"
+        key = tokey(self._get_source_key(source), geometry_string, serialize(options))
+        path = self._get_thumbnail_path(key)
         return f"{settings.THUMBNAIL_PREFIX}{path}.{EXTENSIONS[options['format']]}"
+
+    def _get_thumbnail_path(self, key):
+        """
+        Returns the path of the thumbnail file with ``key`` under
+        ``THUMBNAIL_PREFIX``, without extension. With
+        ``THUMBNAIL_DIRECTORY_SHARDS`` the leading characters of the key make
+        nested directories, ``(2, 2)`` gives ``ab/cd/abcd...``, otherwise all
+        files share one directory.
+        """
+        shards = settings.THUMBNAIL_DIRECTORY_SHARDS
+        if not shards:
+            return f"{key[:2]}{key[2:4]}{key}"
+
+        directories, start = [], 0
+        for width in shards:
+            directories.append(key[start : start + width])
+            start += width
+        return "/".join(directories + [key])
+
+
+@contextmanager
+def prefetching():
+    """
+    Keeps the thumbnails ``prefetch_thumbnails`` returns within the block, so
+    ``get_thumbnail`` calls for them, like the ``thumbnail`` tags of a
+    ``thumbnail_prefetch`` block, don't look them up again.
+    """
+    token = _prefetched.set(dict(_prefetched.get() or {}))
+    try:
+        yield
+    finally:
+        _prefetched.reset(token)
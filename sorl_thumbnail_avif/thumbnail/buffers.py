@@ -0,0 +1,180 @@
+import io
+import os
+import tempfile
+import threading
+
+from sorl_thumbnail_avif.thumbnail.conf import settings
+
+
+class OutputBuffer(io.RawIOBase):
+    """
+    A file the engine encodes into, backed by a ``bytearray`` that goes back
+    to the pool when the buffer is closed. Once it grows beyond
+    ``THUMBNAIL_BUFFER_POOL_MAX_BYTES`` it rolls over to a temporary file, so
+    big outputs don't stay in memory until they are written. Storages read it
+    in chunks like any other file.
+    """
+
+    def __init__(self, data=None, pool=None):
+        super().__init__()
+        self._data = data if data is not None else bytearray()
+        self._pool = pool
+        self._file = None
+        self._size = 0
+        self._position = 0
+
+    def __len__(self):
+        return self._size
+
+    def __reduce__(self):
+        # Outputs of the process pool travel as plain bytes
+        return _from_bytes, (self.getvalue(),)
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def rolled_over(self):
+        return self._file is not None
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        self._checkClosed()
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._checkClosed()
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+        self._position = offset
+        return offset
+
+    def readinto(self, b):
+        self._checkClosed()
+        end = min(self._position + len(b), self._size)
+        count = max(end - self._position, 0)
+        if self._file is not None:
+            self._file.seek(self._position)
+            with memoryview(b) as view:
+                count = self._file.readinto(view[:count])
+        else:
+            with memoryview(self._data) as view:
+                b[:count] = view[self._position : end]
+        self._position += count
+        return count
+
+    def write(self, b):
+        self._checkClosed()
+        with memoryview(b) as view:
+            count = view.nbytes
+            end = self._position + count
+            if self._file is None and end > settings.THUMBNAIL_BUFFER_POOL_MAX_BYTES:
+                self._rollover()
+
+            if self._file is not None:
+                self._file.seek(self._position)
+                self._file.write(view)
+            else:
+                if self._position > len(self._data):
+                    self._data.extend(bytes(self._position - len(self._data)))
+                self._data[self._position : end] = view.cast("B")
+        self._position = end
+        self._size = max(self._size, end)
+        return count
+
+    def truncate(self, size=None):
+        self._checkClosed()
+        size = self._position if size is None else size
+        self._size = min(self._size, size)
+        if self._file is not None:
+            self._file.truncate(self._size)
+        return size
+
+    def getbuffer(self):
+        """
+        Returns a read only view of the written bytes, valid until the buffer
+        is closed. Only rolled over buffers are copied.
+        """
+        self._checkClosed()
+        if self._file is not None:
+            return memoryview(self.getvalue())
+        return memoryview(self._data).toreadonly()[: self._size]
+
+    def getvalue(self):
+        if self._file is not None:
+            self._checkClosed()
+            self._file.seek(0)
+            return self._file.read(self._size)
+        return bytes(self.getbuffer())
+
+    def close(self):
+        if not self.closed:
+            if self._file is not None:
+                self._file.close()
+            elif self._pool is not None:
+                self._pool.release(self._data)
+        self._data = None
+        self._file = None
+        super().close()
+
+    def _rollover(self):
+        self._file = tempfile.TemporaryFile()
+        with memoryview(self._data) as view:
+            self._file.write(view[: self._size])
+        if self._pool is not None:
+            self._pool.release(self._data)
+        self._data = None
+
+
+class BufferPool:
+    """
+    Keeps up to ``THUMBNAIL_BUFFER_POOL_SIZE`` idle output buffers so encodes
+    reuse memory that was already allocated. Buffers bigger than
+    ``THUMBNAIL_BUFFER_POOL_MAX_BYTES`` are dropped, so changing the setting
+    frees them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buffers = []
+
+    def acquire(self):
+        with self._lock:
+            data = self._buffers.pop() if self._buffers else None
+        return OutputBuffer(data, pool=self)
+
+    def release(self, data):
+        if len(data) > settings.THUMBNAIL_BUFFER_POOL_MAX_BYTES:
+            return
+        with self._lock:
+            if len(self._buffers) < settings.THUMBNAIL_BUFFER_POOL_SIZE:
+                self._buffers.append(data)
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._buffers = []
+
+
+def _from_bytes(data):
+    buffer = buffer_pool.acquire()
+    buffer.write(data)
+    return buffer
+
+
+buffer_pool = BufferPool()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=buffer_pool.reset)
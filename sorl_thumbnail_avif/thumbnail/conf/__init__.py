@@ -0,0 +1,21 @@
+from sorl.thumbnail.conf import settings as sorl_settings
+
+from sorl_thumbnail_avif.thumbnail.conf import defaults
+
+
+class Settings:
+    """
+    Settings proxy that will lookup first in the sorl-thumbnail settings (and
+    so in the django settings), and then in the avif defaults.
+    """
+
+    def __getattr__(self, name):
+        if name != name.upper():
+            raise AttributeError(name)
+        try:
+            return getattr(sorl_settings, name)
+        except AttributeError:
+            return getattr(defaults, name)
+
+
+settings = Settings()
@@ -0,0 +1,153 @@
+# AVIF encoder speed, 0 (slowest, smallest files) to 10 (fastest).
+# ``None`` picks the speed from ``THUMBNAIL_AVIF_SIZE_CLASSES``.
+THUMBNAIL_AVIF_SPEED = None
+
+# Number of AVIF encoder threads. ``None`` picks the thread count from
+# ``THUMBNAIL_AVIF_SIZE_CLASSES``.
+THUMBNAIL_AVIF_THREADS = None
+
+# AV1 codec used for encoding: auto, aom, rav1e or svt
+THUMBNAIL_AVIF_CODEC = "auto"
+
+# Encoder tiling, either "auto" or "<columns>x<rows>" with power of two tile
+# counts, e.g. "2x2".
+THUMBNAIL_AVIF_TILING = "auto"
+
+# Encoder defaults per output size: (max pixels, speed, threads). The first
+# class the thumbnail fits in is used, ``None`` matches any size and a thread
+# count of ``None`` means all cpus.
+THUMBNAIL_AVIF_SIZE_CLASSES = (
+    (320 * 320, 6, 1),
+    (1280 * 1280, 7, 2),
+    (None, 8, None),
+)
+
+# Large downscales decode the source at a reduced resolution (JPEG draft mode,
+# ``Image.reduce`` for the other formats) that stays at least this many times
+# bigger than the thumbnail. ``None`` always decodes at full resolution.
+THUMBNAIL_REDUCING_GAP = 2.0
+
+# Sources that can't be read in place (e.g. remote urls) are streamed to a
+# temporary file, keeping at most this many bytes in memory.
+THUMBNAIL_SPOOL_MAX_SIZE = 10 * 1024 * 1024
+
+# How ``is_valid_image`` checks raw data: "verify" checks the whole file,
+# "header" only the magic bytes and dimensions, which is enough for uploads
+# from trusted sources.
+THUMBNAIL_VALIDATION = "verify"
+
+# Seconds a source that failed to open or decode is remembered as invalid in
+# the key value store. Thumbnails for it fail fast meanwhile.
+THUMBNAIL_INVALID_SOURCE_TIMEOUT = 3600
+
+# Threads encoding the resolutions of a thumbnail in parallel, shared by the
+# whole process. ``None`` means one per cpu.
+THUMBNAIL_ENCODE_WORKERS = None
+
+# Characters of the thumbnail key used for each level of directories under
+# THUMBNAIL_PREFIX, e.g. (2, 2) for ab/cd/<key>. ``None`` keeps every file in
+# one directory, ``manage.py thumbnail_shard`` moves existing files.
+THUMBNAIL_DIRECTORY_SHARDS = None
+
+# Return thumbnails without a key value store lookup, their names only depend
+# on the source, geometry and options. Missing thumbnails are found with a
+# storage existence check, done once per process for up to
+# THUMBNAIL_STATELESS_CACHE_SIZE thumbnails and checked again after
+# THUMBNAIL_STATELESS_CACHE_TIMEOUT seconds. Thumbnails deleted by another
+# process are returned until then.
+THUMBNAIL_STATELESS = False
+THUMBNAIL_STATELESS_CACHE_SIZE = 100000
+THUMBNAIL_STATELESS_CACHE_TIMEOUT = 300
+
+# Name thumbnails after the sha256 of the source content instead of its path,
+# so identical files share their thumbnails. The hash is kept in the key value
+# store, see ``AvifThumbnail.get_content_key``.
+THUMBNAIL_CONTENT_KEYS = False
+
+# Formats ``FormatNegotiationMiddleware`` picks from, in order of preference,
+# when the ``Accept`` header of the request lists them, and the format used
+# when it lists none of them.
+THUMBNAIL_NEGOTIATED_FORMATS = ("AVIF", "WEBP")
+THUMBNAIL_NEGOTIATION_FALLBACK = "JPEG"
+
+# Idle output buffers kept for reuse by the encodes, and the size in bytes above
+# which an encoded thumbnail rolls over to a temporary file instead.
+THUMBNAIL_BUFFER_POOL_SIZE = 8
+THUMBNAIL_BUFFER_POOL_MAX_BYTES = 4 * 1024 * 1024
+
+# Values of the key value store kept in each process, so rendering thumbnails
+# found before needs no round trip, and the seconds they are kept for. Deletes
+# in other processes only show when they expire, so it is off (``0``) unless
+# set, e.g. to 10000.
+THUMBNAIL_LOCAL_CACHE_SIZE = 0
+THUMBNAIL_LOCAL_CACHE_TIMEOUT = 300
+
+# Sources ``get_thumbnails_bulk`` looks up and stores at once, and the threads
+# creating their missing thumbnails, ``None`` uses the ``ThreadPoolExecutor``
+# default.
+THUMBNAIL_BULK_CHUNK_SIZE = 500
+THUMBNAIL_BULK_WORKERS = None
+
+# Threads the async API (``aget_thumbnail``) runs key value store, storage and
+# engine work in. ``None`` uses the ``ThreadPoolExecutor`` default.
+THUMBNAIL_ASYNC_WORKERS = None
+
+# Worker processes rendering thumbnails, so decoding and encoding run outside
+# of the request process and its GIL. ``0`` renders in process.
+THUMBNAIL_PROCESS_POOL_WORKERS = 0
+
+# Renders waiting for or running in the process pool, ``None`` means twice the
+# workers. Further requests wait for a slot.
+THUMBNAIL_PROCESS_POOL_QUEUE_SIZE = None
+
+# Seconds to wait for a slot in the queue and again for the render to finish
+# before giving up with ``ThumbnailError``.
+THUMBNAIL_PROCESS_POOL_TIMEOUT = 30
+
+# Multiprocessing start method of the process pool ("fork", "spawn",
+# "forkserver"), ``None`` uses the platform default.
+THUMBNAIL_PROCESS_POOL_CONTEXT = None
+
+# Directory of the lock files making sure a thumbnail is created by one process
+# of the host at a time. ``None`` uses a directory in the temp directory.
+THUMBNAIL_LOCK_DIR = None
+
+# Seconds to wait for a thumbnail another caller is creating before creating it
+# too, lock files older than this are considered abandoned.
+THUMBNAIL_LOCK_TIMEOUT = 30
+
+# Return a placeholder on a cache miss, the source url with the size of the
+# thumbnail, and create the thumbnail in ``THUMBNAIL_DEFERRED_QUEUE``.
+THUMBNAIL_DEFERRED = False
+
+# Queue creating the deferred thumbnails, a subclass of
+# ``sorl_thumbnail_avif.thumbnail.queues.QueueBase``.
+THUMBNAIL_DEFERRED_QUEUE = "sorl_thumbnail_avif.thumbnail.queues.ThreadQueue"
+
+# Jobs waiting in the ``ThreadQueue``, further ones are dropped.
+THUMBNAIL_DEFERRED_QUEUE_SIZE = 1000
+
+# Formats of ``get_thumbnail_formats`` and the ``thumbnail_picture`` tag, most
+# preferred first. The last one is the ``<img>`` fallback.
+THUMBNAIL_PICTURE_FORMATS = ("AVIF", "WEBP", "JPEG")
+
+# Qualities the ``target_bytes`` and ``target_ssim`` options search.
+THUMBNAIL_QUALITY_RANGE = (20, 90)
+
+# Encodes of each search, the trial and then the thumbnail.
+THUMBNAIL_QUALITY_SEARCH_STEPS = 5
+
+# Thumbnails more than twice this size are first searched downscaled to it.
+# ``None`` searches the thumbnail only.
+THUMBNAIL_QUALITY_TRIAL_SIZE = 128
+
+# Receivers of the ``thumbnail_stage`` signal connected at startup, e.g.
+# "sorl_thumbnail_avif.thumbnail.metrics.StatsdCollector" or
+# "sorl_thumbnail_avif.thumbnail.metrics.PrometheusCollector".
+THUMBNAIL_METRICS_COLLECTORS = ()
+
+# Prefix of the metric names of the collectors.
+THUMBNAIL_METRICS_PREFIX = "thumbnail"
+
+# (host, port) the ``StatsdCollector`` sends to.
+THUMBNAIL_STATSD_ADDRESS = ("localhost", 8125)
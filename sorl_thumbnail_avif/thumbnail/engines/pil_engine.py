@@ -1,25 +1,262 @@
+import math
+import os
+import re
+import shutil
+import weakref
 from io import BytesIO
-from sorl.thumbnail.engines.pil_engine import Engine
+from tempfile import SpooledTemporaryFile
+from sorl.thumbnail.engines.pil_engine import EXIF_ORIENTATION, Engine
+from sorl.thumbnail.parsers import ThumbnailParseError
 
-from PIL import Image, ImageFile
+from PIL import Image, ImageOps
 from PIL.ImageFilter import GaussianBlur
 import pillow_avif  # noqa: F401
 
+from sorl_thumbnail_avif.thumbnail.buffers import buffer_pool
+from sorl_thumbnail_avif.thumbnail.conf import settings
+from sorl_thumbnail_avif.thumbnail.metrics import stage
+
+
+# Chunk size used to stream non seekable sources
+CHUNK_SIZE = 64 * 1024
+
+# Modes ``Image.reduce`` can handle
+REDUCIBLE_MODES = ("L", "LA", "RGB", "RGBA")
+JPEG_MODES = ("1", "L", "RGB", "CMYK")
+
+# Side of the grayscale images and of the blocks ``ssim`` compares
+SSIM_SIZE = 256
+SSIM_BLOCK = 8
+
+tiling_pat = re.compile(r"^(?P<columns>\d+)x(?P<rows>\d+)$")
+
+
+def ssim(image1, image2):
+    """
+    Returns the structural similarity of two images of the same size, the mean
+    SSIM of the 8x8 blocks of their luma downscaled to at most 256 pixels.
+    """
+    size = image1.size
+    if max(size) > SSIM_SIZE:
+        factor = SSIM_SIZE / max(size)
+        size = (max(int(size[0] * factor), 1), max(int(size[1] * factor), 1))
+    width, height = size
+    data1 = image1.convert("L").resize(size, Image.BOX).tobytes()
+    data2 = image2.convert("L").resize(size, Image.BOX).tobytes()
+
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    block = min(SSIM_BLOCK, width, height)
+    total, blocks = 0.0, 0
+    for y in range(0, height - block + 1, block):
+        for x in range(0, width - block + 1, block):
+            rows = [
+                slice(i * width + x, i * width + x + block) for i in range(y, y + block)
+            ]
+            a = [p for row in rows for p in data1[row]]
+            b = [p for row in rows for p in data2[row]]
+            n = len(a)
+            mean_a, mean_b = sum(a) / n, sum(b) / n
+            var_a = sum((p - mean_a) ** 2 for p in a) / n
+            var_b = sum((p - mean_b) ** 2 for p in b) / n
+            cov = sum((p - mean_a) * (q - mean_b) for p, q in zip(a, b)) / n
+            total += ((2 * mean_a * mean_b + c1) * (2 * cov + c2)) / (
+                (mean_a**2 + mean_b**2 + c1) * (var_a + var_b + c2)
+            )
+            blocks += 1
+    return total / blocks
+
+
+def parse_tiling(tiling):
+    """
+    Parses a ``<columns>x<rows>`` tiling string and returns the log2 of the
+    (columns, rows) tile counts as libavif expects them.
+    """
+    m = tiling_pat.match(str(tiling))
+
+    if m:
+        columns, rows = int(m.group("columns")), int(m.group("rows"))
+        # tile counts must be powers of two
+        if columns and rows and not columns & (columns - 1) and not rows & (rows - 1):
+            return columns.bit_length() - 1, rows.bit_length() - 1
+
+    raise ThumbnailParseError(f"Tiling does not have the correct syntax: {tiling}")
+
 
 class AvifEngine(Engine):
     def get_image(self, source):
-        buffer = BytesIO(source.read())
-        return Image.open(buffer)
+        fp = self._open_source(source)
+        try:
+            image = Image.open(fp)
+        except Exception:
+            fp.close()
+            raise
+        # The file is ours to close, in cleanup() or when an image that is
+        # never cleaned up (e.g. only its size was needed) goes.
+        image.close_source = weakref.finalize(image, fp.close)
+        return image
+
+    def _open_source(self, source):
+        """
+        Returns a seekable file object for ``source``. Seekable storage files
+        (local files, already downloaded remote files) are used as they are,
+        streams are copied in chunks to a spooled temporary file that only
+        keeps ``THUMBNAIL_SPOOL_MAX_SIZE`` bytes in memory. Raw bytes, as a
+        process pool worker gets them, are wrapped as they are.
+        """
+        if isinstance(source, bytes):
+            return BytesIO(source)
+        if not hasattr(source, "storage"):
+            return BytesIO(source.read())
+
+        f = source.storage.open(source.name)
+        fp = getattr(f, "file", f)
+        if getattr(fp, "seekable", None) and fp.seekable():
+            return fp
+
+        spool = SpooledTemporaryFile(max_size=settings.THUMBNAIL_SPOOL_MAX_SIZE)
+        try:
+            shutil.copyfileobj(f, spool, CHUNK_SIZE)
+        except Exception:
+            spool.close()
+            raise
+        finally:
+            f.close()
+        spool.seek(0)
+        return spool
+
+    def cleanup(self, image):
+        # multi frame images keep their file open after loading
+        image.close()
+        close_source = getattr(image, "close_source", None)
+        if close_source is not None:
+            close_source()
+
+    def draft(self, image, geometry, options):
+        """
+        Decodes ``image`` at a reduced resolution when the thumbnail is a
+        large downscale. The reduced image stays at least
+        ``THUMBNAIL_REDUCING_GAP`` times bigger than ``geometry`` so the final
+        resize keeps its quality.
+        """
+        reducing_gap = settings.THUMBNAIL_REDUCING_GAP
+
+        # cropbox coordinates are relative to the full size source
+        if not reducing_gap or options.get("cropbox"):
+            return image
+
+        x_image, y_image = map(float, self.get_image_size(image))
+        if self.flip_dimensions(image):
+            x_image, y_image = y_image, x_image
+        factor = self._calculate_scaling_factor(x_image, y_image, geometry, options)
+
+        if not factor:
+            return image
+
+        reduce = int(1 / (factor * reducing_gap))
+        if reduce < 2:
+            return image
+
+        # JPEG can decode at 1/2, 1/4 or 1/8 scale (draft returns None for
+        # formats that can't), the others are box reduced after decoding.
+        size = tuple(math.ceil(n / reduce) for n in self.get_image_size(image))
+        if image.draft(image.mode, size) is None and image.mode in REDUCIBLE_MODES:
+            image = image.reduce(reduce)
+
+        return image
+
+    def load(self, image):
+        """
+        Decodes the image data, raises for broken or truncated images.
+        """
+        image.load()
+        return image
 
     def is_valid_image(self, raw_data):
-        buffer = BytesIO(raw_data)
+        """
+        Checks raw data, a path or a file object (so uploads saved to a
+        temporary file don't have to be read into memory) for valid image
+        data. With ``THUMBNAIL_VALIDATION = "header"`` only the magic bytes and
+        the dimensions in the header are checked, without decoding.
+
+        An already opened image gets the header check only, it stays usable to
+        create thumbnails.
+        """
+        if isinstance(raw_data, Image.Image):
+            return self._is_valid_header(raw_data)
+
+        if isinstance(raw_data, bytes):
+            raw_data = BytesIO(raw_data)
         try:
-            trial_image = Image.open(buffer)
-            trial_image.verify()
+            with Image.open(raw_data) as trial_image:
+                if settings.THUMBNAIL_VALIDATION == "header":
+                    return self._is_valid_header(trial_image)
+                trial_image.verify()
         except Exception:
             return False
         return True
 
+    def _is_valid_header(self, image):
+        # Image.open already matched the magic bytes to a format
+        x_image, y_image = self.get_image_size(image)
+        return x_image > 0 and y_image > 0
+
+    def create(self, image, geometry, options):
+        image = self.prepare(image, geometry, options)
+        image = self.resize(image, geometry, options)
+        return self.finish(image, geometry, options)
+
+    def prepare(self, image, geometry, options):
+        """
+        The size independent steps of ``create``, done once per source.
+        """
+        image = self.cropbox(image, geometry, options)
+        with stage(self, "orientation"):
+            image = self.orientation(image, geometry, options)
+        image = self.colorspace(image, geometry, options)
+        image = self.remove_border(image, options)
+        return image
+
+    def resize(self, image, geometry, options):
+        """
+        Scales and crops a prepared image to ``geometry``. A smaller geometry
+        can be resized from the result again.
+        """
+        with stage(self, "scale") as scale_stage:
+            image = self.scale(image, geometry, options)
+            scale_stage.set(pixels=image.size[0] * image.size[1])
+        with stage(self, "crop"):
+            image = self.crop(image, geometry, options)
+        return image
+
+    def finish(self, image, geometry, options):
+        """
+        The steps of ``create`` that depend on the final size, the resized
+        image is not modified.
+        """
+        with stage(self, "finish"):
+            image = self.rounded(image, geometry, options)
+            image = self.blur(image, geometry, options)
+            image = self.padding(image, geometry, options)
+        return image
+
+    def _get_exif_orientation(self, image):
+        # ``getexif`` only parses the header data kept in ``image.info``, so
+        # it works before decoding and for every format, reduced images too.
+        try:
+            return image.getexif().get(EXIF_ORIENTATION)
+        except Exception:
+            return None
+
+    def _orientation(self, image):
+        if self._get_exif_orientation(image) in (None, 1):
+            return image
+        # also drops the orientation tag, so later steps don't flip again
+        return ImageOps.exif_transpose(image)
+
+    def _rounded(self, image, r):
+        # putalpha works in place, keep the resized image for smaller sizes
+        return super()._rounded(image.copy(), r)
+
     def _padding(self, image, geometry, options):
         x_image, y_image = self.get_image_size(image)
         left = int((geometry[0] - x_image) / 2)
@@ -29,13 +266,200 @@ class AvifEngine(Engine):
         im.paste(image, (left, top))
         return im
 
+    def write(self, image, options, thumbnail):
+        thumbnail.write(self.encode(image, options))
+
+    def encode(self, image, options):
+        """
+        Returns the encoded image in a buffer of the pool, see ``_encode``.
+        Safe to call from other threads.
+        """
+        # The same image can be encoded in several formats, JPEG fallbacks of
+        # transparent thumbnails lose the alpha channel.
+        if options["format"] == "JPEG" and image.mode not in JPEG_MODES:
+            image = image.convert("RGB")
+
+        with stage(
+            self, "encode", pixels=image.size[0] * image.size[1]
+        ) as encode_stage:
+            raw_data = self._encode(
+                image,
+                options["format"],
+                options["quality"],
+                image_info=options.get("image_info", {}),
+                progressive=options.get("progressive", settings.THUMBNAIL_PROGRESSIVE),
+                options=options,
+            )
+            encode_stage.set(bytes=len(raw_data), format=options["format"])
+        return raw_data
+
+    def encode_to_target(self, image, options):
+        """
+        Searches the AVIF quality meeting ``options["target_bytes"]``, the
+        highest quality that fits, or ``options["target_ssim"]``, the lowest
+        quality at least that similar to ``image``, within
+        ``THUMBNAIL_QUALITY_RANGE``. Returns the quality and the encoded data.
+
+        The search starts from ``options["quality_hint"]``, the quality found
+        for the source before, refined on the image downscaled to
+        ``THUMBNAIL_QUALITY_TRIAL_SIZE``, so the full size image is only
+        encoded a few times.
+        """
+        low, high = settings.THUMBNAIL_QUALITY_RANGE
+        quality = options.get("quality_hint")
+
+        trial = self._get_trial_image(image)
+        if trial is not image:
+            scale = trial.size[0] * trial.size[1] / (image.size[0] * image.size[1])
+            quality, trial_data = self._search_quality(
+                trial, options, low, high, quality, scale
+            )
+            if options.get("target_bytes"):
+                # The size doesn't follow the pixel count closely, so compare
+                # with the full size at that quality and search the trial
+                # again with the actual ratio.
+                raw_data = self.encode(image, dict(options, quality=quality))
+                scale = len(trial_data) / len(raw_data)
+                raw_data.close()
+                trial_data.close()
+                quality, trial_data = self._search_quality(
+                    trial, options, low, high, quality, scale
+                )
+            trial_data.close()
+
+        return self._search_quality(image, options, low, high, quality)
+
+    def _search_quality(self, image, options, low, high, start=None, scale=1):
+        """
+        Searches the qualities from ``low`` to ``high`` in at most
+        ``THUMBNAIL_QUALITY_SEARCH_STEPS`` encodes. From ``start`` it moves in
+        growing steps until the target is crossed, then bisects. For
+        downscaled trials ``target_bytes`` is scaled by ``scale``.
+        """
+        target_bytes = options.get("target_bytes")
+        target_ssim = options.get("target_ssim")
+
+        def meets(raw_data):
+            if target_bytes:
+                return len(raw_data) <= target_bytes * scale
+            try:
+                with Image.open(raw_data) as encoded:
+                    return ssim(image, encoded) >= target_ssim
+            finally:
+                raw_data.seek(0)
+
+        # Sizes shrink as the quality drops, similarity grows as it rises, so
+        # meeting a byte target means trying higher and a ssim one lower.
+        higher = bool(target_bytes)
+        best = None
+        quality = start if start is not None and low <= start <= high else None
+        direction, step = None, 4
+        for _ in range(settings.THUMBNAIL_QUALITY_SEARCH_STEPS):
+            if low > high:
+                break
+            if quality is None:
+                quality = (low + high) // 2
+
+            raw_data = self.encode(image, dict(options, quality=quality))
+            met = meets(raw_data)
+            if met:
+                if best is not None:
+                    best[1].close()
+                best = quality, raw_data
+            else:
+                raw_data.close()
+            if met == higher:
+                low, move = quality + 1, 1
+            else:
+                high, move = quality - 1, -1
+
+            if direction in (None, move) and start is not None:
+                quality += move * step
+                step *= 2
+                if not low <= quality <= high:
+                    quality = None
+            else:
+                # The target was crossed, bisect what is left
+                start, quality = None, None
+            direction = move
+
+        if best is None:
+            # Nothing met the target, get as close as the range allows
+            quality = settings.THUMBNAIL_QUALITY_RANGE[0 if higher else 1]
+            best = quality, self.encode(image, dict(options, quality=quality))
+        return best
+
+    def _get_trial_image(self, image):
+        size = settings.THUMBNAIL_QUALITY_TRIAL_SIZE
+        if not size or max(image.size) <= size * 2:
+            return image
+        factor = size / max(image.size)
+        return image.resize(
+            (max(int(image.size[0] * factor), 1), max(int(image.size[1] * factor), 1)),
+            Image.BICUBIC,
+        )
+
+    def _get_avif_size_class(self, image):
+        pixels = image.size[0] * image.size[1]
+        for max_pixels, speed, threads in settings.THUMBNAIL_AVIF_SIZE_CLASSES:
+            if max_pixels is None or pixels <= max_pixels:
+                return speed, threads
+        return None, None
+
+    def _get_avif_params(self, image, options):
+        speed = options.get("avif_speed", settings.THUMBNAIL_AVIF_SPEED)
+        threads = options.get("avif_threads", settings.THUMBNAIL_AVIF_THREADS)
+        class_speed, class_threads = self._get_avif_size_class(image)
+
+        params = {
+            "codec": options.get("avif_codec", settings.THUMBNAIL_AVIF_CODEC),
+            "max_threads": int(threads or class_threads or os.cpu_count() or 1),
+        }
+
+        if speed is None:
+            speed = class_speed
+        if speed is not None:
+            params["speed"] = int(speed)
+
+        tiling = options.get("avif_tiling", settings.THUMBNAIL_AVIF_TILING)
+        if tiling == "auto":
+            params["autotiling"] = True
+        else:
+            params["tile_cols"], params["tile_rows"] = parse_tiling(tiling)
+            params["autotiling"] = False
+
+        return params
+
     def _get_raw_data(
-        self, image, format_, quality, image_info=None, progressive=False
+        self,
+        image,
+        format_,
+        quality,
+        image_info=None,
+        progressive=False,
+        options=None,
     ):
-        # Increase (but never decrease) PIL buffer size
-        ImageFile.MAXBLOCK = max(ImageFile.MAXBLOCK, image.size[0] * image.size[1])
-        bf = BytesIO()
+        buffer = self._encode(image, format_, quality, image_info, progressive, options)
+        try:
+            return buffer.getvalue()
+        finally:
+            buffer.close()
 
+    def _encode(
+        self,
+        image,
+        format_,
+        quality,
+        image_info=None,
+        progressive=False,
+        options=None,
+    ):
+        """
+        Encodes ``image`` into a buffer of the pool and returns it, closing it
+        gives the memory back to the pool. Pillow sizes the encoder buffers for
+        each image, so nothing process wide is changed.
+        """
+        image_info = image_info or {}
         params = {
             "format": format_,
             "quality": quality,
@@ -46,24 +470,28 @@ class AvifEngine(Engine):
         if "icc_profile" in image_info:
             params["icc_profile"] = image_info["icc_profile"]
 
-        raw_data = None
-
         if format_ == "JPEG" and progressive:
             params["progressive"] = True
+        elif format_ == "AVIF":
+            params.update(self._get_avif_params(image, options or {}))
+
+        buffer = buffer_pool.acquire()
         try:
             # Do not save unnecessary exif data for smaller thumbnail size
             params.pop("exif", {})
-            image.save(bf, **params)
-        except OSError:
-            # Try without optimization.
-            params.pop("optimize")
-            image.save(bf, **params)
-        else:
-            raw_data = bf.getvalue()
-        finally:
-            bf.close()
-
-        return raw_data
+            try:
+                image.save(buffer, **params)
+            except OSError:
+                # Try without optimization.
+                params.pop("optimize")
+                buffer.seek(0)
+                buffer.truncate()
+                image.save(buffer, **params)
+        except Exception:
+            buffer.close()
+            raise
+        buffer.seek(0)
+        return buffer
 
     def _blur(self, image, radius):
         return image.filter(GaussianBlur(radius=radius))
@@ -0,0 +1,195 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from django.db import close_old_connections
+from sorl.thumbnail import default
+from sorl.thumbnail.helpers import ThumbnailError
+
+from sorl_thumbnail_avif.thumbnail.conf import settings
+from sorl_thumbnail_avif.thumbnail.helpers import DECODE_ERRORS, SourceImageError
+from sorl_thumbnail_avif.thumbnail.metrics import recording_stages, send_stages
+from sorl_thumbnail_avif.thumbnail.signals import thumbnail_stage
+
+
+_lock = threading.Lock()
+_encode_executor = None
+_async_executor = None
+_process_executor = None
+_process_slots = None
+
+
+class DatabaseThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    A thread pool for work using the database, like the key value store.
+    Connections older than ``CONN_MAX_AGE`` or broken are closed before and
+    after every job, as Django does around requests, since the threads
+    outlive them.
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(_run_with_connections, fn, *args, **kwargs)
+
+
+def _run_with_connections(fn, *args, **kwargs):
+    close_old_connections()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+def get_encode_executor():
+    """
+    Returns the thread pool thumbnails are encoded in. It is shared by all
+    threads so the number of concurrent encodes stays bounded, Pillow releases
+    the GIL while encoding.
+    """
+    global _encode_executor
+
+    with _lock:
+        if _encode_executor is None:
+            _encode_executor = ThreadPoolExecutor(
+                max_workers=settings.THUMBNAIL_ENCODE_WORKERS or os.cpu_count(),
+                thread_name_prefix="thumbnail-encode",
+            )
+    return _encode_executor
+
+
+def get_async_executor():
+    """
+    Returns the thread pool the async API runs its blocking work in: key value
+    store lookups, storage access and creating thumbnails. It is separate from
+    the encode pool, thumbnails created here wait on encodes there.
+    """
+    global _async_executor
+
+    with _lock:
+        if _async_executor is None:
+            _async_executor = DatabaseThreadPoolExecutor(
+                max_workers=settings.THUMBNAIL_ASYNC_WORKERS,
+                thread_name_prefix="thumbnail-async",
+            )
+    return _async_executor
+
+
+def get_process_executor():
+    """
+    Returns the process pool thumbnails are rendered in when
+    ``THUMBNAIL_PROCESS_POOL_WORKERS`` is set, and the semaphore bounding the
+    work queued on it.
+    """
+    global _process_executor, _process_slots
+
+    with _lock:
+        if _process_executor is None:
+            workers = settings.THUMBNAIL_PROCESS_POOL_WORKERS
+            context = settings.THUMBNAIL_PROCESS_POOL_CONTEXT
+            _process_executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=context and multiprocessing.get_context(context),
+                initializer=_init_process_worker,
+            )
+            _process_slots = threading.BoundedSemaphore(
+                settings.THUMBNAIL_PROCESS_POOL_QUEUE_SIZE or workers * 2
+            )
+    return _process_executor, _process_slots
+
+
+def shutdown_process_executor(wait=True):
+    """
+    Shuts the process pool down, the next render starts a new one.
+    """
+    global _process_executor, _process_slots
+
+    with _lock:
+        executor, _process_executor, _process_slots = _process_executor, None, None
+    if executor is not None:
+        executor.shutdown(wait=wait, cancel_futures=True)
+
+
+def render_in_process_pool(raw_data, geometry_strings, options, formats=None):
+    """
+    Renders the thumbnails of the source bytes in the process pool, see
+    ``AvifThumbnail._render``. Raises ``ThumbnailError`` when the queue stays
+    full or the render doesn't finish within ``THUMBNAIL_PROCESS_POOL_TIMEOUT``
+    seconds, so a busy pool pushes back on the request threads instead of
+    piling up work. The stages timed in the worker are sent in this process.
+    """
+    executor, slots = get_process_executor()
+    timeout = settings.THUMBNAIL_PROCESS_POOL_TIMEOUT
+
+    if not slots.acquire(timeout=timeout):
+        raise ThumbnailError("Thumbnail process pool queue is full")
+    try:
+        future = executor.submit(
+            _render,
+            raw_data,
+            geometry_strings,
+            options,
+            formats,
+            bool(thumbnail_stage.receivers),
+        )
+    except Exception:
+        slots.release()
+        raise
+    future.add_done_callback(lambda future: slots.release())
+
+    try:
+        result, stages = future.result(timeout=timeout)
+    except FutureTimeoutError as e:
+        raise ThumbnailError("Thumbnail rendering timed out") from e
+    except BrokenProcessPool as e:
+        shutdown_process_executor(wait=False)
+        raise ThumbnailError("Thumbnail process pool is broken") from e
+    send_stages(stages)
+    return result
+
+
+def _render(raw_data, geometry_strings, options, formats, record_stages=False):
+    if not record_stages:
+        return _render_source(raw_data, geometry_strings, options, formats), []
+    # The collectors of the worker are never served, the caller sends them
+    with recording_stages() as stages:
+        result = _render_source(raw_data, geometry_strings, options, formats)
+    return result, stages
+
+
+def _render_source(raw_data, geometry_strings, options, formats):
+    # Only the source being invalid is a SourceImageError, the caller
+    # remembers it. Anything else, like a MemoryError, is raised as it is.
+    try:
+        source_image = default.engine.get_image(raw_data)
+    except DECODE_ERRORS as e:
+        raise SourceImageError("Can't open source") from e
+    try:
+        return default.backend._render(source_image, geometry_strings, options, formats)
+    finally:
+        default.engine.cleanup(source_image)
+
+
+def _init_process_worker():
+    import django
+    from django.apps import apps
+
+    # Spawned workers don't inherit the setup of the parent process
+    if not apps.ready:
+        django.setup()
+
+
+def _reset_after_fork():
+    global _lock, _encode_executor, _async_executor, _process_executor, _process_slots
+
+    # The threads and processes of the pools belong to the parent
+    _lock = threading.Lock()
+    _encode_executor = None
+    _async_executor = None
+    _process_executor = None
+    _process_slots = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,27 @@
+from PIL import Image, UnidentifiedImageError
+from sorl.thumbnail.helpers import ThumbnailError
+
+
+class SourceImageError(ThumbnailError):
+    """
+    The source image can't be read, opened or decoded.
+    """
+
+
+class SourceReadError(SourceImageError):
+    """
+    The source image can't be read from its storage. Unlike a source that
+    can't be decoded it may be read on the next try, so it isn't remembered
+    as invalid.
+    """
+
+
+# Errors Pillow raises for data that isn't a valid image, as opposed to the
+# ``OSError`` of reading it. ``UnidentifiedImageError`` is an ``OSError`` too,
+# so it has to be checked first.
+DECODE_ERRORS = (
+    UnidentifiedImageError,
+    Image.DecompressionBombError,
+    SyntaxError,
+    ValueError,
+)
@@ -0,0 +1,76 @@
+import time
+
+from sorl.thumbnail.images import BaseImageFile, ImageFile
+
+from sorl_thumbnail_avif.thumbnail.conf import settings
+
+
+class PlaceholderImageFile(BaseImageFile):
+    """
+    Stands in for a thumbnail that is created in the background: the url of
+    the source with the size the thumbnail will have.
+    """
+
+    def __init__(self, source, size):
+        self.source = source
+        self.name = source.name
+        self.size = size
+
+    def exists(self):
+        return False
+
+    @property
+    def url(self):
+        return self.source.url
+
+
+class StatelessImageFile(ImageFile):
+    """
+    A thumbnail returned without a key value store lookup. Its size is read
+    from the file the first time it is used unless the expected size is set.
+    """
+
+    @property
+    def size(self):
+        if self._size is None:
+            self.set_size()
+        return self._size
+
+
+class ExistingThumbnails:
+    """
+    Names of the thumbnails known to exist, so ``THUMBNAIL_STATELESS`` only
+    checks the storage once per process. Names are kept for
+    ``THUMBNAIL_STATELESS_CACHE_TIMEOUT`` seconds, so thumbnails deleted by
+    other processes are noticed, and all are dropped when there are
+    ``THUMBNAIL_STATELESS_CACHE_SIZE`` of them.
+    """
+
+    def __init__(self):
+        self._names = {}
+
+    def __contains__(self, name):
+        expires = self._names.get(name)
+        if expires is None:
+            return False
+        if expires <= time.monotonic():
+            self._names.pop(name, None)
+            return False
+        return True
+
+    def add(self, name):
+        if len(self._names) >= settings.THUMBNAIL_STATELESS_CACHE_SIZE:
+            self._names = {}
+        self._names[name] = (
+            time.monotonic() + settings.THUMBNAIL_STATELESS_CACHE_TIMEOUT
+        )
+
+    def discard(self, *names):
+        for name in names:
+            self._names.pop(name, None)
+
+    def clear(self):
+        self._names = {}
+
+
+existing_thumbnails = ExistingThumbnails()
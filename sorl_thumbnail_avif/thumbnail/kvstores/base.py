@@ -0,0 +1,231 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from sorl.thumbnail.helpers import deserialize, serialize
+from sorl.thumbnail.images import deserialize_image_file, serialize_image_file
+from sorl.thumbnail.kvstores.base import add_prefix
+
+from sorl_thumbnail_avif.thumbnail.conf import settings
+from sorl_thumbnail_avif.thumbnail.executors import get_async_executor
+
+# Entries that only change when their thumbnail or source does, and are
+# deleted through the key value store then. "thumbnails" lists are updated by
+# every process and "invalid" marks expire, so they are always read through.
+LOCAL_CACHE_IDENTITIES = frozenset(("image", "formats", "content"))
+
+
+class LocalCache:
+    """
+    Least recently used values of the key value store kept in the process, up
+    to ``THUMBNAIL_LOCAL_CACHE_SIZE`` of them for
+    ``THUMBNAIL_LOCAL_CACHE_TIMEOUT`` seconds. Deletes and sets through the
+    store of this process update it, the ones of other processes show once the
+    entries expire. ``hits`` and ``misses`` count the lookups.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        size = settings.THUMBNAIL_LOCAL_CACHE_SIZE
+        if not size:
+            return
+        expires = time.monotonic() + settings.THUMBNAIL_LOCAL_CACHE_TIMEOUT
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+local_cache = LocalCache()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=local_cache.reset)
+
+
+def _is_local(key):
+    if not settings.THUMBNAIL_LOCAL_CACHE_SIZE:
+        return False
+    parts = key.rsplit("||", 2)
+    return len(parts) == 3 and parts[1] in LOCAL_CACHE_IDENTITIES
+
+
+class KVStoreMixin:
+    """
+    Adds batched and async lookups to a sorl-thumbnail key value store, and
+    the ``local_cache`` in front of it.
+    """
+
+    def get_many(self, image_files):
+        """
+        Gets the ``image_files`` from store in one round trip. Returns a list
+        in the same order with ``None`` for the ones not found.
+        """
+        keys = [add_prefix(image_file.key) for image_file in image_files]
+        values, missing = self._get_many_local(keys)
+        if missing:
+            values.update(self._set_many_local(self._get_many_raw(missing)))
+        return [
+            deserialize_image_file(values[key]) if values.get(key) else None
+            for key in keys
+        ]
+
+    async def aget_many(self, image_files):
+        """
+        Async version of ``get_many``.
+        """
+        keys = [add_prefix(image_file.key) for image_file in image_files]
+        values, missing = self._get_many_local(keys)
+        if missing:
+            found = await self._aget_many_raw(missing)
+            values.update(self._set_many_local(found))
+        return [
+            deserialize_image_file(values[key]) if values.get(key) else None
+            for key in keys
+        ]
+
+    def set_many(self, image_files, sources):
+        """
+        Like ``set`` for every image file of ``image_files`` with the source
+        at the same index of ``sources``, in three round trips whatever their
+        number. Sources missing from the store are added.
+        """
+        sources_by_key = {source.key: source for source in sources}
+        source_keys = [add_prefix(key) for key in sources_by_key]
+        list_keys = [add_prefix(key, "thumbnails") for key in sources_by_key]
+        found = self._get_many_raw(source_keys + list_keys)
+
+        values = {}
+        for key, source in zip(source_keys, sources_by_key.values()):
+            if not found.get(key):
+                source.set_size()
+                values[key] = serialize_image_file(source)
+
+        thumbnail_keys = {
+            key: set(deserialize(found[key]) if found.get(key) else ())
+            for key in list_keys
+        }
+        for image_file, source in zip(image_files, sources):
+            image_file.set_size()
+            values[add_prefix(image_file.key)] = serialize_image_file(image_file)
+            thumbnail_keys[add_prefix(source.key, "thumbnails")].add(image_file.key)
+        for key, keys in thumbnail_keys.items():
+            values[key] = serialize(list(keys))
+
+        self._set_many_raw(values)
+        self._set_many_local(values)
+
+    def _get_many_local(self, keys):
+        """
+        Returns the values of ``keys`` in the ``local_cache`` and the keys to
+        look up in the store.
+        """
+        values, missing = {}, []
+        for key in keys:
+            value = local_cache.get(key) if _is_local(key) else None
+            if value is None:
+                missing.append(key)
+            else:
+                values[key] = value
+        return values, missing
+
+    def _set_many_local(self, values):
+        for key, value in values.items():
+            if value and _is_local(key):
+                local_cache.set(key, value)
+        return values
+
+    def _get_raw(self, key):
+        if not _is_local(key):
+            return super()._get_raw(key)
+        value = local_cache.get(key)
+        if value is None:
+            value = super()._get_raw(key)
+            if value:
+                local_cache.set(key, value)
+        return value
+
+    def _set_raw(self, key, value):
+        super()._set_raw(key, value)
+        if _is_local(key):
+            local_cache.set(key, value)
+
+    def _delete_raw(self, *keys):
+        super()._delete_raw(*keys)
+        local_cache.delete(*keys)
+
+    #
+    # Methods which key-value stores should implement
+    #
+    def _get_many_raw(self, keys):
+        """
+        Gets the values for ``keys``, returns a dict of the keys found.
+        """
+        return {key: self._get_raw(key) for key in keys}
+
+    def _set_many_raw(self, values):
+        """
+        Sets the keys of the ``values`` dict to their values.
+        """
+        for key, value in values.items():
+            self._set_raw(key, value)
+
+    def _iter_raw(self, prefix, batch_size=1000):
+        """
+        Yields the ``(key, value)`` pairs of the keys starting with
+        ``prefix``, reading ``batch_size`` values at a time. Stores that can
+        list their keys lazily should stream them instead of loading them all.
+        """
+        keys = []
+        for key in self._find_keys_raw(prefix):
+            keys.append(key)
+            if len(keys) == batch_size:
+                yield from self._get_many_raw(keys).items()
+                keys = []
+        if keys:
+            yield from self._get_many_raw(keys).items()
+
+    async def _aget_many_raw(self, keys):
+        """
+        Async version of ``_get_many_raw``. Runs it in the async executor
+        rather than in the single thread ``sync_to_async`` uses by default,
+        so concurrent lookups don't queue behind each other.
+        """
+        get_many_raw = sync_to_async(
+            self._get_many_raw, thread_sensitive=False, executor=get_async_executor()
+        )
+        return await get_many_raw(keys)
@@ -0,0 +1,46 @@
+from django.db import connections, router
+from sorl.thumbnail.conf import settings
+from sorl.thumbnail.kvstores import cached_db_kvstore
+from sorl.thumbnail.kvstores.cached_db_kvstore import EMPTY_VALUE
+from sorl.thumbnail.models import KVStore as KVStoreModel
+
+from sorl_thumbnail_avif.thumbnail.kvstores.base import KVStoreMixin
+
+
+class KVStore(KVStoreMixin, cached_db_kvstore.KVStore):
+    def _get_many_raw(self, keys):
+        values = self.cache.get_many(keys)
+        missing = [key for key in keys if key not in values]
+
+        if missing:
+            qs = KVStoreModel.objects.filter(key__in=missing)
+            found = dict(qs.values_list("key", "value"))
+            # we set the cache to prevent further db lookups
+            values.update({key: found.get(key, EMPTY_VALUE) for key in missing})
+            self.cache.set_many(
+                {key: values[key] for key in missing}, settings.THUMBNAIL_CACHE_TIMEOUT
+            )
+
+        return {key: value for key, value in values.items() if value != EMPTY_VALUE}
+
+    def _set_many_raw(self, values):
+        features = connections[router.db_for_write(KVStoreModel)].features
+        if not features.supports_update_conflicts:
+            # e.g. Oracle has no upsert, set the keys one by one
+            return super()._set_many_raw(values)
+
+        # MySQL and MariaDB upsert on any unique field and reject naming it
+        unique_fields = (
+            ["key"] if features.supports_update_conflicts_with_target else None
+        )
+        KVStoreModel.objects.bulk_create(
+            [KVStoreModel(key=key, value=value) for key, value in values.items()],
+            update_conflicts=True,
+            unique_fields=unique_fields,
+            update_fields=["value"],
+        )
+        self.cache.set_many(values, settings.THUMBNAIL_CACHE_TIMEOUT)
+
+    def _iter_raw(self, prefix, batch_size=1000):
+        qs = KVStoreModel.objects.filter(key__startswith=prefix)
+        return qs.values_list("key", "value").iterator(chunk_size=batch_size)
@@ -0,0 +1,21 @@
+from sorl.thumbnail.kvstores import redis_kvstore
+
+from sorl_thumbnail_avif.thumbnail.kvstores.base import KVStoreMixin
+
+
+class KVStore(KVStoreMixin, redis_kvstore.KVStore):
+    def _get_many_raw(self, keys):
+        return dict(zip(keys, self.connection.mget(keys)))
+
+    def _set_many_raw(self, values):
+        self.connection.mset(values)
+
+    def _iter_raw(self, prefix, batch_size=1000):
+        keys = []
+        for key in self.connection.scan_iter(match=prefix + "*", count=batch_size):
+            keys.append(key.decode("utf-8"))
+            if len(keys) == batch_size:
+                yield from zip(keys, self.connection.mget(keys))
+                keys = []
+        if keys:
+            yield from zip(keys, self.connection.mget(keys))
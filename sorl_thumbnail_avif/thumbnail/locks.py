@@ -0,0 +1,142 @@
+import os
+import secrets
+import tempfile
+import threading
+import time
+
+from sorl_thumbnail_avif.thumbnail.conf import settings
+
+# Seconds between checks of a lock file held by another process
+POLL_INTERVAL = 0.05
+
+
+class GenerationLocks:
+    """
+    Makes sure a thumbnail is created by one caller at a time: one thread of
+    the process, and with lock files in ``THUMBNAIL_LOCK_DIR`` one process of
+    the host. A lock older than ``THUMBNAIL_LOCK_TIMEOUT`` is considered
+    abandoned, so a crashed process can't hold it forever. Each lock file
+    holds a token of its owner, so a lock taken over from a slow process isn't
+    removed when that process is done.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = {}
+        self._tokens = {}
+
+    def acquire(self, key):
+        """
+        Takes the lock for ``key`` without waiting, returns whether it did.
+        """
+        with self._lock:
+            if key in self._events:
+                return False
+            self._events[key] = threading.Event()
+
+        try:
+            acquired = self._acquire_file(key)
+        except BaseException:
+            # e.g. a read-only or full lock dir, don't leave the key locked
+            with self._lock:
+                self._events.pop(key).set()
+            raise
+        if acquired:
+            return True
+
+        with self._lock:
+            self._events.pop(key).set()
+        return False
+
+    def release(self, key):
+        with self._lock:
+            token = self._tokens.pop(key, None)
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as f:
+                owned = f.read() == token
+            if owned:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+        with self._lock:
+            self._events.pop(key).set()
+
+    def wait(self, key, timeout):
+        """
+        Waits at most ``timeout`` seconds for the lock for ``key`` to be
+        released, returns whether it was.
+        """
+        deadline = time.monotonic() + timeout
+
+        with self._lock:
+            event = self._events.get(key)
+        if event is not None and not event.wait(max(timeout, 0)):
+            return False
+
+        path = self._get_path(key)
+        while os.path.exists(path) and not self._is_stale(path):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(POLL_INTERVAL, remaining))
+        return True
+
+    def reset(self):
+        """
+        Forgets the locks held by the threads of this process, after a fork
+        they belong to the parent.
+        """
+        self._lock = threading.Lock()
+        self._events = {}
+        self._tokens = {}
+
+    def _acquire_file(self, key):
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        token = ("%d:%s" % (os.getpid(), secrets.token_hex(8))).encode()
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self._is_stale(path):
+                    return False
+                # Take over the abandoned lock, if another process removed it
+                # first creating it again decides who gets it.
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            else:
+                try:
+                    os.write(fd, token)
+                except BaseException:
+                    os.close(fd)
+                    os.remove(path)
+                    raise
+                os.close(fd)
+                with self._lock:
+                    self._tokens[key] = token
+                return True
+        return False
+
+    def _is_stale(self, path):
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except FileNotFoundError:
+            return False
+        return age > settings.THUMBNAIL_LOCK_TIMEOUT
+
+    def _get_path(self, key):
+        lock_dir = settings.THUMBNAIL_LOCK_DIR or os.path.join(
+            tempfile.gettempdir(), "sorl-thumbnail-avif"
+        )
+        return os.path.join(lock_dir, "%s.lock" % key)
+
+
+generation_locks = GenerationLocks()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=generation_locks.reset)
@@ -0,0 +1,164 @@
+import os
+import re
+import sqlite3
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from sorl.thumbnail import default
+from sorl.thumbnail.helpers import deserialize
+from sorl.thumbnail.kvstores.base import add_prefix
+
+from sorl_thumbnail_avif.thumbnail.conf import settings
+
+# Alternative resolutions are named after their thumbnail, e.g. <name>@2x.avif
+resolution_pat = re.compile(r"@[\d.]+x(\.\w+)$")
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes the files under THUMBNAIL_PREFIX no entry of the key value "
+        "store refers to"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Report the orphaned files without deleting them",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Files checked and deleted at once",
+        )
+        parser.add_argument(
+            "--min-age",
+            type=int,
+            default=3600,
+            help="Seconds since a file was modified before it can be deleted, "
+            "thumbnails are written before they are stored",
+        )
+
+    def handle(self, *args, **options):
+        if settings.THUMBNAIL_STATELESS:
+            raise CommandError(
+                "THUMBNAIL_STATELESS doesn't record thumbnails in the key value "
+                "store, every thumbnail would be an orphan"
+            )
+        self.verbosity = int(options["verbosity"])
+        self.dry_run = options["dry_run"]
+        self.batch_size = options["batch_size"]
+        self.min_mtime = time.time() - options["min_age"]
+        self.stats = {"scanned": 0, "orphans": 0, "bytes": 0}
+
+        # The referenced names go to a sqlite table on disk, its index is the
+        # sorted set the storage listing is checked against, so memory
+        # doesn't grow with the number of thumbnails.
+        with tempfile.TemporaryDirectory() as directory:
+            db = sqlite3.connect(os.path.join(directory, "referenced.sqlite3"))
+            try:
+                db.execute("CREATE TABLE referenced (name TEXT PRIMARY KEY)")
+                self.load_referenced(db)
+                self.collect(db)
+            finally:
+                db.close()
+
+        if self.verbosity >= 1:
+            self.stdout.write(
+                "%s %d of %d files, %d bytes"
+                % (
+                    "Would delete" if self.dry_run else "Deleted",
+                    self.stats["orphans"],
+                    self.stats["scanned"],
+                    self.stats["bytes"],
+                )
+            )
+
+    def load_referenced(self, db):
+        prefix = settings.THUMBNAIL_PREFIX
+        names = []
+        for _, value in self.iter_images():
+            if not value:
+                continue
+            name = deserialize(value)["name"]
+            if name.startswith(prefix):
+                names.append((name,))
+            if len(names) == self.batch_size:
+                db.executemany("INSERT OR IGNORE INTO referenced VALUES (?)", names)
+                names = []
+        db.executemany("INSERT OR IGNORE INTO referenced VALUES (?)", names)
+        db.commit()
+
+    def iter_images(self):
+        prefix = add_prefix("", identity="image")
+        if hasattr(default.kvstore, "_iter_raw"):
+            return default.kvstore._iter_raw(prefix, self.batch_size)
+        return (
+            (key, default.kvstore._get_raw(key))
+            for key in default.kvstore._find_keys_raw(prefix)
+        )
+
+    def collect(self, db):
+        batch = []
+        for name in self.walk(default.storage, settings.THUMBNAIL_PREFIX):
+            self.stats["scanned"] += 1
+            batch.append(name)
+            if len(batch) == self.batch_size:
+                self.collect_batch(db, batch)
+                batch = []
+        if batch:
+            self.collect_batch(db, batch)
+
+    def collect_batch(self, db, names):
+        thumbnail_names = {name: resolution_pat.sub(r"\1", name) for name in names}
+        lookup = sorted(set(thumbnail_names.values()))
+        referenced = {
+            row[0]
+            for row in db.execute(
+                "SELECT name FROM referenced WHERE name IN (%s)"
+                % ",".join("?" * len(lookup)),
+                lookup,
+            )
+        }
+
+        storage = default.storage
+        for name in names:
+            if thumbnail_names[name] in referenced:
+                continue
+            if storage.get_modified_time(name).timestamp() > self.min_mtime:
+                continue
+            self.stats["orphans"] += 1
+            self.stats["bytes"] += storage.size(name)
+            if self.verbosity >= 2:
+                self.stdout.write(name)
+            if not self.dry_run:
+                storage.delete(name)
+
+    def walk(self, storage, path):
+        """
+        Yields the names of the files under ``path``, directory by directory,
+        with ``os.scandir`` for local storages.
+        """
+        try:
+            root = storage.path(path)
+        except NotImplementedError:
+            directories, files = storage.listdir(path)
+            for file_name in files:
+                yield path + file_name
+            for directory in directories:
+                yield from self.walk(storage, path + directory + "/")
+            return
+
+        if not os.path.isdir(root):
+            return
+        directories = []
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.name)
+                else:
+                    yield path + entry.name
+        for directory in directories:
+            yield from self.walk(storage, path + directory + "/")
@@ -0,0 +1,287 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from sorl.thumbnail import default
+from sorl.thumbnail.images import ImageFile, get_or_create_storage
+
+from sorl_thumbnail_avif.thumbnail.conf import settings
+from sorl_thumbnail_avif.thumbnail.executors import _init_process_worker
+from sorl_thumbnail_avif.thumbnail.helpers import SourceImageError, SourceReadError
+from sorl_thumbnail_avif.thumbnail.locks import generation_locks
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates the thumbnails of an image field for every object of its "
+        "model, skipping the ones in the key value store"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("field", help="app_label.Model.field")
+        parser.add_argument("geometries", nargs="+", help="e.g. 100x100 x200")
+        parser.add_argument(
+            "-o",
+            "--option",
+            action="append",
+            default=[],
+            dest="thumbnail_options",
+            help="Thumbnail option as key=value, e.g. crop=center",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count(),
+            help="Worker processes, 0 creates the thumbnails in this process",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Objects read and looked up at once, and between checkpoints",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            help="File recording the progress, an interrupted run resumes there",
+        )
+
+    def handle(self, *args, **options):
+        self.verbosity = int(options["verbosity"])
+        model, field = self.get_field(options["field"])
+        geometries = options["geometries"]
+        thumbnail_options = self.parse_options(options["thumbnail_options"])
+        batch_size = options["batch_size"]
+
+        state = {
+            "field": options["field"],
+            "geometries": geometries,
+            "options": thumbnail_options,
+            "last_pk": None,
+        }
+        checkpoint = options["checkpoint"]
+        if checkpoint and os.path.exists(checkpoint):
+            state = self.read_checkpoint(checkpoint, state)
+
+        queryset = (
+            model._default_manager.exclude(**{field: ""})
+            .exclude(**{"%s__isnull" % field: True})
+            .order_by("pk")
+            .only("pk", field)
+        )
+
+        executor = None
+        if options["workers"]:
+            executor = ProcessPoolExecutor(
+                max_workers=options["workers"], initializer=_init_process_worker
+            )
+
+        self.stats = {"sources": 0, "created": 0, "skipped": 0, "errors": 0}
+        self.started = time.monotonic()
+        try:
+            # Pages of primary keys rather than one long cursor, so no read
+            # is kept open while the workers write to the database.
+            while True:
+                batch = queryset
+                if state["last_pk"] is not None:
+                    batch = batch.filter(pk__gt=state["last_pk"])
+                batch = list(batch[:batch_size])
+                if not batch:
+                    break
+                self.prewarm(batch, field, geometries, thumbnail_options, executor)
+                self.checkpoint(checkpoint, state, batch[-1].pk)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+        if self.verbosity >= 1:
+            self.stdout.write("Done: %s" % self.format_stats())
+
+    def get_field(self, label):
+        try:
+            app_label, model_name, field = label.split(".")
+            model = apps.get_model(app_label, model_name)
+            model._meta.get_field(field)
+        except (ValueError, LookupError) as e:
+            raise CommandError("Unknown image field %r: %s" % (label, e))
+        return model, field
+
+    def parse_options(self, pairs):
+        thumbnail_options = {}
+        for pair in pairs:
+            key, sep, value = pair.partition("=")
+            if not sep:
+                raise CommandError("Options are given as key=value, not %r" % pair)
+            # numbers and booleans as JSON, anything else as a string
+            try:
+                thumbnail_options[key] = json.loads(value)
+            except ValueError:
+                thumbnail_options[key] = value
+        return thumbnail_options
+
+    def read_checkpoint(self, path, state):
+        with open(path) as f:
+            saved = json.load(f)
+        if {key: saved.get(key) for key in ("field", "geometries", "options")} != {
+            key: state[key] for key in ("field", "geometries", "options")
+        }:
+            raise CommandError(
+                "Checkpoint %s was written for other arguments, remove it to "
+                "start again" % path
+            )
+        return saved
+
+    def checkpoint(self, path, state, last_pk):
+        state["last_pk"] = last_pk
+        if path:
+            with open(path + ".tmp", "w") as f:
+                json.dump(state, f)
+            os.replace(path + ".tmp", path)
+
+    def prewarm(self, objects, field, geometries, thumbnail_options, executor):
+        """
+        Looks the thumbnails of ``objects`` up in one round trip and creates
+        the missing ones, in the worker processes if any. The workers only
+        render and write files, the key value store is updated here for the
+        whole batch at once.
+        """
+        lookups = [
+            default.backend._get_thumbnail_files(
+                getattr(obj, field), geometries, dict(thumbnail_options)
+            )
+            for obj in objects
+        ]
+
+        flat = [thumbnail for _, _, thumbnails in lookups for thumbnail in thumbnails]
+        cached = iter(default.backend._get_cached_thumbnails(flat))
+        jobs = []
+        for source, options, thumbnails in lookups:
+            missing = [
+                (geometry, thumbnail.name)
+                for geometry, thumbnail in zip(geometries, thumbnails)
+                if not next(cached)
+            ]
+            self.stats["skipped"] += len(geometries) - len(missing)
+            if missing:
+                jobs.append(
+                    (
+                        source,
+                        (
+                            source.name,
+                            source.serialize_storage(),
+                            [geometry for geometry, _ in missing],
+                            [name for _, name in missing],
+                            options,
+                        ),
+                    )
+                )
+
+        if executor is None:
+            results = [self.run_job(job) for _, job in jobs]
+        else:
+            # The workers are forked on submit, they must not inherit the
+            # database connections of this process
+            connections.close_all()
+            futures = [executor.submit(_create_thumbnails, *job) for _, job in jobs]
+            results = [self.get_result(future) for future in futures]
+
+        thumbnails, sources = [], []
+        for (source, job), result in zip(jobs, results):
+            if isinstance(result, SourceImageError):
+                if not isinstance(result, SourceReadError):
+                    default.backend._set_invalid(source)
+                result = None
+            if result is None:
+                self.stats["errors"] += 1
+                continue
+            size, created = result
+            if size is not None:
+                source.set_size(size)
+            for name, thumbnail_size in created:
+                thumbnail = ImageFile(name, default.storage)
+                if thumbnail_size is not None:
+                    thumbnail.set_size(thumbnail_size)
+                thumbnails.append(thumbnail)
+                sources.append(source)
+            # the others are being created by another process
+            self.stats["skipped"] += len(job[2]) - len(created)
+        if thumbnails and hasattr(default.kvstore, "set_many"):
+            default.kvstore.set_many(thumbnails, sources)
+        else:
+            for thumbnail, source in zip(thumbnails, sources):
+                default.kvstore.get_or_set(source)
+                default.kvstore.set(thumbnail, source)
+        self.stats["created"] += len(thumbnails)
+
+        self.stats["sources"] += len(objects)
+        if self.verbosity >= 2:
+            self.stdout.write(self.format_stats())
+
+    def run_job(self, job):
+        try:
+            return _create_thumbnails(*job)
+        except SourceImageError as e:
+            logger.exception("Can't create the thumbnails of %s", job[0])
+            return e
+        except Exception:
+            logger.exception("Can't create the thumbnails of %s", job[0])
+            return None
+
+    def get_result(self, future):
+        try:
+            return future.result()
+        except SourceImageError as e:
+            logger.exception("Can't create thumbnails")
+            return e
+        except Exception:
+            logger.exception("Can't create thumbnails")
+            return None
+
+    def format_stats(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return (
+            "%(sources)d sources, %(created)d thumbnails created, "
+            "%(skipped)d already there, %(errors)d failed sources" % self.stats
+            + ", %.1f thumbnails/s" % (self.stats["created"] / elapsed)
+        )
+
+
+def _create_thumbnails(name, storage, geometry_strings, thumbnail_names, options):
+    """
+    Renders and writes the thumbnails of a source, without any key value store
+    access. Returns the source size, ``None`` when nothing was rendered, and
+    ``(name, size)`` for every thumbnail it created or found in the storage.
+    Thumbnails another process holds the generation lock of are left out.
+    """
+    backend = default.backend
+    source = ImageFile(name, get_or_create_storage(storage))
+    thumbnails = [ImageFile(name, default.storage) for name in thumbnail_names]
+
+    owned = [i for i, th in enumerate(thumbnails) if generation_locks.acquire(th.key)]
+    try:
+        create = [
+            i
+            for i in owned
+            if settings.THUMBNAIL_FORCE_OVERWRITE or not thumbnails[i].exists()
+        ]
+        size = None
+        if create:
+            source_image = backend._get_source_image(source)
+            try:
+                size, rendered, _ = backend._render(
+                    source_image, [geometry_strings[i] for i in create], dict(options)
+                )
+            finally:
+                default.engine.cleanup(source_image)
+            for i, (outputs,) in zip(create, rendered):
+                backend._write_thumbnails(thumbnails[i], outputs)
+    finally:
+        for i in owned:
+            generation_locks.release(thumbnails[i].key)
+    return size, [(thumbnails[i].name, thumbnails[i]._size) for i in owned]
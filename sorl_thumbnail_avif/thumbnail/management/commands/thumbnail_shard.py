@@ -0,0 +1,167 @@
+import os
+
+from django.core.management.base import BaseCommand
+from sorl.thumbnail import default
+from sorl.thumbnail.images import (
+    ImageFile,
+    deserialize_image_file,
+    serialize_image_file,
+)
+from sorl.thumbnail.kvstores.base import add_prefix, del_prefix
+
+from sorl_thumbnail_avif.thumbnail.conf import settings
+
+# Length of the thumbnail keys, ``tokey`` returns md5 hex digests
+KEY_LENGTH = 32
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves the thumbnails in the key value store to the directory layout "
+        "of THUMBNAIL_DIRECTORY_SHARDS and updates their entries"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Sources migrated between progress reports",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Count the thumbnails to move without moving them",
+        )
+
+    def handle(self, *args, **options):
+        verbosity = int(options["verbosity"])
+        batch_size = options["batch_size"]
+        dry_run = options["dry_run"]
+
+        moved = sources = 0
+        batch = []
+        for source_key in self.iter_source_keys(batch_size):
+            batch.append(source_key)
+            if len(batch) < batch_size:
+                continue
+            moved += sum(self.migrate_source(key, dry_run) for key in batch)
+            sources += len(batch)
+            batch = []
+            if verbosity >= 2:
+                self.stdout.write("%d sources" % sources)
+        if batch:
+            moved += sum(self.migrate_source(key, dry_run) for key in batch)
+            sources += len(batch)
+            if verbosity >= 2:
+                self.stdout.write("%d sources" % sources)
+
+        if verbosity >= 1:
+            self.stdout.write(
+                "%s %d thumbnails" % ("Would move" if dry_run else "Moved", moved)
+            )
+
+    def iter_source_keys(self, batch_size):
+        """
+        Yields the keys of the sources with thumbnails, streamed from the
+        store ``batch_size`` at a time where it can. Migrating only rewrites
+        the values of these keys, so the listing isn't thrown off by it.
+        """
+        if hasattr(default.kvstore, "_iter_raw"):
+            prefix = add_prefix("", identity="thumbnails")
+            for key, _ in default.kvstore._iter_raw(prefix, batch_size):
+                yield del_prefix(key)
+        else:
+            yield from default.kvstore._find_keys(identity="thumbnails")
+
+    def migrate_source(self, source_key, dry_run):
+        """
+        Moves the thumbnails of one source. The old entries are deleted only
+        after the source points to the new ones, so an interrupted run can be
+        started again.
+        """
+        thumbnail_keys = default.kvstore._get(source_key, identity="thumbnails") or []
+        new_keys, old_keys = [], []
+
+        for key in thumbnail_keys:
+            thumbnail = default.kvstore._get(key)
+            name = thumbnail and self.get_new_name(thumbnail.name)
+            if not name or name == thumbnail.name:
+                new_keys.append(key)
+                continue
+            if dry_run:
+                old_keys.append(key)
+                continue
+
+            self.move_files(thumbnail, name)
+            moved = ImageFile(name, thumbnail.storage)
+            moved.set_size(thumbnail.size)
+            default.kvstore._set(moved.key, moved)
+
+            formats = default.kvstore._get(key, identity="formats")
+            if formats:
+                default.kvstore._set(
+                    moved.key,
+                    [self.rename_serialized(value) for value in formats],
+                    identity="formats",
+                )
+
+            new_keys.append(moved.key)
+            old_keys.append(key)
+
+        if old_keys and not dry_run:
+            default.kvstore._set(source_key, new_keys, identity="thumbnails")
+            for key in old_keys:
+                default.kvstore._delete(key)
+                default.kvstore._delete(key, identity="formats")
+        return len(old_keys)
+
+    def get_new_name(self, name):
+        """
+        Returns the name of the thumbnail file ``name`` in the current layout,
+        ``None`` for files not created under ``THUMBNAIL_PREFIX``.
+        """
+        prefix = settings.THUMBNAIL_PREFIX
+        if not name.startswith(prefix):
+            return None
+        stem, ext = os.path.splitext(os.path.basename(name))
+        key = stem[-KEY_LENGTH:]
+        if len(key) != KEY_LENGTH:
+            return None
+        return "%s%s%s" % (prefix, default.backend._get_thumbnail_path(key), ext)
+
+    def rename_serialized(self, value):
+        image_file = deserialize_image_file(value)
+        image_file.name = self.get_new_name(image_file.name) or image_file.name
+        return serialize_image_file(image_file)
+
+    def move_files(self, thumbnail, name):
+        """
+        Moves the thumbnail file and its alternative resolutions to ``name``.
+        Files already moved by an interrupted run are skipped.
+        """
+        old_stem, ext = os.path.splitext(thumbnail.name)
+        new_stem = os.path.splitext(name)[0]
+        moves = [(thumbnail.name, name)] + [
+            (
+                "%s@%sx%s" % (old_stem, resolution, ext),
+                "%s@%sx%s" % (new_stem, resolution, ext),
+            )
+            for resolution in settings.THUMBNAIL_ALTERNATIVE_RESOLUTIONS
+        ]
+        for old_name, new_name in moves:
+            if thumbnail.storage.exists(old_name):
+                self.move_file(thumbnail.storage, old_name, new_name)
+
+    def move_file(self, storage, old_name, new_name):
+        try:
+            old_path, new_path = storage.path(old_name), storage.path(new_name)
+        except NotImplementedError:
+            # Remote storages have no rename, copy the file then delete it
+            if not storage.exists(new_name):
+                with storage.open(old_name) as f:
+                    storage.save(new_name, f)
+            storage.delete(old_name)
+        else:
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            os.replace(old_path, new_path)
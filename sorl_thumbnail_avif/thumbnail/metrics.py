@@ -0,0 +1,192 @@
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from django.http import HttpResponse
+from sorl.thumbnail.helpers import get_module_class
+
+from sorl_thumbnail_avif.thumbnail.conf import settings
+from sorl_thumbnail_avif.thumbnail.signals import thumbnail_stage
+
+# The ``THUMBNAIL_METRICS_COLLECTORS`` connected when the app is ready
+collectors = []
+
+# The stages kept by ``recording_stages`` instead of being sent
+_recorded = None
+
+
+class Stage:
+    """
+    Times a stage and sends ``thumbnail_stage`` when it finishes without an
+    error. Byte and pixel counts only known at the end can be added with
+    ``set``.
+    """
+
+    __slots__ = ("sender", "name", "info", "start")
+
+    def __init__(self, sender, name, info):
+        self.sender = sender
+        self.name = name
+        self.info = info
+
+    def set(self, **info):
+        self.info.update(info)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            return
+        duration = time.perf_counter() - self.start
+        recorded = _recorded
+        if recorded is not None:
+            recorded.append((self.sender.__class__, self.name, duration, self.info))
+        else:
+            thumbnail_stage.send(
+                sender=self.sender.__class__,
+                stage=self.name,
+                duration=duration,
+                **self.info,
+            )
+
+
+class NoStage:
+    """
+    Stands in for ``Stage`` while nobody listens.
+    """
+
+    __slots__ = ()
+
+    def set(self, **info):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NO_STAGE = NoStage()
+
+
+def stage(sender, name, **info):
+    """
+    Returns a context manager timing the ``name`` stage of ``sender``, a
+    shared no-op one when ``thumbnail_stage`` has no receivers.
+    """
+    if not thumbnail_stage.receivers and _recorded is None:
+        return NO_STAGE
+    return Stage(sender, name, info)
+
+
+@contextmanager
+def recording_stages():
+    """
+    Keeps the stages finished in any thread of the process inside the block
+    in the list it yields instead of sending them. Process pool workers
+    return them with their result, and the process serving the metrics sends
+    them with ``send_stages``.
+    """
+    global _recorded
+
+    _recorded = []
+    try:
+        yield _recorded
+    finally:
+        _recorded = None
+
+
+def send_stages(stages):
+    """
+    Sends the stages kept by ``recording_stages``.
+    """
+    for sender, name, duration, info in stages:
+        thumbnail_stage.send(sender=sender, stage=name, duration=duration, **info)
+
+
+def connect_collectors():
+    for path in settings.THUMBNAIL_METRICS_COLLECTORS:
+        collector = get_module_class(path)()
+        thumbnail_stage.connect(collector, weak=False)
+        collectors.append(collector)
+
+
+class StatsdCollector:
+    """
+    Sends every stage to statsd at ``THUMBNAIL_STATSD_ADDRESS`` as a timer
+    named ``<THUMBNAIL_METRICS_PREFIX>.<stage>`` and its bytes and pixels as
+    histograms, over UDP so a missing statsd costs nothing.
+    """
+
+    def __init__(self):
+        self.address = settings.THUMBNAIL_STATSD_ADDRESS
+        self.prefix = settings.THUMBNAIL_METRICS_PREFIX
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, sender, stage, duration, bytes=None, pixels=None, **kwargs):
+        lines = ["%s.%s:%.3f|ms" % (self.prefix, stage, duration * 1000)]
+        if bytes is not None:
+            lines.append("%s.%s.bytes:%d|h" % (self.prefix, stage, bytes))
+        if pixels is not None:
+            lines.append("%s.%s.pixels:%d|h" % (self.prefix, stage, pixels))
+        try:
+            self.socket.sendto("\n".join(lines).encode(), self.address)
+        except OSError:
+            pass
+
+
+class PrometheusCollector:
+    """
+    Counts the stages of this process, including the ones of its
+    ``THUMBNAIL_PROCESS_POOL_WORKERS``, ``render`` returns them in the
+    Prometheus text format. ``prometheus_view`` serves them.
+    """
+
+    def __init__(self):
+        self.prefix = settings.THUMBNAIL_METRICS_PREFIX
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def __call__(self, sender, stage, duration, bytes=None, pixels=None, **kwargs):
+        with self.lock:
+            totals = self.stages.setdefault(stage, [0, 0.0, 0, 0])
+            totals[0] += 1
+            totals[1] += duration
+            totals[2] += bytes or 0
+            totals[3] += pixels or 0
+
+    def render(self):
+        with self.lock:
+            stages = sorted(
+                (name, list(totals)) for name, totals in self.stages.items()
+            )
+
+        seconds = "%s_stage_seconds" % self.prefix
+        lines = ["# TYPE %s summary" % seconds]
+        for stage, (count, duration, _, _) in stages:
+            lines.append('%s_count{stage="%s"} %d' % (seconds, stage, count))
+            lines.append('%s_sum{stage="%s"} %f' % (seconds, stage, duration))
+        for metric, index in (("bytes", 2), ("pixels", 3)):
+            name = "%s_stage_%s_total" % (self.prefix, metric)
+            lines.append("# TYPE %s counter" % name)
+            for stage, totals in stages:
+                lines.append('%s{stage="%s"} %d' % (name, stage, totals[index]))
+        return "\n".join(lines) + "\n"
+
+
+def prometheus_view(request):
+    """
+    Serves the stages counted by the ``PrometheusCollector`` of the process.
+    """
+    return HttpResponse(
+        "".join(
+            collector.render()
+            for collector in collectors
+            if isinstance(collector, PrometheusCollector)
+        ),
+        content_type="text/plain; version=0.0.4",
+    )
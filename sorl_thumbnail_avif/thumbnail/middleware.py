@@ -0,0 +1,97 @@
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.utils.cache import patch_vary_headers
+
+from sorl_thumbnail_avif.thumbnail.conf import settings
+
+_negotiation = ContextVar("thumbnail_format_negotiation", default=None)
+
+
+class FormatNegotiation:
+    """
+    The image formats the client of the current request accepts. Only formats
+    listed explicitly count, browsers send ``*/*`` whatever they decode.
+    """
+
+    def __init__(self, accept):
+        self.accepted = set()
+        self.used = False
+
+        for media_range in accept.split(","):
+            media_type, *params = [part.strip() for part in media_range.split(";")]
+            quality = 1.0
+            for param in params:
+                name, _, value = param.partition("=")
+                if name.strip() == "q":
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        pass
+            if quality > 0 and media_type.lower().startswith("image/"):
+                self.accepted.add(media_type[len("image/") :].upper())
+
+    def get_format(self):
+        """
+        Returns the first of ``THUMBNAIL_NEGOTIATED_FORMATS`` the client
+        accepts, ``THUMBNAIL_NEGOTIATION_FALLBACK`` otherwise.
+        """
+        self.used = True
+        for format_ in settings.THUMBNAIL_NEGOTIATED_FORMATS:
+            if format_.upper() in self.accepted:
+                return format_.upper()
+        return settings.THUMBNAIL_NEGOTIATION_FALLBACK
+
+
+def get_negotiated_format():
+    """
+    Returns the thumbnail format negotiated for the current request, ``None``
+    outside of requests handled by ``FormatNegotiationMiddleware``.
+    """
+    negotiation = _negotiation.get()
+    if negotiation is None:
+        return None
+    return negotiation.get_format()
+
+
+class FormatNegotiationMiddleware:
+    """
+    Creates the thumbnails of the request, when no format is given, in the
+    best format its ``Accept`` header lists. The format is part of the
+    thumbnail options, so each format is a thumbnail of its own, and
+    responses using one vary on ``Accept``.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        negotiation = FormatNegotiation(request.headers.get("Accept", ""))
+        token = _negotiation.set(negotiation)
+        try:
+            response = self.get_response(request)
+        finally:
+            _negotiation.reset(token)
+        return self.process_response(negotiation, response)
+
+    async def __acall__(self, request):
+        negotiation = FormatNegotiation(request.headers.get("Accept", ""))
+        token = _negotiation.set(negotiation)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _negotiation.reset(token)
+        return self.process_response(negotiation, response)
+
+    def process_response(self, negotiation, response):
+        if negotiation.used:
+            patch_vary_headers(response, ("Accept",))
+        return response
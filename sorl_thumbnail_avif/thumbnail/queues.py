@@ -0,0 +1,97 @@
+import logging
+import queue
+import threading
+
+from django.db import close_old_connections
+from sorl.thumbnail import default
+from sorl.thumbnail.helpers import get_module_class, serialize
+
+from sorl_thumbnail_avif.thumbnail.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_deferred_queue = None
+
+
+def get_deferred_queue():
+    """
+    Returns the ``THUMBNAIL_DEFERRED_QUEUE`` instance of the process.
+    """
+    global _deferred_queue
+
+    with _lock:
+        if _deferred_queue is None:
+            _deferred_queue = get_module_class(settings.THUMBNAIL_DEFERRED_QUEUE)()
+    return _deferred_queue
+
+
+class QueueBase:
+    """
+    Runs the thumbnail creation deferred by ``THUMBNAIL_DEFERRED``.
+    """
+
+    def enqueue(self, source, geometry_strings, options):
+        """
+        Schedules ``default.backend.create_thumbnails(source, geometry_strings,
+        **options)``. ``source`` is an ``ImageFile``, queues running the job in
+        another process can send ``source.serialize()`` and rebuild it with
+        ``deserialize_image_file``, the options are plain values.
+        """
+        raise NotImplementedError()
+
+
+class ThreadQueue(QueueBase):
+    """
+    Creates the thumbnails in a background thread of the process. A job that
+    is already queued is not queued again, and jobs are dropped while
+    ``THUMBNAIL_DEFERRED_QUEUE_SIZE`` jobs are waiting, the next request for
+    the thumbnail queues it again.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=settings.THUMBNAIL_DEFERRED_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._thread = None
+
+    def enqueue(self, source, geometry_strings, options):
+        job_key = (source.key, tuple(geometry_strings), serialize(options))
+
+        with self._lock:
+            if job_key in self._pending:
+                return
+            try:
+                self._queue.put_nowait((job_key, source, geometry_strings, options))
+            except queue.Full:
+                logger.warning(
+                    "Deferred thumbnail queue is full, dropping [%s]", source
+                )
+                return
+            self._pending.add(job_key)
+
+            # Also restarts the worker in a forked child
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._work, name="thumbnail-deferred", daemon=True
+                )
+                self._thread.start()
+
+    def join(self):
+        """
+        Waits for the queued jobs to be done.
+        """
+        self._queue.join()
+
+    def _work(self):
+        while True:
+            job_key, source, geometry_strings, options = self._queue.get()
+            try:
+                default.backend.create_thumbnails(source, geometry_strings, **options)
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                with self._lock:
+                    self._pending.discard(job_key)
+                close_old_connections()
+                self._queue.task_done()
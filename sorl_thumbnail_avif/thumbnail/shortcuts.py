@@ -0,0 +1,15 @@
+from sorl.thumbnail import default
+
+
+def prefetch_thumbnails(objects, field, geometry_string, **options):
+    """
+    Returns the thumbnail of the ``field`` image of every object of
+    ``objects`` at ``geometry_string``, ``None`` for objects without an image.
+    The thumbnails are looked up in one round trip and the missing ones are
+    created concurrently, see ``AvifThumbnail.prefetch_thumbnails``.
+    """
+    files = [getattr(obj, field) for obj in objects]
+    thumbnails = iter(
+        default.backend.prefetch_thumbnails(files, [geometry_string], **options)
+    )
+    return [next(thumbnails)[0] if file_ else None for file_ in files]
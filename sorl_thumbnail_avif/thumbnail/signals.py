@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# Sent after every stage of creating a thumbnail with ``stage`` (its name),
+# ``duration`` in seconds and, where they apply, ``bytes`` and ``pixels``.
+thumbnail_stage = Signal()
@@ -0,0 +1,253 @@
+import logging
+
+from django.template import Library, Node, TemplateSyntaxError
+from django.utils.encoding import smart_str
+from django.utils.html import format_html, format_html_join
+
+from sorl.thumbnail import default
+from sorl.thumbnail.templatetags.thumbnail import ThumbnailNodeBase, kw_pat
+
+from sorl_thumbnail_avif.thumbnail.base import prefetching
+from sorl_thumbnail_avif.thumbnail.conf import settings
+
+register = Library()
+logger = logging.getLogger(__name__)
+
+
+def parse_options(parser, bits, error_msg):
+    """
+    Returns the ``(key, expression)`` pairs of the ``key=value`` ``bits`` of a
+    tag.
+    """
+    options = []
+    for bit in bits:
+        m = kw_pat.match(bit)
+        if not m:
+            raise TemplateSyntaxError(error_msg)
+        key = smart_str(m.group("key"))
+        expr = parser.compile_filter(m.group("value"))
+        options.append((key, expr))
+    return options
+
+
+def resolve_options(options, context):
+    """
+    Resolves the options returned by ``parse_options`` to the keyword
+    arguments of the backend, ``options=`` takes a dict of them.
+    """
+    resolved = {}
+    for key, expr in options:
+        noresolve = {"True": True, "False": False, "None": None}
+        value = noresolve.get(str(expr), expr.resolve(context))
+        if key == "options":
+            resolved.update(value)
+        else:
+            resolved[key] = value
+    return resolved
+
+
+class ThumbnailOptionsNodeBase(ThumbnailNodeBase):
+    """
+    Parses ``tag source geometry [key1=val1 key2=val2...] [as var]``.
+    """
+
+    def __init__(self, parser, token):
+        bits = token.split_contents()
+        if len(bits) < 3:
+            raise TemplateSyntaxError(self.error_msg)
+
+        self.file_ = parser.compile_filter(bits[1])
+        self.geometry = parser.compile_filter(bits[2])
+        self.as_var = None
+
+        if bits[-2] == "as":
+            self.as_var = bits[-1]
+            options_bits = bits[3:-2]
+        else:
+            options_bits = bits[3:]
+        self.options = parse_options(parser, options_bits, self.error_msg)
+
+
+class ThumbnailSrcsetNode(ThumbnailOptionsNodeBase):
+    error_msg = (
+        "Syntax error. Expected: ``thumbnail_srcset source geometries "
+        "[key1=val1 key2=val2...] [as var]``"
+    )
+
+    def _render(self, context):
+        file_ = self.file_.resolve(context)
+        geometries = self.geometry.resolve(context)
+        if isinstance(geometries, str):
+            geometries = geometries.split()
+        options = resolve_options(self.options, context)
+
+        srcset = ""
+        if file_ and geometries:
+            srcset = get_srcset(file_, geometries, **options)
+
+        if self.as_var:
+            context[self.as_var] = srcset
+            return ""
+
+        if not srcset:
+            return ""
+        return format_html('srcset="{}"', srcset)
+
+    def __repr__(self):
+        return "<ThumbnailSrcsetNode>"
+
+
+def get_srcset(file_, geometries, **options):
+    """
+    Returns the ``srcset`` value for thumbnails of ``file_`` at every geometry,
+    using the width of each thumbnail as its descriptor.
+    """
+    thumbnails = default.backend.get_thumbnails(file_, list(geometries), **options)
+
+    candidates = {}
+    for thumbnail in thumbnails:
+        # the error thumbnails of unreadable sources have no size
+        if not thumbnail.size:
+            continue
+        # without upscaling several geometries can end up the same size
+        candidates.setdefault(thumbnail.x, thumbnail.url)
+
+    return ", ".join(f"{url} {width}w" for width, url in sorted(candidates.items()))
+
+
+@register.tag
+def thumbnail_srcset(parser, token):
+    return ThumbnailSrcsetNode(parser, token)
+
+
+MIME_TYPES = {
+    "AVIF": "image/avif",
+    "WEBP": "image/webp",
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "GIF": "image/gif",
+}
+
+
+class ThumbnailPictureNode(ThumbnailOptionsNodeBase):
+    error_msg = (
+        "Syntax error. Expected: ``thumbnail_picture source geometry "
+        "[formats=val] [alt=val] [key1=val1 key2=val2...] [as var]``"
+    )
+
+    def _render(self, context):
+        file_ = self.file_.resolve(context)
+        geometry = self.geometry.resolve(context)
+        options = resolve_options(self.options, context)
+
+        formats = options.pop("formats", None) or settings.THUMBNAIL_PICTURE_FORMATS
+        if isinstance(formats, str):
+            formats = formats.split()
+        alt = options.pop("alt", "")
+
+        thumbnails = []
+        if file_:
+            thumbnails = default.backend.get_thumbnail_formats(
+                file_, geometry, formats, **options
+            )
+
+        if self.as_var:
+            context[self.as_var] = thumbnails
+            return ""
+
+        if not thumbnails:
+            return ""
+        return get_picture(thumbnails, formats, alt)
+
+    def __repr__(self):
+        return "<ThumbnailPictureNode>"
+
+
+def get_picture(thumbnails, formats, alt=""):
+    """
+    Returns a ``<picture>`` with a ``<source>`` for every thumbnail but the
+    last one, which is the ``<img>`` browsers fall back to. ``formats`` are
+    the formats of the thumbnails.
+    """
+    *sources, fallback = thumbnails
+    # the error thumbnails of unreadable sources have no size
+    size = ""
+    if fallback.size:
+        size = format_html(' width="{}" height="{}"', fallback.x, fallback.y)
+    return format_html(
+        '<picture>{}<img src="{}"{} alt="{}"></picture>',
+        format_html_join(
+            "",
+            '<source srcset="{}" type="{}">',
+            (
+                (thumbnail.url, MIME_TYPES[format_.upper()])
+                for thumbnail, format_ in zip(sources, formats)
+            ),
+        ),
+        fallback.url,
+        size,
+        alt,
+    )
+
+
+@register.tag
+def thumbnail_picture(parser, token):
+    return ThumbnailPictureNode(parser, token)
+
+
+class ThumbnailPrefetchNode(Node):
+    error_msg = (
+        "Syntax error. Expected: ``thumbnail_prefetch sources [field] geometries "
+        "[key1=val1 key2=val2...]`` ... ``endthumbnail_prefetch``"
+    )
+
+    def __init__(self, parser, token):
+        bits = token.split_contents()
+        positional = [bit for bit in bits[1:] if not kw_pat.match(bit)]
+        if len(positional) not in (2, 3) or bits[1 : len(positional) + 1] != (
+            positional
+        ):
+            raise TemplateSyntaxError(self.error_msg)
+
+        self.sources = parser.compile_filter(positional[0])
+        self.field = (
+            parser.compile_filter(positional[1]) if len(positional) == 3 else None
+        )
+        self.geometries = parser.compile_filter(positional[-1])
+        self.options = parse_options(
+            parser, bits[len(positional) + 1 :], self.error_msg
+        )
+
+        self.nodelist = parser.parse(("endthumbnail_prefetch",))
+        parser.delete_first_token()
+
+    def render(self, context):
+        with prefetching():
+            try:
+                self.prefetch(context)
+            except Exception:
+                if settings.THUMBNAIL_DEBUG:
+                    raise
+                logger.exception("Thumbnail prefetch failed")
+            return self.nodelist.render(context)
+
+    def prefetch(self, context):
+        sources = self.sources.resolve(context) or []
+        geometries = self.geometries.resolve(context)
+        if isinstance(geometries, str):
+            geometries = geometries.split()
+        options = resolve_options(self.options, context)
+
+        if self.field is not None:
+            field = self.field.resolve(context)
+            sources = [getattr(source, field) for source in sources]
+        if geometries:
+            default.backend.prefetch_thumbnails(sources, list(geometries), **options)
+
+    def __repr__(self):
+        return "<ThumbnailPrefetchNode>"
+
+
+@register.tag
+def thumbnail_prefetch(parser, token):
+    return ThumbnailPrefetchNode(parser, token)
@@ -30,6 +30,7 @@ INSTALLED_APPS = (
     "django.contrib.auth",
     "django.contrib.contenttypes",
     "sorl.thumbnail",
+    "sorl_thumbnail_avif.thumbnail",
     "tests.test_thumbnails",
 )
 
@@ -4,3 +4,4 @@ from .default import *  # noqa: F403
 THUMBNAIL_FORMAT = "AVIF"
 THUMBNAIL_ENGINE = "sorl_thumbnail_avif.thumbnail.engines.AvifEngine"
 THUMBNAIL_BACKEND = "sorl_thumbnail_avif.thumbnail.AvifThumbnail"
+THUMBNAIL_KVSTORE = "sorl_thumbnail_avif.thumbnail.kvstores.cached_db_kvstore.KVStore"
@@ -5,3 +5,9 @@ from sorl.thumbnail import ImageField
 
 class Item(models.Model):
     image = ImageField(upload_to=True)
+
+
+class DimensionsItem(models.Model):
+    image = ImageField(upload_to=True, width_field="width", height_field="height")
+    width = models.PositiveIntegerField(null=True)
+    height = models.PositiveIntegerField(null=True)
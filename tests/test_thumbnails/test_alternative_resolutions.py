@@ -1,8 +1,9 @@
 import os
+from unittest import mock
 
 import pytest
 
-from sorl.thumbnail import get_thumbnail
+from sorl.thumbnail import default, get_thumbnail
 from sorl.thumbnail.conf import settings
 from sorl.thumbnail.engines.pil_engine import Engine as PILEngine
 from sorl.thumbnail.images import ImageFile
@@ -54,3 +55,20 @@ class AlternativeResolutionsTest(BaseStorageTestCase):
             self.assertEqual(
                 engine.get_image_size(engine.get_image(ImageFile(file_=fp))), (75, 75)
             )
+
+    @pytest.mark.django_db
+    def test_retina_pyramid(self):
+        with mock.patch.object(
+            default.engine, "prepare", wraps=default.engine.prepare
+        ) as prepare, mock.patch.object(
+            default.engine, "resize", wraps=default.engine.resize
+        ) as resize:
+            get_thumbnail(self.image, "40x40")
+
+        self.assertEqual(prepare.call_count, 1)
+        geometries = [call.args[1] for call in resize.call_args_list]
+        self.assertEqual(geometries, [(80, 80), (60, 60), (40, 40)])
+
+        # every resolution is resized from the one before it
+        sizes = [call.args[0].size for call in resize.call_args_list]
+        self.assertEqual(sizes, [(100, 100), (80, 80), (60, 60)])
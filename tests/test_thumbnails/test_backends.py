@@ -1,10 +1,17 @@
+import asyncio
+import hashlib
 import os
 import platform
 import shutil
 import sys
+import tempfile
+import threading
 import unittest
-from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, StringIO
+from unittest import mock
 
+from django.core.files.storage import FileSystemStorage
 from django.test import TestCase
 from django.test.utils import override_settings
 from PIL import Image
@@ -13,12 +20,29 @@ import pytest
 
 from sorl.thumbnail import default, delete, get_thumbnail
 from sorl.thumbnail.conf import settings
-from sorl.thumbnail.helpers import get_module_class
+from sorl.thumbnail.helpers import ThumbnailError, get_module_class
 from sorl.thumbnail.images import ImageFile
+from sorl.thumbnail.kvstores.base import add_prefix
 
 from sorl_thumbnail_avif.thumbnail import AvifThumbnail as ThumbnailBackend
+from sorl_thumbnail_avif.thumbnail.base import prefetching
+from sorl_thumbnail_avif.thumbnail.executors import (
+    DatabaseThreadPoolExecutor,
+    get_process_executor,
+    shutdown_process_executor,
+)
+from sorl_thumbnail_avif.thumbnail.images import (
+    PlaceholderImageFile,
+    StatelessImageFile,
+    existing_thumbnails,
+)
+from sorl_thumbnail_avif.thumbnail.kvstores.base import LocalCache, local_cache
+from sorl_thumbnail_avif.thumbnail.locks import GenerationLocks, generation_locks
+from sorl_thumbnail_avif.thumbnail.queues import ThreadQueue, get_deferred_queue
+from sorl_thumbnail_avif.thumbnail.shortcuts import prefetch_thumbnails
+from sorl_thumbnail_avif.thumbnail.signals import thumbnail_stage
 
-from .models import Item
+from .models import DimensionsItem, Item
 from .utils import BaseTestCase, FakeFile, same_open_fd_count
 
 
@@ -50,6 +74,883 @@ class BackendTest(BaseTestCase):
         self.assertTrue(ImageFile(im2).exists())
 
 
+@pytest.mark.django_db
+class GetThumbnailsTest(BaseTestCase):
+    def test_get_thumbnails(self):
+        item = Item.objects.get(image="500x500.avif")
+        cached = self.BACKEND.get_thumbnail(item.image, "150x150")
+
+        with mock.patch.object(
+            default.engine, "get_image", wraps=default.engine.get_image
+        ) as get_image, mock.patch.object(
+            default.kvstore, "get_many", wraps=default.kvstore.get_many
+        ) as get_many:
+            thumbnails = self.BACKEND.get_thumbnails(
+                item.image, ["50x50", "150x150", "100x200"], crop="center"
+            )
+
+        self.assertEqual(get_image.call_count, 1)
+        self.assertEqual(get_many.call_count, 1)
+        self.assertEqual(
+            [(th.x, th.y) for th in thumbnails], [(50, 50), (150, 150), (100, 200)]
+        )
+        for th in thumbnails:
+            self.assertTrue(th.exists())
+            self.assertEqual(default.kvstore.get(th).size, th.size)
+
+        # same keys as get_thumbnail
+        self.assertNotEqual(thumbnails[1].name, cached.name)
+        self.assertEqual(
+            thumbnails[1].name,
+            self.BACKEND.get_thumbnail(item.image, "150x150", crop="center").name,
+        )
+
+    def test_get_many(self):
+        item = Item.objects.get(image="200x100.avif")
+        th = self.BACKEND.get_thumbnail(item.image, "20x20", crop="center")
+        missing = ImageFile("missing.avif", default.storage)
+
+        self.assertEqual(
+            [
+                cached and cached.size
+                for cached in default.kvstore.get_many([th, missing, th])
+            ],
+            [[20, 20], None, [20, 20]],
+        )
+
+
+@pytest.mark.django_db(transaction=True)
+class AsyncTest(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        # the in memory sqlite test database doesn't take concurrent writers
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        for target in (
+            "sorl_thumbnail_avif.thumbnail.base.get_async_executor",
+            "sorl_thumbnail_avif.thumbnail.kvstores.base.get_async_executor",
+        ):
+            patcher = mock.patch(target, return_value=self.executor)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.executor.shutdown)
+
+    def test_close_old_connections(self):
+        executor = DatabaseThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        with mock.patch(
+            "sorl_thumbnail_avif.thumbnail.executors.close_old_connections"
+        ) as close_old_connections:
+            self.assertEqual(executor.submit(abs, -1).result(), 1)
+            self.assertEqual(close_old_connections.call_count, 2)
+            self.assertEqual(list(executor.map(abs, [-2, -3])), [2, 3])
+            self.assertEqual(close_old_connections.call_count, 6)
+
+    def test_aget_thumbnails(self):
+        item = Item.objects.get(image="500x500.avif")
+        geometries = ["31x31", "32x32", "33x33"]
+
+        async def gather():
+            return await asyncio.gather(
+                *(self.BACKEND.aget_thumbnail(item.image, g) for g in geometries)
+            )
+
+        thumbnails = asyncio.run(gather())
+        self.assertEqual([th.x for th in thumbnails], [31, 32, 33])
+        for th in thumbnails:
+            self.assertTrue(th.exists())
+
+        with mock.patch.object(self.BACKEND, "_create_missing") as create_missing:
+            cached = asyncio.run(self.BACKEND.aget_thumbnails(item.image, geometries))
+        self.assertFalse(create_missing.called)
+        self.assertEqual([th.name for th in cached], [th.name for th in thumbnails])
+
+
+@pytest.mark.django_db
+class GenerationLockTest(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        settings.THUMBNAIL_LOCK_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(settings.THUMBNAIL_LOCK_DIR)
+        del settings.THUMBNAIL_LOCK_DIR
+        super().tearDown()
+
+    def test_locks(self):
+        # another process is another set of locks sharing the lock files
+        locks, other = GenerationLocks(), GenerationLocks()
+
+        self.assertTrue(locks.acquire("key"))
+        self.assertFalse(locks.acquire("key"))
+        self.assertFalse(other.acquire("key"))
+        self.assertTrue(other.acquire("other"))
+        self.assertFalse(other.wait("key", 0.01))
+
+        locks.release("key")
+        self.assertTrue(other.wait("key", 0))
+        self.assertTrue(other.acquire("key"))
+        other.release("key")
+        other.release("other")
+
+    def test_abandoned_lock(self):
+        locks, other = GenerationLocks(), GenerationLocks()
+        self.assertTrue(locks.acquire("key"))
+        os.utime(locks._get_path("key"), (0, 0))
+
+        self.assertTrue(other.wait("key", 0))
+        self.assertTrue(other.acquire("key"))
+        other.release("key")
+
+    def test_lock_dir_error(self):
+        locks = GenerationLocks()
+        with mock.patch("os.write", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                locks.acquire("key")
+        self.assertFalse(os.path.exists(locks._get_path("key")))
+
+        self.assertTrue(locks.acquire("key"))
+        locks.release("key")
+
+    def test_releases_after_acquire_error(self):
+        item = Item.objects.get(image="500x500.avif")
+        acquire = generation_locks.acquire
+        keys = []
+
+        def fail_second(key):
+            if keys:
+                raise OSError("read-only file system")
+            keys.append(key)
+            return acquire(key)
+
+        with mock.patch.object(generation_locks, "acquire", side_effect=fail_second):
+            with self.assertRaises(OSError):
+                self.BACKEND.get_thumbnails(item.image, ["97x97", "98x98"])
+        self.assertTrue(generation_locks.acquire(keys[0]))
+        generation_locks.release(keys[0])
+
+    def test_taken_over_lock(self):
+        locks, other = GenerationLocks(), GenerationLocks()
+        self.assertTrue(locks.acquire("key"))
+        os.utime(locks._get_path("key"), (0, 0))
+        self.assertTrue(other.acquire("key"))
+
+        # the slow owner is done, the lock of the other process stays
+        locks.release("key")
+        self.assertTrue(os.path.exists(other._get_path("key")))
+        self.assertFalse(locks.acquire("key"))
+
+        other.release("key")
+        self.assertFalse(os.path.exists(other._get_path("key")))
+        self.assertTrue(locks.acquire("key"))
+        locks.release("key")
+
+    def _lock_elsewhere(self, image, geometry_string, **options):
+        """
+        Takes the lock for the thumbnail like another process creating it
+        would, and releases it shortly after.
+        """
+        _, _, (thumbnail,) = self.BACKEND._get_thumbnail_files(
+            image, [geometry_string], options
+        )
+        other = GenerationLocks()
+        self.assertTrue(other.acquire(thumbnail.key))
+        timer = threading.Timer(0.1, other.release, [thumbnail.key])
+        timer.start()
+        self.addCleanup(timer.join)
+        return thumbnail
+
+    def test_reuses_result(self):
+        item = Item.objects.get(image="500x500.avif")
+        thumbnail = self._lock_elsewhere(item.image, "39x39")
+
+        with mock.patch.object(
+            self.BACKEND, "_get_cached_thumbnails", side_effect=[[None], [thumbnail]]
+        ), mock.patch.object(self.BACKEND, "_render_source") as render_source:
+            th = self.BACKEND.get_thumbnail(item.image, "39x39")
+
+        self.assertIs(th, thumbnail)
+        self.assertFalse(render_source.called)
+
+    def test_creates_after_failed_wait(self):
+        item = Item.objects.get(image="500x500.avif")
+        self._lock_elsewhere(item.image, "41x41")
+
+        with mock.patch.object(
+            self.BACKEND, "_render_source", wraps=self.BACKEND._render_source
+        ) as render_source:
+            th = self.BACKEND.get_thumbnail(item.image, "41x41")
+
+        self.assertEqual(render_source.call_count, 1)
+        self.assertTrue(th.exists())
+
+    def test_formats(self):
+        self.create_image("locked_formats.jpg", (100, 100))
+        self._lock_elsewhere("locked_formats.jpg", "99x99", format="JPEG")
+
+        with mock.patch.object(
+            self.BACKEND, "_render_source", wraps=self.BACKEND._render_source
+        ) as render_source:
+            thumbnails = self.BACKEND.get_thumbnail_formats(
+                "locked_formats.jpg", "99x99", ["AVIF", "JPEG"]
+            )
+
+        # the locked format is only created after waiting for it
+        self.assertEqual(
+            [call.args[3] for call in render_source.call_args_list],
+            [["AVIF"], ["JPEG"]],
+        )
+        for th in thumbnails:
+            self.assertTrue(th.exists())
+
+
+@pytest.mark.django_db(transaction=True)
+class DeferredTest(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        settings.THUMBNAIL_DEFERRED = True
+
+    def tearDown(self):
+        del settings.THUMBNAIL_DEFERRED
+        super().tearDown()
+
+    def test_placeholder(self):
+        item = Item.objects.get(image="500x500.avif")
+
+        th = self.BACKEND.get_thumbnail(item.image, "43x43")
+        self.assertIsInstance(th, PlaceholderImageFile)
+        self.assertEqual(th.url, item.image.url)
+        self.assertEqual(th.size, (43, 43))
+
+        get_deferred_queue().join()
+        th = self.BACKEND.get_thumbnail(item.image, "43x43")
+        self.assertNotIsInstance(th, PlaceholderImageFile)
+        self.assertTrue(th.exists())
+
+        # the source size is known now
+        placeholder = self.BACKEND.get_thumbnail(item.image, "60x30")
+        self.assertEqual(placeholder.size, (30, 30))
+        get_deferred_queue().join()
+        th = self.BACKEND.get_thumbnail(item.image, "60x30")
+        self.assertEqual(th.size, [30, 30])
+
+    def test_formats(self):
+        self.create_image("deferred_formats.jpg", (100, 100))
+
+        thumbnails = self.BACKEND.get_thumbnail_formats(
+            "deferred_formats.jpg", "99x99", ["AVIF", "JPEG"]
+        )
+        for th in thumbnails:
+            self.assertIsInstance(th, PlaceholderImageFile)
+
+        get_deferred_queue().join()
+        thumbnails = self.BACKEND.get_thumbnail_formats(
+            "deferred_formats.jpg", "99x99", ["AVIF", "JPEG"]
+        )
+        self.assertEqual(
+            [os.path.splitext(th.name)[1] for th in thumbnails], [".avif", ".jpg"]
+        )
+        self.assertIsNotNone(
+            default.kvstore._get(thumbnails[0].key, identity="formats")
+        )
+
+    def test_enqueued_once(self):
+        item = Item.objects.get(image="500x500.avif")
+        queue = ThreadQueue()
+        with mock.patch(
+            "sorl_thumbnail_avif.thumbnail.base.get_deferred_queue",
+            return_value=queue,
+        ), mock.patch.object(queue, "_work"):
+            self.BACKEND.get_thumbnail(item.image, "44x44")
+            self.BACKEND.get_thumbnail(item.image, "44x44")
+        self.assertEqual(queue._queue.qsize(), 1)
+
+
+@pytest.mark.django_db
+class StatelessTest(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        settings.THUMBNAIL_STATELESS = True
+
+    def tearDown(self):
+        del settings.THUMBNAIL_STATELESS
+        super().tearDown()
+
+    def test_no_lookup(self):
+        item = Item.objects.get(image="500x500.avif")
+        created = self.BACKEND.get_thumbnail(item.image, "51x51")
+        self.assertTrue(created.exists())
+
+        with mock.patch.object(
+            default.kvstore, "_get_raw"
+        ) as get_raw, mock.patch.object(
+            default.kvstore, "_get_many_raw"
+        ) as get_many_raw, mock.patch.object(
+            created.storage, "exists", wraps=created.storage.exists
+        ) as exists:
+            th = self.BACKEND.get_thumbnail(item.image, "51x51")
+            th2 = self.BACKEND.get_thumbnail(item.image, "51x51")
+        self.assertIsInstance(th, StatelessImageFile)
+        self.assertEqual(th.name, created.name)
+        self.assertEqual(th2.url, created.url)
+        get_raw.assert_not_called()
+        get_many_raw.assert_not_called()
+        # checked once, known afterwards
+        self.assertEqual(exists.call_count, 1)
+
+        # read from the file when used
+        self.assertEqual(th.size, [51, 51])
+
+    def test_expected_size(self):
+        item = Item.objects.get(image="500x500.avif")
+        self.BACKEND.get_thumbnail(item.image, "53x30")
+        with mock.patch.object(
+            self.BACKEND, "_get_source_size", return_value=(500, 500)
+        ):
+            th = self.BACKEND.get_thumbnail(item.image, "53x30")
+        self.assertIsInstance(th, StatelessImageFile)
+        # worked out without reading the file
+        self.assertEqual(th._size, [30, 30])
+
+    def test_dimension_fields(self):
+        item = DimensionsItem.objects.create(image="500x500.avif")
+        self.assertEqual((item.width, item.height), (500, 500))
+
+        created = self.BACKEND.get_thumbnail_formats(item.image, "89x89")
+        for _ in range(2):
+            thumbnails = self.BACKEND.get_thumbnail_formats(item.image, "89x89")
+            self.assertEqual(
+                [th.name for th in thumbnails], [th.name for th in created]
+            )
+            # worked out from the dimension fields
+            self.assertEqual([th._size for th in thumbnails], [[89, 89]] * 3)
+
+    def test_timeout(self):
+        existing_thumbnails.add("timeout.avif")
+        self.assertIn("timeout.avif", existing_thumbnails)
+        settings.THUMBNAIL_STATELESS_CACHE_TIMEOUT = 0
+        try:
+            existing_thumbnails.add("timeout.avif")
+            self.assertNotIn("timeout.avif", existing_thumbnails)
+        finally:
+            del settings.THUMBNAIL_STATELESS_CACHE_TIMEOUT
+
+    def test_source_size(self):
+        field = mock.Mock(width_field="w", height_field="h")
+        file_ = mock.Mock(field=field, instance=mock.Mock(w=640, h=480))
+        self.assertEqual(self.BACKEND._get_source_size(file_), (640, 480))
+        file_.instance.w = None
+        self.assertIsNone(self.BACKEND._get_source_size(file_))
+        self.assertIsNone(self.BACKEND._get_source_size("500x500.avif"))
+
+    def test_deleted(self):
+        self.create_image("stateless.jpg", (100, 100))
+        th = self.BACKEND.get_thumbnail("stateless.jpg", "40x40")
+        self.assertIsInstance(
+            self.BACKEND.get_thumbnail("stateless.jpg", "40x40"), StatelessImageFile
+        )
+
+        self.create_image("stateless_other.jpg", (100, 100))
+        other = self.BACKEND.get_thumbnail("stateless_other.jpg", "40x40")
+        self.BACKEND.get_thumbnail("stateless_other.jpg", "40x40")
+        self.assertIn(other.name, existing_thumbnails)
+
+        delete("stateless.jpg", delete_file=False)
+        self.assertNotIn(th.name, existing_thumbnails)
+        # the thumbnails of other sources are still known
+        self.assertIn(other.name, existing_thumbnails)
+        self.assertFalse(th.exists())
+        th = self.BACKEND.get_thumbnail("stateless.jpg", "40x40")
+        self.assertNotIsInstance(th, StatelessImageFile)
+        self.assertTrue(th.exists())
+
+
+@pytest.mark.django_db
+class ContentKeyTest(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        settings.THUMBNAIL_CONTENT_KEYS = True
+        for name in ("copy1.avif", "copy2.avif"):
+            shutil.copy(
+                os.path.join(settings.MEDIA_ROOT, "500x500.avif"),
+                os.path.join(settings.MEDIA_ROOT, name),
+            )
+
+    def tearDown(self):
+        del settings.THUMBNAIL_CONTENT_KEYS
+        super().tearDown()
+
+    def test_copies_share_thumbnails(self):
+        th1 = self.BACKEND.get_thumbnail("copy1.avif", "57x57")
+        with mock.patch.object(
+            self.BACKEND, "_render_source", wraps=self.BACKEND._render_source
+        ) as render_source:
+            th2 = self.BACKEND.get_thumbnail("copy2.avif", "57x57")
+        render_source.assert_not_called()
+        self.assertEqual(th1.name, th2.name)
+
+        self.create_image("different.avif", (100, 100))
+        th3 = self.BACKEND.get_thumbnail("different.avif", "57x57")
+        self.assertNotEqual(th3.name, th1.name)
+
+    def test_hashed_once(self):
+        with open(os.path.join(settings.MEDIA_ROOT, "copy1.avif"), "rb") as f:
+            content_key = hashlib.sha256(f.read()).hexdigest()
+        self.assertEqual(self.BACKEND.get_content_key("copy1.avif"), content_key)
+
+        with mock.patch.object(hashlib, "sha256") as sha256:
+            self.assertEqual(self.BACKEND.get_content_key("copy1.avif"), content_key)
+        sha256.assert_not_called()
+
+    def test_missing_source(self):
+        th = self.BACKEND.get_thumbnail("missing.jpg", "57x57")
+        self.assertFalse(th.exists())
+
+
+@pytest.mark.django_db
+class LocalCacheTest(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        settings.THUMBNAIL_LOCAL_CACHE_SIZE = 10000
+
+    def tearDown(self):
+        if hasattr(settings, "THUMBNAIL_LOCAL_CACHE_SIZE"):
+            del settings.THUMBNAIL_LOCAL_CACHE_SIZE
+        super().tearDown()
+
+    def test_no_round_trip(self):
+        self.create_image("local.jpg", (100, 100))
+        th = self.BACKEND.get_thumbnail("local.jpg", "73x73")
+        hits = local_cache.hits
+
+        with mock.patch.object(
+            default.kvstore.cache, "get_many", wraps=default.kvstore.cache.get_many
+        ) as cache_get_many:
+            cached = self.BACKEND.get_thumbnail("local.jpg", "73x73")
+        self.assertEqual(cached.name, th.name)
+        cache_get_many.assert_not_called()
+        self.assertEqual(local_cache.hits, hits + 1)
+
+    def test_delete(self):
+        self.create_image("local_delete.jpg", (100, 100))
+        th = self.BACKEND.get_thumbnail("local_delete.jpg", "73x73")
+        self.assertIsNotNone(default.kvstore.get(th))
+
+        delete("local_delete.jpg", delete_file=False)
+        self.assertIsNone(default.kvstore.get(th))
+        self.assertIsNone(local_cache.get(add_prefix(th.key)))
+
+    def test_disabled(self):
+        del settings.THUMBNAIL_LOCAL_CACHE_SIZE
+        self.create_image("local_disabled.jpg", (100, 100))
+        th = self.BACKEND.get_thumbnail("local_disabled.jpg", "73x73")
+        misses = local_cache.misses
+        self.assertEqual(default.kvstore.get(th).name, th.name)
+        self.assertEqual(local_cache.misses, misses)
+
+    def test_eviction(self):
+        cache = LocalCache()
+        settings.THUMBNAIL_LOCAL_CACHE_SIZE = 2
+        try:
+            cache.set("a", "1")
+            cache.set("b", "2")
+            self.assertEqual(cache.get("a"), "1")
+            cache.set("c", "3")
+            self.assertIsNone(cache.get("b"))
+            self.assertEqual(cache.get("a"), "1")
+            self.assertEqual(len(cache), 2)
+            self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+            settings.THUMBNAIL_LOCAL_CACHE_TIMEOUT = 0
+            cache.set("d", "4")
+            self.assertIsNone(cache.get("d"))
+        finally:
+            if hasattr(settings, "THUMBNAIL_LOCAL_CACHE_TIMEOUT"):
+                del settings.THUMBNAIL_LOCAL_CACHE_TIMEOUT
+
+
+@pytest.mark.django_db(transaction=True)
+class PrefetchTest(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        # the in memory sqlite test database doesn't take concurrent writers
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        patcher = mock.patch(
+            "sorl_thumbnail_avif.thumbnail.base.get_async_executor",
+            return_value=self.executor,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.executor.shutdown)
+
+    def test_prefetch_thumbnails(self):
+        items = list(Item.objects.order_by("pk")) + [Item(image="")]
+        with mock.patch.object(
+            self.executor, "map", wraps=self.executor.map
+        ) as executor_map:
+            thumbnails = prefetch_thumbnails(items, "image", "79x79", crop="center")
+        self.assertEqual(executor_map.call_count, 1)
+        self.assertIsNone(thumbnails[-1])
+        self.assertEqual([(th.x, th.y) for th in thumbnails[:-1]], [(79, 79)] * 3)
+
+        with mock.patch.object(self.BACKEND, "_create_missing") as create_missing:
+            cached = prefetch_thumbnails(items, "image", "79x79", crop="center")
+        create_missing.assert_not_called()
+        self.assertEqual(
+            [th.name for th in cached[:-1]], [th.name for th in thumbnails[:-1]]
+        )
+
+    def test_prefetching(self):
+        item = Item.objects.get(image="500x500.avif")
+        with prefetching():
+            (thumbnails,) = self.BACKEND.prefetch_thumbnails(
+                [item.image], ["81x81", "83x83"]
+            )
+            with mock.patch.object(default.kvstore, "get_many") as get_many:
+                th = self.BACKEND.get_thumbnail(item.image, "83x83")
+            get_many.assert_not_called()
+            self.assertEqual(th, thumbnails[1])
+
+        with mock.patch.object(
+            default.kvstore, "get_many", wraps=default.kvstore.get_many
+        ) as get_many:
+            self.BACKEND.get_thumbnail(item.image, "83x83")
+        get_many.assert_called_once()
+
+
+@pytest.mark.django_db(transaction=True)
+class BulkTest(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        # the in memory sqlite test database doesn't take concurrent writers
+        settings.THUMBNAIL_BULK_WORKERS = 1
+        settings.THUMBNAIL_BULK_CHUNK_SIZE = 2
+
+    def tearDown(self):
+        del settings.THUMBNAIL_BULK_WORKERS
+        del settings.THUMBNAIL_BULK_CHUNK_SIZE
+        super().tearDown()
+
+    def test_get_thumbnails_bulk(self):
+        images = [item.image for item in Item.objects.order_by("pk")]
+        files = images + ["", images[0]]
+
+        with mock.patch.object(
+            default.kvstore, "set_many", wraps=default.kvstore.set_many
+        ) as set_many:
+            results = list(self.BACKEND.get_thumbnails_bulk(files, "85x85"))
+        self.assertEqual([file_ for file_, _ in results], files)
+        self.assertIsNone(results[3][1])
+        self.assertEqual(results[4][1].name, results[0][1].name)
+        # the last chunk only has the thumbnail created in the first one
+        self.assertEqual(set_many.call_count, 2)
+
+        for _, th in results[:3]:
+            self.assertEqual(default.kvstore.get(th).size, th.size)
+            self.assertTrue(th.exists())
+        self.assertEqual(
+            [(th.x, th.y) for _, th in results[:3]], [(85, 85), (85, 85), (85, 42)]
+        )
+
+        with mock.patch.object(
+            self.BACKEND, "_create_bulk_thumbnail"
+        ) as create_bulk_thumbnail:
+            cached = list(self.BACKEND.get_thumbnails_bulk(files, "85x85"))
+        create_bulk_thumbnail.assert_not_called()
+        self.assertEqual(
+            [th and th.name for _, th in cached], [th and th.name for _, th in results]
+        )
+
+    def test_failed_file(self):
+        self.create_image("bulk_failed.jpg", (100, 100))
+        self.create_image("bulk_written.jpg", (100, 100))
+        write_thumbnails = self.BACKEND._write_thumbnails
+
+        def fail_one(thumbnail, outputs):
+            if thumbnail.key == failed.key:
+                raise OSError("disk full")
+            write_thumbnails(thumbnail, outputs)
+
+        _, _, (failed,) = self.BACKEND._get_thumbnail_files(
+            "bulk_failed.jpg", ["95x95"], {}
+        )
+        with mock.patch.object(
+            self.BACKEND, "_write_thumbnails", side_effect=fail_one
+        ), mock.patch.object(
+            default.kvstore, "set_many", wraps=default.kvstore.set_many
+        ) as set_many:
+            results = list(
+                self.BACKEND.get_thumbnails_bulk(
+                    ["bulk_failed.jpg", "bulk_written.jpg"], "95x95"
+                )
+            )
+
+        (_, th_failed), (_, th_written) = results
+        self.assertEqual(th_failed.name, failed.name)
+        self.assertIsNone(default.kvstore.get(th_failed))
+        ((thumbnails, _),) = [call.args for call in set_many.call_args_list]
+        self.assertEqual([th.name for th in thumbnails], [th_written.name])
+        self.assertEqual(default.kvstore.get(th_written).size, th_written.size)
+
+    def test_source_registered(self):
+        self.create_image("bulk.jpg", (100, 100))
+        ((_, th),) = self.BACKEND.get_thumbnails_bulk(["bulk.jpg"], "85x85")
+        source = ImageFile("bulk.jpg")
+        self.assertEqual(default.kvstore.get(source).size, [100, 100])
+        self.assertIn(th.key, default.kvstore._get(source.key, identity="thumbnails"))
+
+        delete("bulk.jpg", delete_file=False)
+        self.assertFalse(th.exists())
+
+
+@pytest.mark.django_db
+class ThumbnailFormatsTest(BaseTestCase):
+    def test_get_thumbnail_formats(self):
+        item = Item.objects.get(image="500x500.avif")
+
+        with mock.patch.object(
+            default.engine, "get_image", wraps=default.engine.get_image
+        ) as get_image, mock.patch.object(
+            default.engine, "encode", wraps=default.engine.encode
+        ) as encode:
+            thumbnails = self.BACKEND.get_thumbnail_formats(item.image, "70x70")
+
+        self.assertEqual(get_image.call_count, 1)
+        self.assertEqual(encode.call_count, 3)
+        self.assertEqual(
+            [os.path.splitext(th.name)[1] for th in thumbnails],
+            [".avif", ".webp", ".jpg"],
+        )
+        for th, format_ in zip(thumbnails, ["AVIF", "WEBP", "JPEG"]):
+            self.assertEqual(th.size, [70, 70])
+            with Image.open(th.storage.open(th.name)) as im:
+                self.assertEqual(im.format, format_)
+
+        # a single lookup once stored
+        with mock.patch.object(
+            self.BACKEND, "_render_source"
+        ) as render_source, mock.patch.object(
+            default.kvstore, "_get_raw", wraps=default.kvstore._get_raw
+        ) as get_raw:
+            cached = self.BACKEND.get_thumbnail_formats(item.image, "70x70")
+        self.assertFalse(render_source.called)
+        self.assertEqual(get_raw.call_count, 1)
+        self.assertEqual([th.name for th in cached], [th.name for th in thumbnails])
+        self.assertEqual([th.size for th in cached], [th.size for th in thumbnails])
+
+        delete(item.image, delete_file=False)
+        self.assertIsNone(default.kvstore._get(thumbnails[0].key, identity="formats"))
+
+    def test_other_formats(self):
+        self.create_image("formats.jpg", (100, 100))
+        first = self.BACKEND.get_thumbnail_formats(
+            "formats.jpg", "87x87", ["AVIF", "JPEG"]
+        )
+
+        with mock.patch.object(
+            default.engine, "encode", wraps=default.engine.encode
+        ) as encode:
+            thumbnails = self.BACKEND.get_thumbnail_formats(
+                "formats.jpg", "87x87", ["AVIF", "WEBP", "PNG"]
+            )
+        # the AVIF file is there already
+        self.assertEqual(encode.call_count, 2)
+        self.assertEqual(
+            [os.path.splitext(th.name)[1] for th in thumbnails],
+            [".avif", ".webp", ".png"],
+        )
+        self.assertEqual(thumbnails[0].name, first[0].name)
+
+        cached = self.BACKEND.get_thumbnail_formats(
+            "formats.jpg", "87x87", ["AVIF", "JPEG"]
+        )
+        self.assertEqual([th.name for th in cached], [th.name for th in first])
+
+    def test_unsupported_format(self):
+        item = Item.objects.get(image="500x500.avif")
+        with self.assertRaises(ValueError):
+            self.BACKEND.get_thumbnail_formats(item.image, "87x87", ["AVIF", "TIFF"])
+
+    def test_transparent_jpeg(self):
+        self.create_image("transparent.png", (80, 80), transparent=True)
+        thumbnails = self.BACKEND.get_thumbnail_formats(
+            "transparent.png", "40x40", ["png", "jpeg"]
+        )
+        self.assertEqual([th.size for th in thumbnails], [[40, 40], [40, 40]])
+        self.assertTrue(self.is_transparent(self.ENGINE.get_image(thumbnails[0])))
+        self.assertEqual(self.ENGINE.get_image(thumbnails[1]).mode, "RGB")
+
+
+@pytest.mark.django_db
+class InvalidSourceTest(BaseTestCase):
+    def test_invalid_source_remembered(self):
+        name = "data/broken.jpeg"
+        source = ImageFile(name)
+
+        th = self.BACKEND.get_thumbnail(name, "20x20")
+        self.assertFalse(th.exists())
+        self.assertTrue(default.kvstore._get(source.key, identity="invalid"))
+
+        with mock.patch.object(
+            default.engine, "get_image", wraps=default.engine.get_image
+        ) as get_image:
+            th = self.BACKEND.get_thumbnail(name, "20x20")
+        self.assertFalse(get_image.called)
+        self.assertFalse(th.exists())
+
+        delete(name, delete_file=False)
+        self.assertIsNone(default.kvstore._get(source.key, identity="invalid"))
+
+    def test_invalid_source_timeout(self):
+        name = "data/broken.jpeg"
+        self.BACKEND.get_thumbnail(name, "20x20")
+
+        settings.THUMBNAIL_INVALID_SOURCE_TIMEOUT = 0
+        try:
+            with mock.patch.object(
+                default.engine, "get_image", wraps=default.engine.get_image
+            ) as get_image:
+                self.BACKEND.get_thumbnail(name, "20x20")
+            self.assertTrue(get_image.called)
+        finally:
+            del settings.THUMBNAIL_INVALID_SOURCE_TIMEOUT
+
+    def test_read_error_not_remembered(self):
+        self.create_image("flaky.jpg", (100, 100))
+        source = ImageFile("flaky.jpg")
+        storage_open = default.storage.open
+        calls = []
+
+        def flaky_open(name, *args, **kwargs):
+            if name == "flaky.jpg" and not calls:
+                calls.append(name)
+                raise OSError("Connection reset by peer")
+            return storage_open(name, *args, **kwargs)
+
+        with mock.patch.object(default.storage, "open", side_effect=flaky_open):
+            th = self.BACKEND.get_thumbnail("flaky.jpg", "20x20")
+            self.assertFalse(th.exists())
+            self.assertIsNone(default.kvstore._get(source.key, identity="invalid"))
+
+            th = self.BACKEND.get_thumbnail("flaky.jpg", "20x20")
+        self.assertTrue(th.exists())
+        self.assertEqual(th.size, [20, 20])
+
+    def test_memory_error_propagates(self):
+        self.create_image("memory.jpg", (100, 100))
+        with mock.patch.object(default.engine, "get_image", side_effect=MemoryError):
+            with self.assertRaises(MemoryError):
+                self.BACKEND.get_thumbnail("memory.jpg", "20x20")
+        source = ImageFile("memory.jpg")
+        self.assertIsNone(default.kvstore._get(source.key, identity="invalid"))
+
+    def test_header_validation(self):
+        buffer = BytesIO()
+        Image.new("RGB", (50, 50)).save(buffer, "PNG")
+        truncated = buffer.getvalue()[:-30]
+
+        self.assertFalse(self.ENGINE.is_valid_image(truncated))
+        settings.THUMBNAIL_VALIDATION = "header"
+        try:
+            self.assertTrue(self.ENGINE.is_valid_image(truncated))
+            self.assertFalse(self.ENGINE.is_valid_image(truncated[:10]))
+        finally:
+            del settings.THUMBNAIL_VALIDATION
+
+
+@pytest.mark.django_db
+class ProcessPoolTest(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        settings.THUMBNAIL_PROCESS_POOL_WORKERS = 1
+        settings.THUMBNAIL_PROCESS_POOL_CONTEXT = "fork"
+
+    def tearDown(self):
+        shutdown_process_executor()
+        del settings.THUMBNAIL_PROCESS_POOL_WORKERS
+        del settings.THUMBNAIL_PROCESS_POOL_CONTEXT
+        super().tearDown()
+
+    def test_render_in_process_pool(self):
+        item = Item.objects.get(image="500x500.avif")
+        with mock.patch.object(
+            default.engine, "get_image", wraps=default.engine.get_image
+        ) as get_image:
+            thumbnails = self.BACKEND.get_thumbnails(item.image, ["37x37", "74x74"])
+
+        # decoded in the worker
+        self.assertFalse(get_image.called)
+        self.assertEqual([th.size for th in thumbnails], [[37, 37], [74, 74]])
+        for th in thumbnails:
+            self.assertTrue(th.exists())
+            self.assertEqual(
+                list(self.ENGINE.get_image_size(self.ENGINE.get_image(th))), th.size
+            )
+
+    def test_stages(self):
+        item = Item.objects.get(image="500x500.avif")
+        stages = []
+
+        def receiver(sender, stage, **kwargs):
+            stages.append((sender, stage, os.getpid()))
+
+        thumbnail_stage.connect(receiver)
+        try:
+            self.BACKEND.get_thumbnail(item.image, "101x101")
+        finally:
+            thumbnail_stage.disconnect(receiver)
+
+        # the stages of the worker are sent in this process
+        names = {stage for _, stage, _ in stages}
+        self.assertTrue({"decode", "scale", "encode", "source"} <= names)
+        self.assertEqual({pid for _, _, pid in stages}, {os.getpid()})
+        self.assertIn((ThumbnailBackend, "decode", os.getpid()), stages)
+
+    def test_invalid_source(self):
+        name = "data/broken.jpeg"
+        th = self.BACKEND.get_thumbnail(name, "21x21")
+        self.assertFalse(th.exists())
+        self.assertTrue(default.kvstore._get(ImageFile(name).key, identity="invalid"))
+        delete(name, delete_file=False)
+
+    def test_timeout(self):
+        self.create_image("pool_timeout.jpg", (100, 100))
+        settings.THUMBNAIL_PROCESS_POOL_TIMEOUT = 0
+        try:
+            with self.assertRaisesRegex(ThumbnailError, "timed out"):
+                self.BACKEND.get_thumbnail("pool_timeout.jpg", "39x39")
+        finally:
+            del settings.THUMBNAIL_PROCESS_POOL_TIMEOUT
+        source = ImageFile("pool_timeout.jpg")
+        self.assertIsNone(default.kvstore._get(source.key, identity="invalid"))
+
+    def test_worker_error(self):
+        self.create_image("pool_error.jpg", (100, 100))
+        # the worker is forked with the patch
+        with mock.patch.object(default.engine, "get_image", side_effect=MemoryError):
+            with self.assertRaises(MemoryError):
+                self.BACKEND.get_thumbnail("pool_error.jpg", "39x39")
+        source = ImageFile("pool_error.jpg")
+        self.assertIsNone(default.kvstore._get(source.key, identity="invalid"))
+
+    def test_queue_full(self):
+        item = Item.objects.get(image="500x500.avif")
+        settings.THUMBNAIL_PROCESS_POOL_QUEUE_SIZE = 1
+        settings.THUMBNAIL_PROCESS_POOL_TIMEOUT = 0.01
+        try:
+            executor, slots = get_process_executor()
+            slots.acquire()
+            with self.assertRaisesRegex(ThumbnailError, "queue is full"):
+                self.BACKEND.get_thumbnail(item.image, "38x38")
+            slots.release()
+            # a busy pool says nothing about the source
+            self.assertIsNone(
+                default.kvstore._get(ImageFile(item.image).key, identity="invalid")
+            )
+        finally:
+            del settings.THUMBNAIL_PROCESS_POOL_QUEUE_SIZE
+            del settings.THUMBNAIL_PROCESS_POOL_TIMEOUT
+
+
 @override_settings(THUMBNAIL_PRESERVE_FORMAT=True, THUMBNAIL_FORMAT="XXX")
 class PreserveFormatTest(TestCase):
     def setUp(self):
@@ -99,6 +1000,22 @@ class TestDescriptors(unittest.TestCase):
             with self.assertRaises(IOError):
                 self.ENGINE.get_image(source)
 
+    def test_cleanup_closes_source(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        Image.new("RGB", (20, 20)).save(os.path.join(location, "cleanup.jpg"))
+        source = ImageFile("cleanup.jpg", FileSystemStorage(location=location))
+
+        with same_open_fd_count(self):
+            image = self.ENGINE.get_image(source)
+            self.ENGINE.load(image)
+            self.ENGINE.cleanup(image)
+        # only the size was needed
+        with same_open_fd_count(self):
+            image = self.ENGINE.get_image(source)
+            self.ENGINE.get_image_size(image)
+            self.ENGINE.cleanup(image)
+
     def test_is_valid_image(self):
         with same_open_fd_count(self):
             self.ENGINE.is_valid_image(b"invalidbinaryimage.jpg")
@@ -0,0 +1,35 @@
+import unittest
+
+from benchmarks.engine import compare, get_cases, percentile, run_case
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_percentile(self):
+        self.assertEqual(percentile([3, 1, 2, 4], 50), 2.5)
+        self.assertEqual(percentile([1, 2, 3], 100), 3)
+
+    def test_run_case(self):
+        index = [name for name, _, _ in get_cases()].index("encode/jpeg/400x300")
+        name, result = run_case(index, repeat=2, warmup=0)
+        self.assertEqual(name, "encode/jpeg/400x300")
+        self.assertEqual(result["runs"], 2)
+        self.assertLessEqual(result["p50_ms"], result["p99_ms"])
+
+    def test_compare(self):
+        baseline = {
+            "results": {
+                "a": {"p50_ms": 10, "peak_memory_bytes": 100},
+                "b": {"p50_ms": 10, "peak_memory_bytes": 0},
+            }
+        }
+        current = {
+            "results": {
+                "a": {"p50_ms": 10.5, "peak_memory_bytes": 200},
+                "b": {"p50_ms": 20, "peak_memory_bytes": 100},
+                "c": {"p50_ms": 1, "peak_memory_bytes": 1},
+            }
+        }
+        self.assertEqual(
+            [(name, metric) for name, metric, *_ in compare(baseline, current, 0.1)],
+            [("a", "peak_memory_bytes"), ("b", "p50_ms")],
+        )
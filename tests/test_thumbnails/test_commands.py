@@ -0,0 +1,220 @@
+import json
+import os
+import tempfile
+import time
+from io import StringIO
+from unittest import mock
+
+import pytest
+from django.core.management import CommandError, call_command
+from django.db import connections
+
+from sorl.thumbnail import default
+from sorl.thumbnail.conf import settings
+from sorl.thumbnail.images import ImageFile
+
+from .models import Item
+from .utils import BaseTestCase
+
+
+@pytest.mark.django_db
+class ThumbnailShardTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        settings.THUMBNAIL_ALTERNATIVE_RESOLUTIONS = [2]
+
+    def tearDown(self):
+        del settings.THUMBNAIL_ALTERNATIVE_RESOLUTIONS
+        if hasattr(settings, "THUMBNAIL_DIRECTORY_SHARDS"):
+            del settings.THUMBNAIL_DIRECTORY_SHARDS
+        super().tearDown()
+
+    def test_thumbnail_path(self):
+        key = "0123456789abcdef0123456789abcdef"
+        self.assertEqual(self.BACKEND._get_thumbnail_path(key), "0123" + key)
+        settings.THUMBNAIL_DIRECTORY_SHARDS = (2, 2)
+        self.assertEqual(self.BACKEND._get_thumbnail_path(key), "01/23/" + key)
+        settings.THUMBNAIL_DIRECTORY_SHARDS = (1,)
+        self.assertEqual(self.BACKEND._get_thumbnail_path(key), "0/" + key)
+
+    def test_migrate(self):
+        self.create_image("shard.jpg", (100, 100))
+        image = ImageFile("shard.jpg")
+        flat = self.BACKEND.get_thumbnail(image, "29x29")
+        self.assertNotIn("/", flat.name[len(settings.THUMBNAIL_PREFIX) :])
+
+        settings.THUMBNAIL_DIRECTORY_SHARDS = (2, 2)
+        out = StringIO()
+        call_command("thumbnail_shard", "--dry-run", stdout=out)
+        self.assertEqual(out.getvalue(), "Would move 1 thumbnails\n")
+        self.assertTrue(flat.exists())
+
+        out = StringIO()
+        call_command("thumbnail_shard", "--batch-size=1", verbosity=2, stdout=out)
+        self.assertIn("1 sources\n", out.getvalue())
+        self.assertIn("Moved 1 thumbnails", out.getvalue())
+
+        sharded = self.BACKEND.get_thumbnail(image, "29x29")
+        key = flat.name[len(settings.THUMBNAIL_PREFIX) + 4 : -len(".avif")]
+        self.assertEqual(
+            sharded.name,
+            "%s%s/%s/%s.avif" % (settings.THUMBNAIL_PREFIX, key[:2], key[2:4], key),
+        )
+        self.assertEqual(sharded.size, flat.size)
+        self.assertFalse(flat.exists())
+        self.assertTrue(sharded.exists())
+        self.assertTrue(sharded.storage.exists(sharded.name.replace(".", "@2x.")))
+
+        source_keys = default.kvstore._get(ImageFile(image).key, identity="thumbnails")
+        self.assertIn(sharded.key, source_keys)
+        self.assertNotIn(flat.key, source_keys)
+        self.assertIsNone(default.kvstore._get(flat.key))
+
+        # nothing left to move
+        out = StringIO()
+        call_command("thumbnail_shard", stdout=out)
+        self.assertEqual(out.getvalue(), "Moved 0 thumbnails\n")
+
+
+@pytest.mark.django_db
+class ThumbnailPrewarmTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        fd, self.checkpoint = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        os.remove(self.checkpoint)
+
+    def tearDown(self):
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        super().tearDown()
+
+    def prewarm(self, *args, workers=0):
+        out = StringIO()
+        call_command(
+            "thumbnail_prewarm",
+            "test_thumbnails.Item.image",
+            *args,
+            "--workers=%d" % workers,
+            "--checkpoint",
+            self.checkpoint,
+            stdout=out,
+        )
+        return out.getvalue()
+
+    def test_prewarm(self):
+        out = self.prewarm("63x63", "65x65", "-o", "quality=70")
+        self.assertIn(
+            "Done: 3 sources, 6 thumbnails created, 0 already there, 0 failed", out
+        )
+
+        item = Item.objects.get(image="500x500.avif")
+        with mock.patch.object(
+            self.BACKEND, "_render_source", wraps=self.BACKEND._render_source
+        ) as render_source:
+            th = self.BACKEND.get_thumbnail(item.image, "65x65", quality=70)
+        render_source.assert_not_called()
+        self.assertTrue(th.exists())
+
+    def test_workers(self):
+        with mock.patch(
+            "django.db.connections.close_all", wraps=connections.close_all
+        ) as close_all, mock.patch.object(
+            default.engine, "get_image", wraps=default.engine.get_image
+        ) as get_image:
+            out = self.prewarm("91x91", workers=1)
+        self.assertIn("Done: 3 sources, 3 thumbnails created, 0 already there", out)
+        # rendered in the worker, forked once the connections were closed
+        get_image.assert_not_called()
+        close_all.assert_called()
+
+        item = Item.objects.get(image="500x500.avif")
+        with mock.patch.object(self.BACKEND, "_render_source") as render_source:
+            th = self.BACKEND.get_thumbnail(item.image, "91x91")
+        render_source.assert_not_called()
+        self.assertTrue(th.exists())
+        self.assertEqual(th.size, [91, 91])
+
+    def test_invalid_source(self):
+        self.create_image("prewarm_broken.jpg", (100, 100))
+        item = Item.objects.get(image="prewarm_broken.jpg")
+        with open(item.image.path, "wb") as f:
+            f.write(b"not an image")
+        out = self.prewarm("93x93")
+        self.assertIn("1 failed sources", out)
+        self.assertTrue(
+            default.kvstore._get(ImageFile(item.image).key, identity="invalid")
+        )
+        default.backend.delete(item.image, delete_file=False)
+
+    def test_resume(self):
+        self.prewarm("67x67")
+        with open(self.checkpoint) as f:
+            last_pk = json.load(f)["last_pk"]
+        self.assertEqual(last_pk, Item.objects.order_by("pk").last().pk)
+
+        self.create_image("prewarm.avif", (100, 100))
+        out = self.prewarm("67x67")
+        self.assertIn("Done: 1 sources, 1 thumbnails created", out)
+
+        os.remove(self.checkpoint)
+        out = self.prewarm("67x67")
+        self.assertIn("4 sources, 0 thumbnails created, 4 already there", out)
+
+    def test_other_arguments(self):
+        self.prewarm("67x67")
+        with self.assertRaises(CommandError):
+            self.prewarm("69x69")
+
+
+@pytest.mark.django_db
+class ThumbnailGcTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        settings.THUMBNAIL_ALTERNATIVE_RESOLUTIONS = [2]
+
+    def tearDown(self):
+        del settings.THUMBNAIL_ALTERNATIVE_RESOLUTIONS
+        super().tearDown()
+
+    def create_orphan(self, name, age):
+        name = settings.THUMBNAIL_PREFIX + name
+        path = default.storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"orphan")
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return name
+
+    def test_gc(self):
+        self.create_image("gc.jpg", (100, 100))
+        th = self.BACKEND.get_thumbnail(ImageFile("gc.jpg"), "71x71")
+        retina = th.name.replace(".", "@2x.")
+        old = self.create_orphan("or/ph/orphan.avif", 7200)
+        old_retina = self.create_orphan("or/ph/orphan@2x.avif", 7200)
+        new = self.create_orphan("new.avif", 0)
+
+        out = StringIO()
+        call_command("thumbnail_gc", "--dry-run", "--batch-size=2", stdout=out)
+        self.assertIn("Would delete 2 of", out.getvalue())
+        self.assertTrue(default.storage.exists(old))
+
+        out = StringIO()
+        call_command("thumbnail_gc", "--batch-size=2", stdout=out)
+        self.assertIn("Deleted 2 of", out.getvalue())
+        self.assertIn(", 12 bytes", out.getvalue())
+        self.assertFalse(default.storage.exists(old))
+        self.assertFalse(default.storage.exists(old_retina))
+        self.assertTrue(default.storage.exists(new))
+        self.assertTrue(th.exists())
+        self.assertTrue(default.storage.exists(retina))
+        default.storage.delete(new)
+
+    def test_stateless(self):
+        settings.THUMBNAIL_STATELESS = True
+        try:
+            with self.assertRaises(CommandError):
+                call_command("thumbnail_gc", stdout=StringIO())
+        finally:
+            del settings.THUMBNAIL_STATELESS
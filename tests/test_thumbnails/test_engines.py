@@ -1,10 +1,13 @@
+import io
 import os
+import pickle
 import unittest
+from unittest import mock
 
 import pytest
 from django.core.files.storage import default_storage
 from django.template.loader import render_to_string
-from PIL import Image
+from PIL import Image, ImageFile as PILImageFile
 import pillow_avif  # noqa: F401
 
 from sorl.thumbnail import default
@@ -12,10 +15,12 @@ from sorl.thumbnail.base import ThumbnailBackend
 from sorl.thumbnail.conf import settings
 from sorl.thumbnail.helpers import get_module_class
 from sorl.thumbnail.images import ImageFile
-from sorl.thumbnail.parsers import parse_geometry
+from sorl.thumbnail.parsers import ThumbnailParseError, parse_geometry
 from sorl.thumbnail.templatetags.thumbnail import margin
 
+from sorl_thumbnail_avif.thumbnail.buffers import BufferPool
 from sorl_thumbnail_avif.thumbnail.engines import AvifEngine as PILEngine
+from sorl_thumbnail_avif.thumbnail.engines.pil_engine import ssim
 
 from .models import Item
 from .utils import BaseTestCase
@@ -498,6 +503,268 @@ class DummyTestCase(unittest.TestCase):
         )
 
 
+@pytest.mark.django_db
+class AvifEncoderOptionsTestCase(BaseTestCase):
+    def test_size_classes(self):
+        engine = PILEngine()
+        small = engine._get_avif_params(Image.new("RGB", (100, 100)), {})
+        self.assertEqual(small["speed"], 6)
+        self.assertEqual(small["max_threads"], 1)
+        self.assertTrue(small["autotiling"])
+
+        large = engine._get_avif_params(Image.new("RGB", (2000, 2000)), {})
+        self.assertEqual(large["speed"], 8)
+        self.assertEqual(large["max_threads"], os.cpu_count())
+
+    def test_explicit_options(self):
+        engine = PILEngine()
+        params = engine._get_avif_params(
+            Image.new("RGB", (100, 100)),
+            {"avif_speed": "9", "avif_threads": 4, "avif_tiling": "4x2"},
+        )
+        self.assertEqual(params["speed"], 9)
+        self.assertEqual(params["max_threads"], 4)
+        self.assertEqual((params["tile_cols"], params["tile_rows"]), (2, 1))
+        self.assertFalse(params["autotiling"])
+
+        with self.assertRaises(ThumbnailParseError):
+            engine._get_avif_params(Image.new("RGB", (10, 10)), {"avif_tiling": "3x1"})
+
+    def test_options_in_key(self):
+        item = Item.objects.get(image="500x500.avif")
+
+        th1 = self.BACKEND.get_thumbnail(item.image, "100x100")
+        th2 = self.BACKEND.get_thumbnail(item.image, "100x100", avif_speed=10)
+        self.assertNotEqual(th1.name, th2.name)
+
+        settings.THUMBNAIL_AVIF_SPEED = 10
+        try:
+            th3 = self.BACKEND.get_thumbnail(item.image, "100x100")
+        finally:
+            del settings.THUMBNAIL_AVIF_SPEED
+        self.assertEqual(th2.name, th3.name)
+
+    def test_tiled_encode(self):
+        item = Item.objects.get(image="500x500.avif")
+        th = self.BACKEND.get_thumbnail(
+            item.image, "400x400", avif_tiling="2x2", avif_threads=2
+        )
+        self.assertEqual(Image.open(th.storage.path(th.name)).size, (400, 400))
+
+
+@pytest.mark.django_db
+class QualitySearchTestCase(BaseTestCase):
+    def detailed_image(self, size):
+        return Image.effect_mandelbrot(size, (-2, -1.5, 1, 1.5), 100).convert("RGB")
+
+    def test_target_bytes(self):
+        engine = PILEngine()
+        image = self.detailed_image((400, 400))
+        options = {"format": "AVIF", "quality": 95, "target_bytes": 6000}
+
+        with mock.patch.object(engine, "encode", wraps=engine.encode) as encode:
+            quality, raw_data = engine.encode_to_target(image, options)
+
+        self.assertLessEqual(len(raw_data), 6000)
+        self.assertGreater(
+            len(engine.encode(image, dict(options, quality=quality + 5))), 6000
+        )
+        # the trial does most of the search
+        full_size = [c for c in encode.call_args_list if c[0][0] is image]
+        self.assertLessEqual(len(full_size), 6)
+
+    def test_target_ssim(self):
+        engine = PILEngine()
+        image = self.detailed_image((200, 200))
+        quality, raw_data = engine.encode_to_target(
+            image, {"format": "AVIF", "quality": 95, "target_ssim": 0.9}
+        )
+        with Image.open(raw_data) as encoded:
+            self.assertGreaterEqual(ssim(image, encoded), 0.9)
+        self.assertLess(quality, 90)
+
+    def test_unreachable_target(self):
+        engine = PILEngine()
+        quality, _ = engine.encode_to_target(
+            self.detailed_image((100, 100)),
+            {"format": "AVIF", "quality": 95, "target_bytes": 10},
+        )
+        self.assertEqual(quality, 20)
+
+    def test_quality_stored(self):
+        self.detailed_image((600, 600)).save(
+            os.path.join(settings.MEDIA_ROOT, "detailed.png")
+        )
+
+        self.BACKEND.get_thumbnail("detailed.png", "300x300", target_bytes=5000)
+        quality = default.kvstore._get(ImageFile("detailed.png").key, "quality")
+        self.assertTrue(quality)
+
+        with mock.patch.object(
+            default.engine, "encode_to_target", wraps=default.engine.encode_to_target
+        ) as encode_to_target:
+            self.BACKEND.get_thumbnail("detailed.png", "200x200", target_bytes=5000)
+        self.assertEqual(encode_to_target.call_args[0][1]["quality_hint"], quality)
+
+
+@pytest.mark.django_db
+class OutputBufferTestCase(BaseTestCase):
+    def test_encode_leaves_maxblock(self):
+        maxblock = PILImageFile.MAXBLOCK
+        image = Image.new("RGB", (1200, 1200), (10, 20, 30))
+
+        raw_data = PILEngine().encode(
+            image, {"format": "JPEG", "quality": 95, "progressive": True}
+        )
+
+        self.assertEqual(PILImageFile.MAXBLOCK, maxblock)
+        with Image.open(raw_data) as encoded:
+            self.assertEqual(encoded.size, (1200, 1200))
+        raw_data.close()
+
+    def test_reuse(self):
+        pool = BufferPool()
+        buffer = pool.acquire()
+        buffer.write(b"thumbnail")
+        data = buffer._data
+        self.assertEqual(bytes(buffer.getbuffer()), b"thumbnail")
+        buffer.close()
+
+        buffer = pool.acquire()
+        self.assertIs(buffer._data, data)
+        self.assertEqual(len(buffer), 0)
+        buffer.write(b"th")
+        self.assertEqual(buffer.getvalue(), b"th")
+        buffer.seek(0)
+        self.assertEqual(buffer.read(), b"th")
+
+    def test_rollover(self):
+        pool = BufferPool()
+        settings.THUMBNAIL_BUFFER_POOL_MAX_BYTES = 4
+        try:
+            buffer = pool.acquire()
+            buffer.write(b"th")
+            self.assertFalse(buffer.rolled_over)
+            buffer.write(b"umbnail")
+            self.assertTrue(buffer.rolled_over)
+            self.assertEqual(len(pool._buffers), 1)
+
+            self.assertEqual(len(buffer), 9)
+            buffer.seek(2)
+            self.assertEqual(buffer.read(3), b"umb")
+            self.assertEqual(buffer.getvalue(), b"thumbnail")
+            buffer.close()
+        finally:
+            del settings.THUMBNAIL_BUFFER_POOL_MAX_BYTES
+
+    def test_rolled_over_thumbnail(self):
+        Image.effect_mandelbrot((300, 300), (-2, -1.5, 1, 1.5), 100).save(
+            os.path.join(settings.MEDIA_ROOT, "mandelbrot.png")
+        )
+        settings.THUMBNAIL_BUFFER_POOL_MAX_BYTES = 1024
+        try:
+            th = self.BACKEND.get_thumbnail("mandelbrot.png", "210x210", format="PNG")
+        finally:
+            del settings.THUMBNAIL_BUFFER_POOL_MAX_BYTES
+        self.assertGreater(th.storage.size(th.name), 1024)
+        with Image.open(th.storage.path(th.name)) as image:
+            self.assertEqual(image.size, (210, 210))
+
+    def test_pickle(self):
+        buffer = BufferPool().acquire()
+        buffer.write(b"thumbnail")
+        self.assertEqual(pickle.loads(pickle.dumps(buffer)).getvalue(), b"thumbnail")
+
+
+@pytest.mark.django_db
+class DraftTestCase(BaseTestCase):
+    IMAGE_DIMENSIONS = []
+    options = {"crop": False, "cropbox": None}
+
+    def test_jpeg_draft(self):
+        self.create_image("2000x1000.jpg", (2000, 1000))
+        engine = PILEngine()
+        im = engine.get_image(ImageFile("2000x1000.jpg"))
+
+        im = engine.draft(im, (100, 50), self.options)
+        self.assertEqual(im.size, (250, 125))
+
+    def test_reduce(self):
+        self.create_image("2000x1000.png", (2000, 1000))
+        engine = PILEngine()
+        im = engine.get_image(ImageFile("2000x1000.png"))
+
+        im = engine.draft(im, (100, 50), self.options)
+        self.assertEqual(im.size, (200, 100))
+
+    def test_no_draft(self):
+        self.create_image("2000x1000.jpg", (2000, 1000))
+        engine = PILEngine()
+
+        im = engine.get_image(ImageFile("2000x1000.jpg"))
+        self.assertEqual(engine.draft(im, (1000, 500), self.options).size, (2000, 1000))
+
+        im = engine.get_image(ImageFile("2000x1000.jpg"))
+        options = {"crop": False, "cropbox": "0,0,1000,1000"}
+        self.assertEqual(engine.draft(im, (100, 50), options).size, (2000, 1000))
+
+    def test_thumbnail_size(self):
+        item, _ = self.create_image("2001x1001.jpg", (2001, 1001))
+        th = self.BACKEND.get_thumbnail(item.image, "100")
+        self.assertEqual((th.x, th.y), (100, 50))
+        self.assertEqual(default.kvstore.get(ImageFile(item.image)).size, [2001, 1001])
+
+
+class UnseekableStream(io.RawIOBase):
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self.stream.readinto(b)
+
+
+class UnseekableStorage:
+    def __init__(self, data):
+        self.data = data
+
+    def open(self, name, mode="rb"):
+        return UnseekableStream(self.data)
+
+
+@pytest.mark.django_db
+class SourceLoadingTestCase(BaseTestCase):
+    IMAGE_DIMENSIONS = [(100, 100)]
+
+    def test_local_file_not_copied(self):
+        engine = PILEngine()
+        im = engine.get_image(ImageFile("100x100.avif"))
+        self.assertEqual(im.fp.name, os.path.join(settings.MEDIA_ROOT, "100x100.avif"))
+        self.assertEqual(im.size, (100, 100))
+
+        im.load()
+        self.assertIsNone(im.fp)
+
+    def test_stream_spooled(self):
+        with open(os.path.join(settings.MEDIA_ROOT, "100x100.avif"), "rb") as fp:
+            data = fp.read()
+
+        engine = PILEngine()
+        im = engine.get_image(ImageFile("stream.avif", UnseekableStorage(data)))
+        self.assertEqual(im.size, (100, 100))
+        im.load()
+
+    def test_is_valid_image_file(self):
+        engine = PILEngine()
+        path = os.path.join(settings.MEDIA_ROOT, "100x100.avif")
+        self.assertTrue(engine.is_valid_image(path))
+        with open(path, "rb") as fp:
+            self.assertTrue(engine.is_valid_image(fp))
+        self.assertFalse(engine.is_valid_image(b"invalid"))
+
+
 class ImageValidationTestCase(unittest.TestCase):
     def setUp(self):
         self.BACKEND = get_module_class(settings.THUMBNAIL_BACKEND)()
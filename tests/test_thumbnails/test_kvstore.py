@@ -1,7 +1,16 @@
 import threading
 import unittest
+from unittest import mock
+
+import pytest
+from django.db import connection
 
 from sorl.thumbnail.kvstores.cached_db_kvstore import KVStore
+from sorl.thumbnail.models import KVStore as KVStoreModel
+
+from sorl_thumbnail_avif.thumbnail.kvstores.cached_db_kvstore import (
+    KVStore as AvifKVStore,
+)
 
 
 class KVStoreTestCase(unittest.TestCase):
@@ -20,3 +29,40 @@ class KVStoreTestCase(unittest.TestCase):
 
         # Cache backend for each thread needs to be unique
         self.assertNotEqual(cache_backends[0], cache_backends[1])
+
+
+@pytest.mark.django_db
+class SetManyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.kvstore = AvifKVStore()
+        self.features = connection.features
+
+    def test_set_many(self):
+        self.kvstore._set_many_raw({"set-many-a": "1", "set-many-b": "2"})
+        self.kvstore._set_many_raw({"set-many-a": "3"})
+        self.assertEqual(
+            dict(
+                KVStoreModel.objects.filter(key__startswith="set-many-").values_list(
+                    "key", "value"
+                )
+            ),
+            {"set-many-a": "3", "set-many-b": "2"},
+        )
+
+    def test_no_conflict_target(self):
+        # MySQL and MariaDB reject unique_fields
+        with mock.patch.object(
+            self.features, "supports_update_conflicts_with_target", False
+        ), mock.patch.object(KVStoreModel.objects, "bulk_create") as bulk_create:
+            self.kvstore._set_many_raw({"no-target": "1"})
+        self.assertIsNone(bulk_create.call_args.kwargs["unique_fields"])
+
+    def test_no_upsert(self):
+        # Oracle
+        with mock.patch.object(
+            self.features, "supports_update_conflicts", False
+        ), mock.patch.object(KVStoreModel.objects, "bulk_create") as bulk_create:
+            self.kvstore._set_many_raw({"no-upsert": "1"})
+            self.kvstore._set_many_raw({"no-upsert": "2"})
+        bulk_create.assert_not_called()
+        self.assertEqual(KVStoreModel.objects.get(key="no-upsert").value, "2")
@@ -0,0 +1,102 @@
+import socket
+
+import pytest
+
+from sorl.thumbnail.conf import settings
+
+from sorl_thumbnail_avif.thumbnail.metrics import (
+    NO_STAGE,
+    PrometheusCollector,
+    StatsdCollector,
+    prometheus_view,
+    stage,
+)
+from sorl_thumbnail_avif.thumbnail.signals import thumbnail_stage
+
+from .models import Item
+from .utils import BaseTestCase
+
+
+@pytest.mark.django_db
+class StageTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.stages = []
+        thumbnail_stage.connect(self.receiver)
+
+    def tearDown(self):
+        thumbnail_stage.disconnect(self.receiver)
+        super().tearDown()
+
+    def receiver(self, sender, **kwargs):
+        self.stages.append(kwargs)
+
+    def test_stages(self):
+        item = Item.objects.get(image="500x500.avif")
+        self.BACKEND.get_thumbnail(item.image, "47x47")
+
+        names = [s["stage"] for s in self.stages]
+        for name in (
+            "kvstore_get",
+            "source",
+            "decode",
+            "orientation",
+            "scale",
+            "crop",
+            "finish",
+            "encode",
+            "write",
+            "kvstore_set",
+        ):
+            self.assertIn(name, names)
+        for s in self.stages:
+            self.assertGreaterEqual(s["duration"], 0)
+
+        encode = self.stages[names.index("encode")]
+        self.assertEqual(encode["pixels"], 47 * 47)
+        self.assertEqual(encode["format"], "AVIF")
+        write = self.stages[names.index("write")]
+        self.assertEqual(write["bytes"], encode["bytes"])
+        # reduced while decoding
+        self.assertEqual(self.stages[names.index("decode")]["pixels"], 100 * 100)
+
+    def test_disabled(self):
+        thumbnail_stage.disconnect(self.receiver)
+        self.assertIs(stage(self, "decode"), NO_STAGE)
+
+
+@pytest.mark.django_db
+class CollectorTestCase(BaseTestCase):
+    def test_prometheus(self):
+        collector = PrometheusCollector()
+        collector(None, stage="encode", duration=0.5, bytes=100, pixels=40)
+        collector(None, stage="encode", duration=0.25, bytes=50, pixels=40)
+        collector(None, stage="decode", duration=1)
+
+        text = collector.render()
+        self.assertIn('thumbnail_stage_seconds_count{stage="encode"} 2\n', text)
+        self.assertIn('thumbnail_stage_seconds_sum{stage="encode"} 0.750000\n', text)
+        self.assertIn('thumbnail_stage_bytes_total{stage="encode"} 150\n', text)
+        self.assertIn('thumbnail_stage_pixels_total{stage="decode"} 0\n', text)
+        self.assertIn("# TYPE thumbnail_stage_seconds summary\n", text)
+
+        response = prometheus_view(None)
+        self.assertEqual(response["Content-Type"], "text/plain; version=0.0.4")
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(5)
+        self.addCleanup(server.close)
+
+        settings.THUMBNAIL_STATSD_ADDRESS = server.getsockname()
+        try:
+            collector = StatsdCollector()
+        finally:
+            del settings.THUMBNAIL_STATSD_ADDRESS
+        collector(None, stage="encode", duration=0.0125, bytes=100)
+
+        self.assertEqual(
+            server.recv(1024).decode().splitlines(),
+            ["thumbnail.encode:12.500|ms", "thumbnail.encode.bytes:100|h"],
+        )
@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+from django.http import HttpResponse
+from django.test import RequestFactory
+
+from sorl_thumbnail_avif.thumbnail.middleware import (
+    FormatNegotiation,
+    FormatNegotiationMiddleware,
+    get_negotiated_format,
+)
+
+from .models import Item
+from .utils import BaseTestCase
+
+
+@pytest.mark.django_db
+class FormatNegotiationTestCase(BaseTestCase):
+    def get_response(self, request):
+        item = Item.objects.get(image="500x500.avif")
+        return HttpResponse(self.BACKEND.get_thumbnail(item.image, "61x61").name)
+
+    def request(self, accept, get_response=None):
+        middleware = FormatNegotiationMiddleware(get_response or self.get_response)
+        return middleware(RequestFactory().get("/", HTTP_ACCEPT=accept))
+
+    def test_accept(self):
+        response = self.request("image/avif,image/webp,*/*;q=0.8")
+        self.assertTrue(response.content.endswith(b".avif"))
+        self.assertEqual(response["Vary"], "Accept")
+
+        response = self.request("image/webp,image/avif;q=0,*/*;q=0.8")
+        self.assertTrue(response.content.endswith(b".webp"))
+
+        # */* doesn't tell which formats are supported
+        response = self.request("text/html,*/*;q=0.8")
+        self.assertTrue(response.content.endswith(b".jpg"))
+
+    def test_explicit_format(self):
+        def get_response(request):
+            item = Item.objects.get(image="500x500.avif")
+            th = self.BACKEND.get_thumbnail(item.image, "61x61", format="PNG")
+            return HttpResponse(th.name)
+
+        response = self.request("image/avif", get_response)
+        self.assertTrue(response.content.endswith(b".png"))
+        self.assertFalse(response.has_header("Vary"))
+
+    def test_outside_request(self):
+        item = Item.objects.get(image="500x500.avif")
+        th = self.BACKEND.get_thumbnail(item.image, "61x61")
+        self.assertTrue(th.name.endswith(".avif"))
+
+    def test_async(self):
+        async def get_response(request):
+            return HttpResponse(get_negotiated_format())
+
+        response = asyncio.run(self.request("image/webp", get_response))
+        self.assertEqual(response.content, b"WEBP")
+        self.assertIsNone(get_negotiated_format())
+        self.assertEqual(response["Vary"], "Accept")
+
+    def test_parse(self):
+        negotiation = FormatNegotiation("image/AVIF;q=0.9, image/png ; q=0,text/html")
+        self.assertEqual(negotiation.accepted, {"AVIF"})
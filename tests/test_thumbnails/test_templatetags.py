@@ -1,18 +1,128 @@
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import PIPE, Popen
+from unittest import mock
 
 from django.template.loader import render_to_string
 from django.test import Client, TestCase
 from django.test.utils import override_settings
 import pytest
 
+from sorl.thumbnail import default
 from sorl.thumbnail.conf import settings
 
+from sorl_thumbnail_avif.thumbnail.templatetags.avif_thumbnail import (
+    get_picture,
+    get_srcset,
+)
+
 from .models import Item
 from .utils import BaseTestCase
 
 
+@pytest.mark.django_db
+class SrcsetTestCase(BaseTestCase):
+    def test_srcset(self):
+        item = Item.objects.get(image="500x500.avif")
+
+        with mock.patch.object(
+            default.engine, "get_image", wraps=default.engine.get_image
+        ) as get_image:
+            val = render_to_string("thumbnail_srcset.html", {"item": item}).strip()
+        self.assertEqual(get_image.call_count, 1)
+
+        urls = re.findall(r"(/media/test/cache/\S+\.avif) (\d+)w", val)
+        self.assertEqual([width for _, width in urls], ["100", "200", "300"])
+        self.assertTrue(val.startswith('<img srcset="'))
+
+        # all cached now
+        with mock.patch.object(default.engine, "get_image") as get_image:
+            self.assertEqual(
+                render_to_string("thumbnail_srcset.html", {"item": item}).strip(), val
+            )
+        self.assertFalse(get_image.called)
+
+    def test_srcset_as_var(self):
+        item = Item.objects.get(image="100x100.avif")
+        val = render_to_string(
+            "thumbnail_srcset_as.html",
+            {"item": item, "geometries": ["50", "100", "200"]},
+        ).strip()
+        # 200 can't be upscaled, it's the same as 100
+        widths = re.findall(r" (\d+)w", val)
+        self.assertEqual(widths, ["50", "100"])
+
+    def test_srcset_missing_source(self):
+        self.assertEqual(get_srcset("srcset_missing.jpg", ["50", "100"]), "")
+
+
+@pytest.mark.django_db
+class PictureTestCase(BaseTestCase):
+    def test_picture(self):
+        item = Item.objects.get(image="500x500.avif")
+        val = render_to_string("thumbnail_picture.html", {"item": item}).strip()
+
+        self.assertRegex(
+            val,
+            r'^<picture><source srcset="/media/test/cache/\S+\.avif" type="image/avif">'
+            r'<source srcset="/media/test/cache/\S+\.webp" type="image/webp">'
+            r'<img src="/media/test/cache/\S+\.jpg" width="120" height="120" '
+            r'alt="An item"></picture>$',
+        )
+
+    def test_picture_as_var(self):
+        item = Item.objects.get(image="500x500.avif")
+        val = render_to_string("thumbnail_picture_as.html", {"item": item}).strip()
+        self.assertRegex(val, r"^\S+\.webp 90x90\s+\S+\.png 90x90$")
+
+    def test_picture_missing_source(self):
+        thumbnails = default.backend.get_thumbnail_formats(
+            "picture_missing.jpg", "120x120", ["WEBP", "JPEG"]
+        )
+        self.assertRegex(
+            get_picture(thumbnails, ["WEBP", "JPEG"], "Missing"),
+            r'^<picture><source srcset="\S+\.webp" type="image/webp">'
+            r'<img src="\S+\.jpg" alt="Missing"></picture>$',
+        )
+
+
+@pytest.mark.django_db(transaction=True)
+class PrefetchTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        # the in memory sqlite test database doesn't take concurrent writers
+        executor = ThreadPoolExecutor(max_workers=1)
+        patcher = mock.patch(
+            "sorl_thumbnail_avif.thumbnail.base.get_async_executor",
+            return_value=executor,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(executor.shutdown)
+
+    def test_prefetch(self):
+        items = list(Item.objects.order_by("pk"))
+        with mock.patch.object(
+            default.kvstore, "get_many", wraps=default.kvstore.get_many
+        ) as get_many:
+            val = render_to_string("thumbnail_prefetch.html", {"items": items})
+        self.assertEqual(get_many.call_count, 1)
+        self.assertEqual(
+            re.findall(r'width="(\d+)"', val), ["75"] * len(items), val.strip()
+        )
+
+        # created by the prefetch, the next render only looks them up once
+        with mock.patch.object(
+            default.kvstore, "get_many", wraps=default.kvstore.get_many
+        ) as get_many, mock.patch.object(default.engine, "get_image") as get_image:
+            self.assertEqual(
+                render_to_string("thumbnail_prefetch.html", {"items": items}), val
+            )
+        self.assertEqual(get_many.call_count, 1)
+        get_image.assert_not_called()
+
+
 @pytest.mark.django_db
 class TemplateTestCaseA(BaseTestCase):
     def test_model(self):
@@ -13,6 +13,8 @@ from sorl.thumbnail.helpers import get_module_class
 from sorl.thumbnail.images import ImageFile
 from sorl.thumbnail.log import ThumbnailLogHandler
 
+from sorl_thumbnail_avif.thumbnail.kvstores.base import local_cache
+
 from .models import Item
 from .storage import MockLoggingHandler
 
@@ -96,6 +98,8 @@ class BaseTestCase(unittest.TestCase):
         return img.mode in ("RGBA", "LA") or "transparency" in img.info
 
     def setUp(self):
+        # the database is rolled back between tests, so must be what it caches
+        local_cache.clear()
         self.BACKEND = get_module_class(settings.THUMBNAIL_BACKEND)()
         self.ENGINE = get_module_class(settings.THUMBNAIL_ENGINE)()
         self.KVSTORE = get_module_class(settings.THUMBNAIL_KVSTORE)()